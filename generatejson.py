@@ -9,28 +9,771 @@
 #   'setupassistant', and 'userland'
 #
 # The generated Json will be saved in the root directory
-# Future plan for this tool is to add AWS S3 integration for auto-upload
+#
+# Only the stage directories are scanned, several directories at a time
+# (with scandir when it is importable), and files anywhere below a stage
+# directory belong to that stage. --include and --exclude take glob patterns
+# for the payloads to pick up and the files or directories to leave out.
+#
+# --profiles treats every directory in the rootdir as a profile with its own
+# stage directories, and writes <profile>/bootstrap.json for each from one
+# scan. Payloads shared between profiles through hard or symbolic links are
+# hashed once and served from the same url.
+#
+# --s3-bucket uploads every payload (and the json) to S3 or any S3 compatible
+# store while hashing it, in the same read pass. Objects whose stored sha256
+# already matches are skipped, so publishing only uploads what changed.
+# Requires boto3. Use --s3-endpoint-url to point at a local S3 stand-in.
+#
+# --watch keeps running, re-hashing only added or changed files and
+# atomically rewriting the json while preserving manual edits to entries.
+#
+# --bundle additionally writes bootstrap.iabundle, a single file containing
+# the json and every payload, for offline or edge bootstraps.
+#
+# --hash-algorithm selects the digest written to 'hash' (default sha256) and
+# records it as 'hash_algorithm'. Pass it more than once to also write the
+# extra digests to 'hashes'; all of them are computed in one read.
+#
+# --profile DIR writes cProfile stats and memory reports for each scan and
+# publish pass to DIR.
+#
+# --delta-cache DIR keeps every published payload in DIR (a blob cache, like
+# the client's --cachepath) and writes bsdiff patches from the earlier
+# versions of each changed payload to the rootdir's deltas directory, listed
+# under the item's 'deltas'. Needs the bsdiff4 module or the bsdiff tool.
+#
+# --shared-rootdir writes the json for a directory of items common to many
+# manifests as a fragment in that directory, and includes it by url and
+# hash (served from --shared-base-url) instead of repeating its items.
+#
+# --seed PATH writes a seed bundle to ship in the installapplications package
+# as seed.iabundle: the json plus, by default, the setupassistant payloads,
+# so the daemon can start before the json has downloaded.
 
-import hashlib
+import copy
+import fnmatch
 import json
+import multiprocessing
 import optparse
 import os
+import re
 import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+# Shared modules live alongside installapplications.py in the payload.
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'payload', 'Library',
+    'Application Support', 'installapplications'))
+# PEP8 can really be annoying at times.
+import blobcache  # noqa
+import delta  # noqa
+import iabundle  # noqa
+import iahash  # noqa
+import manifest  # noqa
+import profiler  # noqa
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Patches live here inside the rootdir, next to the stage directories.
+DELTA_DIR = 'deltas'
+# Patches at least this fraction of the new payload aren't worth it.
+MAX_DELTA_RATIO = 0.5
+# Name of the fragment written to --shared-rootdir.
+FRAGMENT_NAME = 'fragment.json'
+# Payloads picked up when --include isn't given.
+DEFAULT_INCLUDE = ['*.pkg', '*.py', '*.sh', '*.rb', '*.php']
+# Directories listed at once while scanning.
+SCAN_WORKERS = 16
+
+
+class S3Uploader(object):
+    '''Uploads payloads to S3, hashing them in the same read pass. The
+    primary digest of each object is stored as an object tag named after
+    its algorithm so unchanged payloads can be skipped on the next publish.
+    '''
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, workers=4,
+                 partsize=8, algorithms=(iahash.DEFAULT_ALGORITHM,)):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            print '[Error] S3 upload requires boto3: pip install boto3'
+            sys.exit(1)
+        self.ClientError = ClientError
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.partsize = partsize * 2**20
+        self.algorithms = list(algorithms)
+        self.hashtag = self.algorithms[0]
+        self.pool = ThreadPool(workers)
+        # Bound the parts in flight so memory stays at a few parts per worker
+        self.inflight = threading.BoundedSemaphore(workers * 2)
+        self.uploaded = 0
+        self.skipped = 0
+
+    def key(self, *parts):
+        return '/'.join([p for p in (self.prefix,) + parts if p])
+
+    def storedhash(self, key, size):
+        '''Return the digest tag of an existing object of the same size'''
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=key)
+        except self.ClientError:
+            return None
+        if head['ContentLength'] != size:
+            return None
+        try:
+            tags = self.client.get_object_tagging(
+                Bucket=self.bucket, Key=key)['TagSet']
+        except self.ClientError:
+            return None
+        for tag in tags:
+            if tag['Key'] == self.hashtag:
+                return tag['Value']
+        return None
+
+    def tag(self, key, filehash):
+        self.client.put_object_tagging(
+            Bucket=self.bucket, Key=key,
+            Tagging={'TagSet': [{'Key': self.hashtag, 'Value': filehash}]})
+
+    def upload(self, filepath, key):
+        '''Upload filepath to key unless the stored hash already matches.
+        Returns the digests of the file.'''
+        size = os.path.getsize(filepath)
+        stored = self.storedhash(key, size)
+        if stored is not None:
+            # Same size as the published object, so it is worth one hashing
+            # read to find out if the upload can be skipped.
+            digests = iahash.hashfile(filepath, self.algorithms)
+            if digests[self.hashtag] == stored:
+                print 'Unchanged, skipping upload: %s' % key
+                self.skipped += 1
+                return digests
+        if size <= self.partsize:
+            digests = self.putsmall(filepath, key)
+        else:
+            digests = self.putmultipart(filepath, key)
+        self.tag(key, digests[self.hashtag])
+        self.uploaded += 1
+        print 'Uploaded s3://%s/%s' % (self.bucket, key)
+        return digests
+
+    def putsmall(self, filepath, key):
+        with open(filepath, 'rb') as fileref:
+            data = fileref.read()
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+        hash_function = iahash.MultiHash(self.algorithms)
+        hash_function.update(data)
+        return hash_function.hexdigests()
+
+    def putmultipart(self, filepath, key):
+        hash_function = iahash.MultiHash(self.algorithms)
+        upload_id = self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=key)['UploadId']
+        results = []
+
+        def uploadpart(partnumber, data):
+            try:
+                response = self.client.upload_part(
+                    Bucket=self.bucket, Key=key, UploadId=upload_id,
+                    PartNumber=partnumber, Body=data)
+                return {'PartNumber': partnumber, 'ETag': response['ETag']}
+            finally:
+                self.inflight.release()
+
+        try:
+            partnumber = 1
+            with open(filepath, 'rb') as fileref:
+                while 1:
+                    self.inflight.acquire()
+                    data = fileref.read(self.partsize)
+                    if not data:
+                        self.inflight.release()
+                        break
+                    hash_function.update(data)
+                    results.append(self.pool.apply_async(
+                        uploadpart, (partnumber, data)))
+                    partnumber += 1
+            parts = [result.get() for result in results]
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts})
+        except Exception:
+            for result in results:
+                result.wait()
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+        return hash_function.hexdigests()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def filehash_cached(filepath, relpath, uploader, statcache, algorithms):
+    '''Hash (and upload) filepath, reusing the previous digests if the file
+    has not changed since it was last seen.'''
+    if statcache is not None:
+        st = os.stat(filepath)
+        statkey = (st.st_ino, st.st_size, st.st_mtime)
+        cached = statcache.get(filepath)
+        if cached and cached[0] == statkey:
+            return cached[1]
+    if uploader:
+        digests = uploader.upload(filepath,
+                                  uploader.key(*relpath.split(os.sep)))
+    else:
+        digests = iahash.hashfile(filepath, algorithms)
+    if statcache is not None:
+        statcache[filepath] = (statkey, digests)
+    return digests
+
+
+def matches(relpath, patterns):
+    '''True if relpath matches one of the glob patterns. Patterns with a /
+    are matched against the whole path below the rootdir, others against
+    the name.'''
+    name = os.path.basename(relpath)
+    for pattern in patterns:
+        if fnmatch.fnmatch(relpath if '/' in pattern else name, pattern):
+            return True
+    return False
+
+
+def listdir(path):
+    '''Names of the directories and (name, stat) of the files directly in
+    path. Symlinks to directories are not followed, like os.walk.'''
+    dirs, files = [], []
+    try:
+        if scandir is not None:
+            for entry in scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.name)
+                elif entry.is_file():
+                    files.append((entry.name, entry.stat()))
+            return dirs, files
+        for name in os.listdir(path):
+            fullpath = os.path.join(path, name)
+            if os.path.isdir(fullpath) and not os.path.islink(fullpath):
+                dirs.append(name)
+            elif os.path.isfile(fullpath):
+                files.append((name, os.stat(fullpath)))
+    except OSError:
+        # Removed while scanning
+        pass
+    return dirs, files
+
+
+def scantree(rootdir, include, exclude, enter, workers=SCAN_WORKERS):
+    '''Every directory below rootdir that enter(relpath) accepts, and the
+    (relpath, stat) of every file in them matching include but not exclude.
+    Each level of the tree is listed in parallel and excluded directories
+    are not entered.'''
+    dirs, files = [], []
+    level = ['']
+    pool = ThreadPool(workers)
+    try:
+        while level:
+            listings = pool.map(
+                lambda reldir: (reldir, listdir(os.path.join(rootdir,
+                                                             reldir))),
+                level)
+            level = []
+            for reldir, (subdirs, entries) in listings:
+                for name in subdirs:
+                    relpath = os.path.join(reldir, name)
+                    if enter(relpath) and not matches(relpath, exclude):
+                        dirs.append(relpath)
+                        level.append(relpath)
+                for name, st in entries:
+                    relpath = os.path.join(reldir, name)
+                    if reldir and matches(relpath, include) and \
+                            not matches(relpath, exclude):
+                        files.append((relpath, st))
+    finally:
+        pool.close()
+        pool.join()
+    return sorted(dirs), sorted(files)
+
+
+def locate(relpath, profiles=False):
+    '''Split a path below the rootdir into its profile (None without
+    profiles), stage and the rest of the path, or return None if it isn't
+    inside a stage directory. Files belong to the stage directory they are
+    in at any depth.'''
+    parts = relpath.split(os.sep)
+    profile = None
+    if profiles:
+        profile, parts = parts[0], parts[1:]
+    if not parts or parts[0] not in manifest.STAGES:
+        return None
+    return profile, parts[0], parts[1:]
+
+
+def entered(reldir, profiles=False):
+    '''True if the scan has to look inside reldir'''
+    parts = reldir.split(os.sep)
+    if parts[0] == DELTA_DIR:
+        return False
+    if profiles and len(parts) == 1:
+        return True
+    return locate(reldir, profiles) is not None
+
+
+def hashfiles(rootdir, files, uploader, statcache, algorithms):
+    '''Digests of every (relpath, stat) in files. A file reached through
+    more than one path (hard or symbolic links, say between profiles) is
+    hashed once, and every path is mapped to the first one. Returns
+    {relpath: (digests, canonical relpath)}.'''
+    canonical = {}
+    for relpath, st in files:
+        canonical.setdefault((st.st_dev, st.st_ino), relpath)
+    unique = sorted(canonical.values())
+
+    # Hash (and upload) every file concurrently; hashing large files
+    # releases the GIL.
+    def hashone(relpath):
+        try:
+            return filehash_cached(os.path.join(rootdir, relpath), relpath,
+                                   uploader, statcache, algorithms)
+        except (IOError, OSError):
+            # Removed between listing and hashing
+            return None
+
+    pool = ThreadPool(multiprocessing.cpu_count())
+    try:
+        digests = dict(zip(unique, pool.map(hashone, unique)))
+    finally:
+        pool.close()
+        pool.join()
+    hashed = {}
+    for relpath, st in files:
+        first = canonical[(st.st_dev, st.st_ino)]
+        if digests[first] is not None:
+            hashed[relpath] = (digests[first], first)
+    return hashed
+
+
+def makeentry(relpath, urlpath, digests, size, opts):
+    '''The json entry for the payload at relpath, served from the url of
+    the same file at urlpath'''
+    algorithms = opts.hash_algorithm
+    filename = os.path.basename(relpath)
+    filehash = digests[algorithms[0]]
+    # The first base url is the primary, any others are mirrors.
+    fileurls = ['%s/%s' % (base_url, urlpath)
+                for base_url in opts.base_url or []]
+    fileurl = fileurls[0] if fileurls else ''
+    filejson = {'file':
+                '/Library/Application Support/installapplications/%s' % filename,
+                'url': fileurl, 'hash': str(filehash),
+                'name': filename,
+                'size': size}
+    if len(fileurls) > 1:
+        filejson['mirrors'] = fileurls[1:]
+    if algorithms[0] != iahash.DEFAULT_ALGORITHM:
+        filejson['hash_algorithm'] = algorithms[0]
+    if len(algorithms) > 1:
+        filejson['hashes'] = dict(
+            (algorithm, str(digests[algorithm]))
+            for algorithm in algorithms[1:])
+    if os.path.splitext(filename)[1] == '.pkg':
+        filejson['type'] = 'package'
+        filejson['packageid'] = ''
+        filejson['version'] = ''
+    else:
+        filejson['type'] = 'rootscript'
+    return filejson
+
+
+def generateprofiles(rootdir, opts, uploader=None, statcache=None,
+                     profiles=True):
+    '''Scan rootdir once and build the json of every profile in it (a
+    directory of stage directories), or of rootdir itself if profiles is
+    False. Returns {profile: (stages, payloads)} where payloads is a list of
+    (hash, name, path); the profile is None for rootdir itself.'''
+    dirs, files = scantree(rootdir, opts.include, opts.exclude,
+                           lambda reldir: entered(reldir, profiles))
+    generated = {}
+    for reldir in dirs:
+        located = locate(reldir, profiles)
+        if located is not None and not located[2]:
+            stages = generated.setdefault(located[0], ({}, []))[0]
+            stages[located[1]] = []
+    hashed = hashfiles(rootdir, files, uploader, statcache,
+                       opts.hash_algorithm)
+    for relpath, st in files:
+        if relpath not in hashed:
+            continue
+        profile, stage, rest = locate(relpath, profiles)
+        digests, first = hashed[relpath]
+        filejson = makeentry(relpath, first.replace(os.sep, '/'), digests,
+                             st.st_size, opts)
+        stages, payloads = generated[profile]
+        stages[stage].append(filejson)
+        payloads.append((filejson['hash'], filejson['name'],
+                         os.path.join(rootdir, relpath)))
+    return generated
+
+
+def generatestages(rootdir, opts, uploader=None, statcache=None):
+    '''Traverse through root dir, find all stages and all pkgs to generate
+    json. Returns the stages dict and a list of (hash, name, path) payloads.
+    '''
+    return generateprofiles(rootdir, opts, uploader, statcache,
+                            False).get(None, ({}, []))
+
+
+def writejson(savepath, data):
+    '''Stream json to a temporary file next to savepath and rename it into
+    place once it is on disk, so readers never see a partially written
+    manifest.'''
+    tmppath = '%s.%d.tmp' % (savepath, os.getpid())
+    encoder = json.JSONEncoder(sort_keys=True, indent=2)
+    try:
+        with open(tmppath, 'w') as outfile:
+            for chunk in encoder.iterencode(data):
+                outfile.write(chunk)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.rename(tmppath, savepath)
+    except (IOError, OSError):
+        print '[Error] Not a valid directory: %s' % savepath
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass
+        sys.exit(1)
+
+
+def publish(savepath, stages, payloads, opts, uploader=None, profile=None):
+    '''Save the json and any requested artifacts'''
+    writejson(savepath, stages)
+    print 'Json saved to %s' % savepath
+
+    if uploader:
+        uploader.upload(savepath, uploader.key(profile, 'bootstrap.json'))
+
+    if opts.bundle:
+        bundlepath = os.path.join(os.path.dirname(savepath),
+                                  'bootstrap.iabundle')
+        try:
+            count = iabundle.writebundle(bundlepath, stages, payloads)
+        except (IOError, OSError) as err:
+            print '[Error] Could not write bundle %s: %s' % (bundlepath, err)
+            sys.exit(1)
+        print 'Bundle with %d payloads saved to %s' % (count, bundlepath)
+
+    if opts.seed:
+        try:
+            count = iabundle.writebundle(
+                opts.seed, stages,
+                seedpayloads(stages, payloads, opts.seed_payloads))
+        except (IOError, OSError) as err:
+            print '[Error] Could not write seed %s: %s' % (opts.seed, err)
+            sys.exit(1)
+        print 'Seed with %d payloads saved to %s' % (count, opts.seed)
+
+
+def writefragment(opts):
+    '''Write the json for --shared-rootdir as a fragment inside it. Returns
+    the include entry for it, its stages and its payloads; the fragment
+    itself is one of the payloads so it can go into a bundle.'''
+    sharedopts = copy.copy(opts)
+    sharedopts.rootdir = opts.shared_rootdir
+    sharedopts.base_url = [opts.shared_base_url.rstrip('/')]
+    stages, payloads = generatestages(opts.shared_rootdir, sharedopts)
+    fragmentpath = os.path.join(opts.shared_rootdir, FRAGMENT_NAME)
+    # Keep manual edits (packageid, version...) made to the last fragment.
+    stages = mergestages(loadjson(fragmentpath), stages)[0]
+    writejson(fragmentpath, stages)
+    algorithm = opts.hash_algorithm[0]
+    fragmenthash = str(iahash.gethash(fragmentpath, algorithm))
+    include = {'url': '%s/%s' % (sharedopts.base_url[0], FRAGMENT_NAME),
+               'hash': fragmenthash}
+    if algorithm != iahash.DEFAULT_ALGORITHM:
+        include['hash_algorithm'] = algorithm
+    print 'Fragment saved to %s' % fragmentpath
+    return include, stages, payloads + [(fragmenthash, FRAGMENT_NAME,
+                                         fragmentpath)]
+
+
+def includefragment(stages, payloads, fragment):
+    '''Include the fragment returned by writefragment() in stages, dropping
+    the items it already provides'''
+    include, shared, sharedpayloads = fragment
+    provided = set(entry['hash'] for entries in shared.values()
+                   for entry in entries)
+    for stage, entries in stages.items():
+        stages[stage] = [entry for entry in entries
+                         if entry['hash'] not in provided]
+    stages['include'] = [include]
+    known = set(payload[0] for payload in payloads)
+    return payloads + [payload for payload in sharedpayloads
+                       if payload[0] not in known]
+
+
+def seedpayloads(stages, payloads, which):
+    '''The payloads to put in a seed bundle: none, those of the
+    setupassistant stage, or all. Included fragments always go in.'''
+    if which == 'all':
+        return payloads
+    wanted = set()
+    if which == 'setupassistant':
+        wanted.update(entry['hash']
+                      for entry in stages.get('setupassistant', []))
+    wanted.update(include['hash'] for include in stages.get('include', []))
+    return [payload for payload in payloads if payload[0] in wanted]
+
+
+def entrykey(entry):
+    return os.path.basename(entry.get('file', ''))
+
+
+def mergestages(previous, generated):
+    '''Merge a freshly generated manifest into the previous one. Existing
+    entries keep their position and any manual edits (packageid, version,
+    donotwait, type, file...), only the generated hash and url are updated.
+    Returns the merged stages and lists of added, removed and changed names.
+    '''
+    merged = {}
+    added, removed, changed = [], [], []
+    for stage in set(previous) | set(generated):
+        old = previous.get(stage, [])
+        new = generated.get(stage)
+        if new is None:
+            # Stage directory is gone
+            removed.extend([entrykey(entry) for entry in old])
+            continue
+        newbykey = dict((entrykey(entry), entry) for entry in new)
+        merged[stage] = []
+        for entry in old:
+            key = entrykey(entry)
+            if key not in newbykey:
+                if entry.get('hash'):
+                    removed.append(key)
+                    continue
+                # Hand written entries without a payload are kept as is.
+                merged[stage].append(entry)
+                continue
+            fresh = newbykey.pop(key)
+            entry = dict(entry)
+            if entry.get('hash') != fresh['hash']:
+                changed.append(key)
+                entry['hash'] = fresh['hash']
+            for hashkey in ('hash_algorithm', 'hashes', 'deltas'):
+                if hashkey in fresh:
+                    entry[hashkey] = fresh[hashkey]
+                else:
+                    entry.pop(hashkey, None)
+            if fresh['url']:
+                entry['url'] = fresh['url']
+            if 'mirrors' in fresh:
+                entry['mirrors'] = fresh['mirrors']
+            entry['size'] = fresh['size']
+            merged[stage].append(entry)
+        for entry in new:
+            if entrykey(entry) in newbykey:
+                added.append(entrykey(entry))
+                merged[stage].append(entry)
+    return merged, added, removed, changed
+
+
+def family(filename):
+    '''filename with its version numbers taken out, so Foo-1.2.3.pkg and
+    Foo-1.2.4.pkg are recognised as the same payload'''
+    return re.sub(r'[0-9]+([._-][0-9]+)*', '#', filename)
+
+
+def previousentry(entries, filename):
+    '''The entry in a previous stage that filename replaces, if any'''
+    for entry in entries:
+        if entrykey(entry) == filename:
+            return entry
+    matching = [entry for entry in entries
+                if family(entrykey(entry)) == family(filename)]
+    return matching[0] if len(matching) == 1 else None
+
+
+def makedelta(cache, oldhash, newhash, filepath, algorithm, opts,
+              uploader=None):
+    '''Diff an earlier version against filepath and return the delta entry,
+    or None if the patch would not save enough'''
+    name = delta.deltaname(oldhash, newhash)
+    deltadir = os.path.join(opts.rootdir, DELTA_DIR)
+    patchpath = os.path.join(deltadir, name)
+    if not os.path.isfile(patchpath):
+        if not os.path.isdir(deltadir):
+            os.makedirs(deltadir)
+        tmppath = '%s.%d.tmp' % (patchpath, os.getpid())
+        try:
+            delta.diff(cache.path(oldhash), filepath, tmppath)
+            os.rename(tmppath, patchpath)
+        except (delta.DeltaError, IOError, OSError) as err:
+            print '[Error] Could not diff %s: %s' % (filepath, err)
+            if os.path.isfile(tmppath):
+                os.remove(tmppath)
+            return None
+    size = os.path.getsize(patchpath)
+    if size >= os.path.getsize(filepath) * MAX_DELTA_RATIO:
+        return None
+    if uploader:
+        digests = uploader.upload(patchpath, uploader.key(DELTA_DIR, name))
+        patchhash = digests[uploader.hashtag]
+    else:
+        patchhash = iahash.gethash(patchpath, algorithm)
+    return {'from': oldhash, 'url': '%s/%s/%s' % (opts.base_url[0],
+                                                  DELTA_DIR, name),
+            'hash': str(patchhash), 'size': size}
 
 
-def gethash(filename):
-    hash_function = hashlib.sha256()
-    if not os.path.isfile(filename):
-        return 'NOT A FILE'
+def makedeltas(previous, stages, payloads, opts, uploader=None, memo=None):
+    '''Add 'deltas' to each generated entry whose payload changed since the
+    previous json, patching from the last --delta-keep versions still in
+    the delta cache. The current payloads are then added to the cache so
+    the next release can be diffed against them. memo remembers diffs that
+    were not worth keeping between --watch passes.'''
+    cache = blobcache.BlobCache(opts.delta_cache)
+    memo = {} if memo is None else memo
+    paths = dict((filehash, filepath)
+                 for filehash, filename, filepath in payloads)
+    for stage, entries in stages.items():
+        for entry in entries:
+            old = previousentry(previous.get(stage, []), entrykey(entry))
+            if old is None or (old.get('hash_algorithm') !=
+                               entry.get('hash_algorithm')):
+                continue
+            newhash = entry['hash']
+            if old.get('hash') == newhash:
+                if old.get('deltas'):
+                    entry['deltas'] = old['deltas']
+                continue
+            # The version being replaced first, then the ones it could
+            # already be patched from.
+            bases = []
+            for oldhash in [old.get('hash')] + [
+                    patch.get('from') for patch in old.get('deltas', [])]:
+                if oldhash and oldhash != newhash and \
+                        oldhash not in bases and cache.has(oldhash):
+                    bases.append(oldhash)
+            deltas = []
+            for oldhash in bases[:opts.delta_keep]:
+                key = (oldhash, newhash)
+                if key not in memo:
+                    memo[key] = makedelta(
+                        cache, oldhash, newhash, paths[newhash],
+                        entry.get('hash_algorithm',
+                                  iahash.DEFAULT_ALGORITHM),
+                        opts, uploader)
+                if memo[key] is not None:
+                    deltas.append(memo[key])
+            if deltas:
+                entry['deltas'] = deltas
+                print 'Deltas for %s: %d' % (entrykey(entry), len(deltas))
+    for filehash, filename, filepath in payloads:
+        try:
+            # A copy, not a link: payloads are edited in place in the
+            # rootdir, and the cached base has to keep the hash it is
+            # filed under.
+            cache.add(filepath, filehash, link=False)
+        except (IOError, OSError) as err:
+            print '[Error] Could not add %s to the delta cache: %s' % (
+                filepath, err)
+
+
+def loadjson(savepath):
+    try:
+        with open(savepath) as infile:
+            return json.load(infile)
+    except (IOError, ValueError):
+        return {}
+
+
+def watch(rootdir, savepath, opts, uploader=None, prof=None):
+    '''Keep savepath current with rootdir. Only files whose inode, size or
+    mtime changed are re-hashed, and the json is only rewritten (atomically)
+    when an entry was added, removed or changed.'''
+    prof = prof or profiler.NullProfiler()
+    statcache = {}
+    deltamemo = {}
+    previous = loadjson(savepath)
+    written = None
+    print 'Watching %s every %s seconds' % (rootdir, opts.interval)
+    try:
+        while True:
+            # Pick up manual edits made to the json since our last write.
+            try:
+                current = os.stat(savepath).st_mtime
+            except OSError:
+                current = None
+            if current != written:
+                previous = loadjson(savepath)
+            with prof.section('scan'):
+                stages, payloads = generatestages(rootdir, opts, uploader,
+                                                  statcache)
+                if opts.delta_cache:
+                    makedeltas(previous, stages, payloads, opts, uploader,
+                               deltamemo)
+            for filepath in list(statcache):
+                if not os.path.isfile(filepath):
+                    del statcache[filepath]
+            merged, added, removed, changed = mergestages(previous, stages)
+            if merged != previous or written is None:
+                with prof.section('publish'):
+                    publish(savepath, merged, payloads, opts, uploader)
+                written = os.stat(savepath).st_mtime
+                previous = merged
+                print 'Added: %s Removed: %s Changed: %s' % (
+                    ', '.join(added) or '-', ', '.join(removed) or '-',
+                    ', '.join(changed) or '-')
+            time.sleep(opts.interval)
+    except KeyboardInterrupt:
+        print 'Stopped watching %s' % rootdir
+    finally:
+        if uploader:
+            uploader.close()
+
 
-    fileref = open(filename, 'rb')
-    while 1:
-        chunk = fileref.read(2**16)
-        if not chunk:
-            break
-        hash_function.update(chunk)
-    fileref.close()
-    return hash_function.hexdigest()
+def publishprofiles(rootdir, opts, uploader=None, prof=None):
+    '''Write the json of every profile in rootdir, from one scan. Each is
+    saved as <profile>/bootstrap.json in the outputdir (or the rootdir).'''
+    prof = prof or profiler.NullProfiler()
+    with prof.section('scan'):
+        generated = generateprofiles(rootdir, opts, uploader)
+        fragment = None
+        if opts.shared_rootdir:
+            fragment = writefragment(opts)
+    if not generated:
+        print '[Error] No profiles with stage directories in %s' % rootdir
+        sys.exit(1)
+    deltamemo = {}
+    for profile in sorted(generated):
+        # The one scan builds every profile before any is written; each is
+        # dropped once it has been published.
+        stages, payloads = generated.pop(profile)
+        profiledir = os.path.join(opts.outputdir or rootdir, profile)
+        savepath = os.path.join(profiledir, 'bootstrap.json')
+        with prof.section('publish-%s' % profile):
+            if opts.delta_cache:
+                makedeltas(loadjson(savepath), stages, payloads, opts,
+                           uploader, deltamemo)
+            if fragment is not None:
+                payloads = includefragment(stages, payloads, fragment)
+            if not os.path.isdir(profiledir):
+                os.makedirs(profiledir)
+            publish(savepath, stages, payloads, opts, uploader, profile)
 
 
 def main():
@@ -40,46 +783,106 @@ def main():
         'Required: Root directory path for InstallApplications stages'))
     op.add_option('--outputdir', default=None, help=('Optional: Output \
                   directory to save in. Default saves in the rootdir'))
-    op.add_option('--base-url', default=None, action='store',
-                  help=('Base URL to where root dir is hosted'))
+    op.add_option('--base-url', default=None, action='append',
+                  help=('Base URL to where root dir is hosted. Pass more \
+                  than once to add mirrors'))
+    op.add_option('--bundle', default=False, action='store_true',
+                  help=('Optional: Also write bootstrap.iabundle containing \
+                  the json and all payloads'))
+    op.add_option('--s3-bucket', default=None,
+                  help=('Optional: Upload payloads and json to this S3 \
+                  bucket while hashing them'))
+    op.add_option('--s3-prefix', default='',
+                  help=('Optional: Key prefix inside the S3 bucket'))
+    op.add_option('--s3-endpoint-url', default=None,
+                  help=('Optional: Endpoint for S3 compatible storage'))
+    op.add_option('--s3-workers', default=4, type='int',
+                  help=('Optional: Parallel part uploads. Default 4'))
+    op.add_option('--s3-part-size', default=8, type='int',
+                  help=('Optional: Multipart part size in MB. Default 8'))
+    op.add_option('--watch', default=False, action='store_true',
+                  help=('Optional: Keep running and update the json as \
+                  files are added, removed or changed in the rootdir'))
+    op.add_option('--interval', default=5, type='float',
+                  help=('Optional: Seconds between --watch scans. Default 5'))
+    op.add_option('--hash-algorithm', default=None, action='append',
+                  help=('Optional: Hash algorithm for the \'hash\' key. \
+                  Default sha256. Pass more than once to add extra digests'))
+    op.add_option('--profile', default=None, metavar='DIR',
+                  help=('Optional: Write cProfile stats and memory reports \
+                  for each phase to DIR'))
+    op.add_option('--delta-cache', default=None, metavar='DIR',
+                  help=('Optional: Keep published payloads in DIR and write \
+                  patches from earlier versions of changed payloads'))
+    op.add_option('--delta-keep', default=3, type='int',
+                  help=('Optional: Earlier versions to write patches from \
+                  for each changed payload. Default 3'))
+    op.add_option('--shared-rootdir', default=None,
+                  help=('Optional: Root directory of items shared with \
+                  other manifests, written as a fragment and included'))
+    op.add_option('--shared-base-url', default=None,
+                  help=('Optional: Base URL where --shared-rootdir is \
+                  hosted'))
+    op.add_option('--seed', default=None, metavar='PATH',
+                  help=('Optional: Also write a seed bundle to PATH to ship \
+                  in the package as seed.iabundle'))
+    op.add_option('--include', default=None, action='append',
+                  metavar='PATTERN',
+                  help=('Optional: Glob of payloads to pick up. Pass more \
+                  than once for several. Default *.pkg, *.py, *.sh, *.rb \
+                  and *.php'))
+    op.add_option('--exclude', default=[], action='append',
+                  metavar='PATTERN',
+                  help=('Optional: Glob of files and directories to skip. \
+                  Pass more than once for several'))
+    op.add_option('--profiles', default=False, action='store_true',
+                  help=('Optional: Treat each directory in the rootdir as \
+                  a profile with its own stage directories and json'))
+    op.add_option('--seed-payloads', default='setupassistant',
+                  choices=['none', 'setupassistant', 'all'],
+                  help=('Optional: Payloads to put in the seed: none, \
+                  setupassistant or all. Default setupassistant'))
     opts, args = op.parse_args()
 
+    if not opts.hash_algorithm:
+        opts.hash_algorithm = [iahash.DEFAULT_ALGORITHM]
+    for algorithm in opts.hash_algorithm:
+        if not iahash.available(algorithm):
+            print '[Error] Unsupported hash algorithm: %s' % algorithm
+            sys.exit(1)
+
     if opts.rootdir:
         rootdir = opts.rootdir
     else:
         op.print_help()
         sys.exit(1)
 
-    # Traverse through root dir, find all stages and all pkgs to generate json
-    stages = {}
-    for subdir, dirs, files in os.walk(rootdir):
-        for d in dirs:
-            stages[str(d)] = []
-        for file in files:
-            fileext = os.path.splitext(file)[1]
-            if fileext not in ('.pkg', '.py', '.sh', '.rb', '.php'):
-                continue
-            filepath = os.path.join(subdir, file)
-            filename = os.path.basename(filepath)
-            filehash = gethash(filepath)
-            filestage = os.path.basename(os.path.abspath(
-                        os.path.join(filepath, os.pardir)))
-            if opts.base_url:
-                fileurl = '%s/%s/%s' % (opts.base_url, filestage, filename)
-            else:
-                fileurl = ''
-            filejson = {'file':
-                        '/Library/Application Support/installapplications/%s' % filename,
-                        'url': fileurl, 'hash': str(filehash),
-                        'name': filename}
-            if fileext == '.pkg':
-                filejson['type'] = 'package'
-                filejson['packageid'] = ''
-                filejson['version'] = ''
-                stages[filestage].append(filejson)
-            else:
-                filejson['type'] = 'rootscript'
-                stages[filestage].append(filejson)
+    if opts.shared_rootdir and not opts.shared_base_url:
+        print '[Error] --shared-rootdir needs --shared-base-url'
+        sys.exit(1)
+    if not opts.include:
+        opts.include = DEFAULT_INCLUDE
+
+    if opts.profiles and opts.watch:
+        print '[Error] --profiles can\'t be used with --watch'
+        sys.exit(1)
+    if opts.profiles and opts.seed:
+        print '[Error] --profiles can\'t be used with --seed'
+        sys.exit(1)
+
+    if opts.shared_rootdir and opts.watch:
+        print '[Error] --shared-rootdir can\'t be used with --watch'
+        sys.exit(1)
+
+    if opts.delta_cache and not opts.base_url:
+        print '[Error] --delta-cache needs --base-url for the patch urls'
+        sys.exit(1)
+
+    uploader = None
+    if opts.s3_bucket:
+        uploader = S3Uploader(opts.s3_bucket, opts.s3_prefix,
+                              opts.s3_endpoint_url, opts.s3_workers,
+                              opts.s3_part_size, opts.hash_algorithm)
 
     # Saving the file back in the root dir
     if opts.outputdir:
@@ -87,14 +890,33 @@ def main():
     else:
         savepath = os.path.join(rootdir, 'bootstrap.json')
 
-    try:
-        with open(savepath, 'w') as outfile:
-            json.dump(stages, outfile, sort_keys=True, indent=2)
-    except IOError:
-        print '[Error] Not a valid directory: %s' % savepath
-        sys.exit(1)
+    prof = profiler.getprofiler(opts.profile)
 
-    print 'Json saved to %s' % savepath
+    if opts.watch:
+        watch(rootdir, savepath, opts, uploader, prof)
+        return
+
+    if opts.profiles:
+        publishprofiles(rootdir, opts, uploader, prof)
+        if uploader:
+            uploader.close()
+            print 'S3: %d uploaded, %d unchanged' % (uploader.uploaded,
+                                                     uploader.skipped)
+        return
+
+    with prof.section('scan'):
+        stages, payloads = generatestages(rootdir, opts, uploader)
+        if opts.delta_cache:
+            makedeltas(loadjson(savepath), stages, payloads, opts, uploader)
+        if opts.shared_rootdir:
+            payloads = includefragment(stages, payloads,
+                                       writefragment(opts))
+    with prof.section('publish'):
+        publish(savepath, stages, payloads, opts, uploader)
+    if uploader:
+        uploader.close()
+        print 'S3: %d uploaded, %d unchanged' % (uploader.uploaded,
+                                                 uploader.skipped)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,324 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Simulate a mass enrollment against an origin
+# Usage: python loadtest.py --jsonurl https://domain.tld/bootstrap.json
+#
+# Every simulated client does what installapplications.py does: fetch the
+# json, then download each item in stage order from its url (falling over to
+# its mirrors), retrying failed downloads the way download_if_needed() does.
+# A share of downloads can be interrupted part way and resumed with a Range
+# request, as Gurl does after the daemon is killed.
+#
+# The only conditional request the client makes is that resume: Gurl sends
+# the Range and starts over if the ETag or Last-Modified of the response
+# differs from the partial's. installapplications.py never sets Gurl's
+# download_only_if_changed, so the origin gets no If-None-Match or
+# If-Modified-Since requests and no 304s from it, and none are simulated.
+#
+# --clients sets how many bootstraps to simulate, --concurrency how many run
+# at once and --arrival-rate how quickly new ones start (clients per second,
+# exponentially distributed; 0 starts them all at once).
+#
+# --standin serves a directory over HTTP on --port for the duration of the
+# run, so the tool can be pointed at a local copy of the rootdir (generate
+# the json with --base-url http://127.0.0.1:<port>).
+#
+# At the end request rate, bytes served, latency percentiles and errors are
+# printed.
+
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+import json
+import optparse
+import os
+import random
+import sys
+import threading
+import time
+import urllib2
+# Shared modules live alongside installapplications.py in the payload.
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'payload', 'Library',
+    'Application Support', 'installapplications'))
+# PEP8 can really be annoying at times.
+import manifest  # noqa
+
+CHUNK = 2**16
+TIMEOUT = 60
+# download_if_needed() makes one attempt and then three retries.
+RETRIES = 3
+RETRY_SLEEP = 0.5
+
+
+def percentile(values, fraction):
+    '''Nearest rank percentile of an unsorted list'''
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+
+class Stats(object):
+    '''Results of every request made by every simulated client'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []
+        self.clients = []
+        self.errors = {}
+        self.start = None
+        self.end = None
+
+    def request(self, kind, status, firstbyte, total, received, error=None):
+        with self.lock:
+            self.requests.append((kind, status, firstbyte, total, received))
+        if error:
+            self.error(error)
+
+    def error(self, error):
+        with self.lock:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def client(self, seconds, ok):
+        with self.lock:
+            self.clients.append((seconds, ok))
+
+    def report(self):
+        elapsed = (self.end or time.time()) - self.start
+        received = sum(request[4] for request in self.requests)
+        failed = sum(self.errors.values())
+        print 'Duration: %.1f sec' % elapsed
+        print 'Clients: %d started, %d completed, %d failed' % (
+            len(self.clients), len([c for c in self.clients if c[1]]),
+            len([c for c in self.clients if not c[1]]))
+        print 'Requests: %d (%.1f/sec)' % (
+            len(self.requests), len(self.requests) / elapsed if elapsed else 0)
+        print 'Bytes served: %d (%.1f MB/sec)' % (
+            received, received / elapsed / 2**20 if elapsed else 0)
+        print 'Errors: %d' % failed
+        for error in sorted(self.errors):
+            print '    %s: %d' % (error, self.errors[error])
+        for kind in ('json', 'item', 'resume'):
+            requests = [r for r in self.requests if r[0] == kind]
+            if not requests:
+                continue
+            firstbytes = [r[2] for r in requests if r[2] is not None]
+            totals = [r[3] for r in requests]
+            print '%s requests: %d' % (kind, len(requests))
+            for label, values in (('first byte', firstbytes),
+                                  ('total', totals)):
+                print '    %s: p50 %.3f  p90 %.3f  p99 %.3f  max %.3f' % (
+                    label, percentile(values, 0.5), percentile(values, 0.9),
+                    percentile(values, 0.99), max(values or [0]))
+        bootstraps = [c[0] for c in self.clients if c[1]]
+        if bootstraps:
+            print 'Bootstrap time: p50 %.1f  p90 %.1f  p99 %.1f sec' % (
+                percentile(bootstraps, 0.5), percentile(bootstraps, 0.9),
+                percentile(bootstraps, 0.99))
+
+
+class Client(object):
+    '''One simulated InstallApplications run'''
+
+    def __init__(self, opts, plan, stats):
+        self.opts = opts
+        self.plan = plan
+        self.stats = stats
+
+    def get(self, kind, url, offset=0, validator=None, stopafter=None):
+        '''Make one request, reading and discarding the body. Returns
+        (received, (etag, last-modified), complete) where complete is False
+        if the transfer failed or was deliberately stopped.'''
+        request = urllib2.Request(url)
+        if self.opts.headers:
+            request.add_header('Authorization', self.opts.headers)
+        if offset:
+            request.add_header('Range', 'bytes=%d-' % offset)
+        start = time.time()
+        firstbyte = None
+        received = 0
+        status = None
+        try:
+            response = urllib2.urlopen(request, timeout=TIMEOUT)
+            status = response.getcode()
+            info = response.info()
+            etag = (info.get('ETag'), info.get('Last-Modified'))
+            if offset and (status != 206 or etag != validator):
+                # Gurl starts over when the server won't resume or the file
+                # changed underneath it.
+                offset = 0
+            while True:
+                chunk = response.read(CHUNK)
+                if firstbyte is None:
+                    firstbyte = time.time() - start
+                if not chunk:
+                    break
+                received += len(chunk)
+                if stopafter is not None and received >= stopafter:
+                    response.close()
+                    self.stats.request(kind, status, firstbyte,
+                                       time.time() - start, received)
+                    return offset + received, etag, False
+            response.close()
+        except urllib2.HTTPError as err:
+            self.stats.request(kind, err.code, firstbyte,
+                               time.time() - start, received,
+                               'HTTP %d' % err.code)
+            return offset, None, False
+        except Exception as err:  # noqa
+            self.stats.request(kind, status, firstbyte, time.time() - start,
+                               received, type(err).__name__)
+            return offset, None, False
+        self.stats.request(kind, status, firstbyte, time.time() - start,
+                           received)
+        return offset + received, etag, True
+
+    def download(self, item):
+        '''Fetch one item like download_if_needed()/fetch() would'''
+        for attempt in range(RETRIES + 1):
+            for url in item.urls:
+                stopafter = None
+                if item.size and random.random() < self.opts.interrupt:
+                    stopafter = random.randint(1, max(item.size - 1, 1))
+                length, validator, complete = self.get('item', url,
+                                                       stopafter=stopafter)
+                if not complete and validator and any(validator) and \
+                        stopafter is not None:
+                    # Killed part way through; resume from the partial.
+                    length, validator, complete = self.get(
+                        'resume', url, length, validator)
+                if complete:
+                    if item.size and length != item.size:
+                        self.stats.error('size mismatch')
+                        break
+                    return True
+            time.sleep(RETRY_SLEEP)
+        return False
+
+    def run(self):
+        start = time.time()
+        ok = False
+        try:
+            length, validator, complete = self.get('json', self.opts.jsonurl)
+            if not complete:
+                return
+            ok = all(self.download(item) for item in self.plan.items()
+                     if item.urls)
+        finally:
+            self.stats.client(time.time() - start, ok)
+
+
+class StandinHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Interrupted downloads close the connection mid-transfer.
+        pass
+
+
+def standin(rootdir, port):
+    '''Serve rootdir on port in the background'''
+    os.chdir(rootdir)
+    server = StandinServer(('', port), StandinHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print 'Serving %s on port %d' % (rootdir, port)
+    return server
+
+
+def loadplan(jsonurl, headers):
+    request = urllib2.Request(jsonurl)
+    if headers:
+        request.add_header('Authorization', headers)
+    iajson = json.loads(urllib2.urlopen(request, timeout=TIMEOUT).read())
+    plan, errors = manifest.loadplan(iajson)
+    for error in errors:
+        print 'Invalid item: %s' % error
+    return plan, errors
+
+
+def main():
+    usage = '%prog --jsonurl <url> [options]'
+    op = optparse.OptionParser(usage=usage)
+    op.add_option('--jsonurl', help=('Required: URL to the json file'))
+    op.add_option('--headers', default=None,
+                  help=('Optional: Authorization header value'))
+    op.add_option('--clients', default=10, type='int',
+                  help=('Optional: Bootstraps to simulate. Default 10'))
+    op.add_option('--concurrency', default=None, type='int',
+                  help=('Optional: Clients running at once. Default all'))
+    op.add_option('--arrival-rate', default=0, type='float',
+                  help=('Optional: New clients per second. Default 0 \
+                  (start all at once)'))
+    op.add_option('--interrupt', default=0, type='float',
+                  help=('Optional: Fraction of downloads to interrupt and '
+                        'resume with a Range request, starting over if the '
+                        'ETag or Last-Modified changed as Gurl does. The '
+                        'client makes no other conditional requests. '
+                        'Default 0'))
+    op.add_option('--standin', default=None,
+                  help=('Optional: Serve this directory locally during the \
+                  run'))
+    op.add_option('--port', default=8000, type='int',
+                  help=('Optional: Port for --standin. Default 8000'))
+    opts, args = op.parse_args()
+
+    if not opts.jsonurl:
+        op.print_help()
+        sys.exit(1)
+
+    if opts.standin:
+        standin(os.path.abspath(opts.standin), opts.port)
+
+    # Parse the json once up front so a broken one fails fast; every client
+    # still downloads it for itself.
+    plan, errors = loadplan(opts.jsonurl, opts.headers)
+    if errors:
+        print 'InstallApplications would refuse to run this json, exiting!'
+        sys.exit(1)
+    print 'Simulating %d clients against %s (%d items, %d bytes each)' % (
+        opts.clients, opts.jsonurl, len(plan),
+        sum(item.size or 0 for item in plan.items()))
+
+    stats = Stats()
+    slots = threading.BoundedSemaphore(opts.concurrency or opts.clients)
+
+    def runclient():
+        try:
+            Client(opts, plan, stats).run()
+        finally:
+            slots.release()
+
+    threads = []
+    stats.start = time.time()
+    try:
+        for number in range(opts.clients):
+            slots.acquire()
+            thread = threading.Thread(target=runclient)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+            if opts.arrival_rate > 0:
+                time.sleep(random.expovariate(opts.arrival_rate))
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+    except KeyboardInterrupt:
+        print 'Interrupted, reporting partial results'
+    stats.end = time.time()
+    stats.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+blobcache.py
+
+Hash addressed store of verified payloads, kept outside the iapath so it
+survives the end of a run. Blobs live at <root>/<first two hash chars>/<hash>
+and are only ever added from files that already matched their hash.
+
+Blobs are hard linked in from verified files to save space, but always
+copied out: what they are copied to is a partial download that may be
+resumed or rewritten, and that must not write through to the cache.
+"""
+
+import os
+import shutil
+
+
+class BlobCache(object):
+    '''A directory of payloads named by their hash'''
+
+    def __init__(self, root):
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def path(self, filehash):
+        return os.path.join(self.root, filehash[:2], filehash)
+
+    def has(self, filehash):
+        return os.path.isfile(self.path(filehash))
+
+    def add(self, filepath, filehash, link=True):
+        '''Store a verified file. Hard links are used where possible so the
+        cache costs no extra space while the payload is still staged; pass
+        link=False for files whose permissions others may write through.'''
+        destination = self.path(filehash)
+        if os.path.isfile(destination):
+            return destination
+        directory = os.path.dirname(destination)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmppath = '%s.%d.tmp' % (destination, os.getpid())
+        if link:
+            try:
+                os.link(filepath, tmppath)
+            except OSError:
+                link = False
+        if not link:
+            shutil.copyfile(filepath, tmppath)
+        os.rename(tmppath, destination)
+        return destination
+
+    def copyto(self, filehash, destination):
+        '''Copy a cached blob to destination. Returns True on success.'''
+        source = self.path(filehash)
+        if not os.path.isfile(source):
+            return False
+        shutil.copyfile(source, destination)
+        return True
+
+    def remove(self, filehash):
+        try:
+            os.remove(self.path(filehash))
+        except OSError:
+            pass
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+concurrency.py
+
+Adaptive number of parallel downloads. The download layer reports every
+chunk received, the time to the first byte of each download and whether it
+succeeded. Every INTERVAL seconds the controller looks at what came in:
+
+  - too many failures, or first bytes taking much longer than the best seen,
+    halve the limit (multiplicative decrease)
+  - otherwise, if throughput beat the best interval so far, allow one more
+    download (additive increase)
+  - otherwise hold
+
+The best throughput decays a little every interval so the controller keeps
+probing for more as conditions change. Limits come from settings
+['concurrency'] ({"min": 1, "max": 8}) or the command line.
+"""
+
+import threading
+import time
+
+INTERVAL = 5
+ERROR_RATE = 0.2
+LATENCY_FACTOR = 2.0
+DECREASE = 0.5
+# Throughput has to beat the best by this much to count as a gain.
+GAIN = 0.05
+DECAY = 0.95
+
+
+def validate(concurrency):
+    '''Return a list of problems with a raw settings['concurrency'] value'''
+    if not isinstance(concurrency, dict):
+        return ['settings: concurrency must be an object']
+    errors = []
+    for key in ('min', 'max'):
+        value = concurrency.get(key, 1)
+        if not isinstance(value, (int, long)) or isinstance(value, bool) \
+                or value < 1:
+            errors.append('settings: concurrency %s must be a positive '
+                          'integer' % key)
+    if not errors and concurrency.get('min', 1) > \
+            concurrency.get('max', concurrency.get('min', 1)):
+        errors.append('settings: concurrency min is larger than max')
+    return errors
+
+
+class Controller(object):
+    '''AIMD controller for the number of downloads in flight'''
+
+    def __init__(self, minimum, maximum, start=None, log=None,
+                 clock=time.time):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        if start is None:
+            start = self.minimum
+        self.current = min(max(start, self.minimum), self.maximum)
+        self.log = log or (lambda text: None)
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.started = clock()
+        self.bytes = 0
+        self.finished = 0
+        self.failed = 0
+        self.latencies = []
+        self.best = None
+        self.bestlatency = None
+
+    def received(self, nbytes):
+        with self.lock:
+            self.bytes += nbytes
+
+    def firstbyte(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def record(self, ok):
+        '''Called when a download finishes'''
+        with self.lock:
+            self.finished += 1
+            if not ok:
+                self.failed += 1
+
+    def limit(self):
+        '''Downloads allowed in flight right now'''
+        with self.lock:
+            if self.clock() - self.started >= INTERVAL:
+                self.decide()
+            return self.current
+
+    def decide(self):
+        '''Caller holds the lock'''
+        now = self.clock()
+        throughput = self.bytes / max(now - self.started, 0.001)
+        latency = None
+        if self.latencies:
+            latency = sorted(self.latencies)[len(self.latencies) // 2]
+        failed, finished = self.failed, self.finished
+        self.started = now
+        self.bytes = self.finished = self.failed = 0
+        self.latencies = []
+        if not throughput and not finished:
+            # Nothing was downloading; nothing to learn.
+            return
+        reason = None
+        if finished and float(failed) / finished >= ERROR_RATE:
+            reason = '%d of %d downloads failed' % (failed, finished)
+        elif latency is not None and self.bestlatency and \
+                latency > self.bestlatency * LATENCY_FACTOR:
+            reason = 'first byte took %d ms' % (latency * 1000)
+        if latency is not None and (self.bestlatency is None or
+                                    latency < self.bestlatency):
+            self.bestlatency = latency
+        if reason:
+            self.set(int(self.current * DECREASE), reason)
+            # Start measuring gains again from the new level.
+            self.best = None
+            return
+        if self.best is None or throughput > self.best * (1 + GAIN):
+            if self.best is not None:
+                self.set(self.current + 1, '%.1f MB/s' % (
+                    throughput / 2**20))
+            self.best = throughput
+        else:
+            self.best *= DECAY
+
+    def set(self, value, reason):
+        value = min(max(value, self.minimum), self.maximum)
+        if value != self.current:
+            self.log('Download concurrency %d -> %d (%s)' % (
+                self.current, value, reason))
+            self.current = value
+
+
+def getcontroller(settings, minimum=None, maximum=None, start=None,
+                  log=None):
+    '''Return a Controller for settings['concurrency'], with minimum and
+    maximum overriding the json, or None if concurrency isn't adaptive'''
+    limits = settings.get('concurrency')
+    if limits is None and minimum is None and maximum is None:
+        return None
+    limits = limits or {}
+    if minimum is None:
+        minimum = limits.get('min', 1)
+    if maximum is None:
+        maximum = limits.get('max', max(minimum, start or 1))
+    return Controller(minimum, maximum, start, log)
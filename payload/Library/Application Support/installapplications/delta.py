@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+delta.py
+
+Binary deltas between payload versions, in the bsdiff 4 format. The bsdiff4
+module is used when it is importable, otherwise the bsdiff and bspatch tools
+that ship with macOS. A patch is only a way to rebuild a file; whatever it
+produces still has to match the item's hash.
+"""
+
+import os
+import subprocess
+from distutils.spawn import find_executable
+
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+
+BSDIFF = '/usr/bin/bsdiff'
+BSPATCH = '/usr/bin/bspatch'
+SUFFIX = '.bsdiff'
+
+
+class DeltaError(Exception):
+    pass
+
+
+def tool(name, default):
+    '''Path of a command line tool, or None. launchd gives us a short PATH,
+    so the macOS location is tried as well.'''
+    found = find_executable(name)
+    if found:
+        return found
+    return default if os.path.isfile(default) else None
+
+
+def available():
+    '''True if patches can be applied here'''
+    return bsdiff4 is not None or tool('bspatch', BSPATCH) is not None
+
+
+def run(command, *args):
+    if command is None:
+        raise DeltaError('needs the bsdiff4 module or the bsdiff tools')
+    proc = subprocess.Popen([command] + list(args), stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    output, err = proc.communicate()
+    if proc.returncode:
+        raise DeltaError(err.strip() or '%s exited with %d' % (
+            command, proc.returncode))
+
+
+def diff(old, new, patch):
+    '''Write the patch that turns old into new'''
+    if bsdiff4 is not None:
+        bsdiff4.file_diff(old, new, patch)
+    else:
+        run(tool('bsdiff', BSDIFF), old, new, patch)
+
+
+def apply(old, new, patch):
+    '''Rebuild new from old and patch'''
+    if bsdiff4 is not None:
+        try:
+            bsdiff4.file_patch(old, new, patch)
+        except (ValueError, IOError) as err:
+            raise DeltaError(str(err))
+    else:
+        run(tool('bspatch', BSPATCH), old, new, patch)
+
+
+def deltaname(oldhash, newhash):
+    return '%s-%s%s' % (oldhash[:16], newhash[:16], SUFFIX)
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+diskspace.py
+
+Disk footprint of a run. Most payloads are deleted once they have been
+installed, so the space needed is not the sum of every payload but the
+largest point along the way: everything installed so far, plus the payloads
+that stay on disk, plus the payload being installed, plus whatever the
+prefetcher has staged ahead of it.
+"""
+
+import os
+
+
+def freespace(path):
+    '''Bytes available to us on the volume holding path'''
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def peakfootprint(items, staged=(), budget=0, kept=()):
+    '''Peak bytes a run needs on disk. items are the items still to run in
+    order; staged are those whose payload is already on disk and kept those
+    whose payload is not freed once they have run. Packages are assumed to
+    take their payload size again once installed; scripts take nothing.
+    budget is the most the prefetcher may stage ahead.'''
+    staged = set(id(item) for item in staged)
+    kept = set(id(item) for item in kept)
+    # Everything already on disk stays until its own turn comes.
+    ondisk = sum(item.size or 0 for item in items if id(item) in staged)
+    installed = 0
+    peak = ondisk
+    for item in items:
+        size = item.size or 0
+        if id(item) not in staged:
+            ondisk += size
+        peak = max(peak, installed + ondisk + budget)
+        if item.type == 'package':
+            installed += size
+        if id(item) not in kept:
+            ondisk -= size
+    return peak
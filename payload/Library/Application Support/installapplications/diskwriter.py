@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+diskwriter.py
+
+Write path for downloads. Network callbacks hand over many small chunks;
+writing each one straight to disk fights with whatever installer is running
+at the same time. DiskWriter preallocates the file to its expected length,
+collects chunks in a bounded buffer and writes them out in large aligned
+blocks. It also times the writes so disk throughput can be reported apart
+from network throughput.
+
+Any downloader can use it: open, write() chunks, close().
+"""
+
+import fcntl
+import os
+import struct
+import sys
+import time
+
+# Flush once this much data is buffered.
+BUFFER_SIZE = 4 * 2**20
+# Writes are issued in multiples of this many bytes.
+ALIGNMENT = 2**20
+
+# darwin fcntl F_PREALLOCATE and fstore_t
+F_PREALLOCATE = 42
+F_ALLOCATECONTIG = 0x2
+F_ALLOCATEALL = 0x4
+F_PEOFPOSMODE = 3
+FSTORE_FORMAT = '=Iiqqq'
+
+
+def preallocate(fileref, length):
+    '''Reserve length bytes past the end of fileref without changing its
+    size. Returns True if the space was reserved.'''
+    if length <= 0 or sys.platform != 'darwin':
+        return False
+    fd = fileref.fileno()
+    for flags in (F_ALLOCATECONTIG | F_ALLOCATEALL, F_ALLOCATEALL):
+        fstore = struct.pack(FSTORE_FORMAT, flags, F_PEOFPOSMODE, 0,
+                             length, 0)
+        try:
+            fcntl.fcntl(fd, F_PREALLOCATE, fstore)
+            return True
+        except (IOError, OSError):
+            # Contiguous space isn't available, try fragmented.
+            continue
+    return False
+
+
+class DiskWriter(object):
+    '''A file like object that coalesces small writes'''
+
+    def __init__(self, path, mode='wb', expected=-1,
+                 buffersize=BUFFER_SIZE, alignment=ALIGNMENT):
+        self.path = path
+        self.fileref = open(path, mode)
+        self.buffersize = buffersize
+        self.alignment = alignment
+        self.chunks = []
+        self.buffered = 0
+        self.written = 0
+        self.writetime = 0.0
+        self.closed = False
+        if expected > 0:
+            self.fileref.seek(0, os.SEEK_END)
+            self.preallocated = preallocate(
+                self.fileref, expected - self.fileref.tell())
+        else:
+            self.preallocated = False
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.buffersize:
+            self.flush(aligned=True)
+
+    def flush(self, aligned=False):
+        '''Write out buffered data. When aligned, only whole alignment
+        blocks are written and the remainder stays buffered.'''
+        if not self.buffered:
+            return
+        data = ''.join(self.chunks)
+        if aligned:
+            length = len(data) - (len(data) % self.alignment)
+        else:
+            length = len(data)
+        if not length:
+            return
+        start = time.time()
+        self.fileref.write(buffer(data, 0, length))
+        if not aligned:
+            self.fileref.flush()
+        self.writetime += time.time() - start
+        self.written += length
+        rest = data[length:]
+        self.chunks = [rest] if rest else []
+        self.buffered = len(rest)
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self.fileref.close()
+        self.closed = True
+
+    def throughput(self):
+        '''Bytes per second spent actually writing to disk'''
+        if not self.writetime:
+            return None
+        return self.written / self.writetime
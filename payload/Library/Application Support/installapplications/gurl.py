@@ -23,9 +23,12 @@ curl replacement using NSURLConnection and friends
 """
 
 import os
+import time
 import xattr
 from urlparse import urlparse
 
+from diskwriter import DiskWriter
+
 # builtin super doesn't work with Cocoa classes in recent PyObjC releases.
 from objc import super
 
@@ -181,6 +184,9 @@ class Gurl(NSObject):
         self.ignore_system_proxy = options.get('ignore_system_proxy', False)
         self.destination_path = options.get('file')
         self.can_resume = options.get('can_resume', False)
+        # Resume a partial file even if it came from a different server
+        # (mirrors); the caller must verify the finished file.
+        self.resume_any_source = options.get('resume_any_source', False)
         self.url = options.get('url')
         self.additional_headers = options.get('additional_headers', {})
         self.username = options.get('username')
@@ -189,6 +195,9 @@ class Gurl(NSObject):
             'download_only_if_changed', False)
         self.cache_data = options.get('cache_data')
         self.connection_timeout = options.get('connection_timeout', 60)
+        # Called with the size of every chunk received; blocking in it
+        # slows the transfer down (see ratelimit.py).
+        self.throttle = options.get('throttle')
         if NSURLSESSION_AVAILABLE:
             self.minimum_tls_protocol = options.get(
                 'minimum_tls_protocol', kTLSProtocol1)
@@ -207,6 +216,8 @@ class Gurl(NSObject):
         self.bytesReceived = 0
         self.expectedLength = -1
         self.percentComplete = 0
+        self.startTime = None
+        self.finishTime = None
         self.connection = None
         self.session = None
         self.task = None
@@ -218,6 +229,7 @@ class Gurl(NSObject):
             self.log('No output file specified.')
             self.done = True
             return
+        self.startTime = time.time()
         url = NSURL.URLWithString_(self.url)
         request = (
             NSMutableURLRequest.requestWithURL_cachePolicy_timeoutInterval_(
@@ -230,7 +242,8 @@ class Gurl(NSObject):
         if os.path.isfile(self.destination_path):
             stored_data = self.get_stored_headers()
             if (self.can_resume and 'expected-length' in stored_data and
-                    ('last-modified' in stored_data or 'etag' in stored_data)):
+                    ('last-modified' in stored_data or 'etag' in stored_data
+                     or self.resume_any_source)):
                 # we have a partial file and we're allowed to resume
                 self.resume = True
                 local_filesize = os.path.getsize(self.destination_path)
@@ -269,7 +282,7 @@ class Gurl(NSObject):
 
     def cancel(self):
         '''Cancel the connection'''
-        if self.connection:
+        if self.connection or self.session:
             if NSURLSESSION_AVAILABLE:
                 self.session.invalidateAndCancel()
             else:
@@ -286,6 +299,13 @@ class Gurl(NSObject):
             NSDate.dateWithTimeIntervalSinceNow_(.1))
         return self.done
 
+    def networkThroughput(self):
+        '''Bytes per second received over the network'''
+        end = self.finishTime or time.time()
+        if not self.startTime or end <= self.startTime:
+            return None
+        return self.bytesReceived / (end - self.startTime)
+
     def get_stored_headers(self):
         '''Returns any stored headers for self.destination_path'''
         # try to read stored headers
@@ -360,9 +380,13 @@ class Gurl(NSObject):
         # pylint: disable=W0613
         if self.destination and self.destination_path:
             self.destination.close()
-            self.removeExpectedSizeFromStoredHeaders()
+            # Keep the expected size of an interrupted transfer so it can
+            # be resumed.
+            if not error:
+                self.removeExpectedSizeFromStoredHeaders()
         if error:
             self.recordError_(error)
+        self.finishTime = time.time()
         self.done = True
 
     def connection_didFailWithError_(self, connection, error):
@@ -371,6 +395,7 @@ class Gurl(NSObject):
         # we don't actually use the connection argument, so
         # pylint: disable=W0613
         self.recordError_(error)
+        self.finishTime = time.time()
         self.done = True
         if self.destination and self.destination_path:
             self.destination.close()
@@ -382,6 +407,7 @@ class Gurl(NSObject):
         # we don't actually use the connection argument, so
         # pylint: disable=W0613
 
+        self.finishTime = time.time()
         self.done = True
         if self.destination and self.destination_path:
             self.destination.close()
@@ -415,7 +441,8 @@ class Gurl(NSObject):
             if self.status == 206 and self.resume:
                 # 206 is Partial Content response
                 stored_data = self.get_stored_headers()
-                if (not stored_data or
+                if not self.resume_any_source and (
+                        not stored_data or
                         stored_data.get('etag') != download_data.get('etag') or
                         stored_data.get('last-modified') != download_data.get(
                             'last-modified')):
@@ -434,7 +461,6 @@ class Gurl(NSObject):
                     # restart and attempt to download the entire file
                     self.log(
                         'Restarting download of %s' % self.destination_path)
-                    os.unlink(self.destination_path)
                     self.start()
                     return
                 # try to resume
@@ -444,11 +470,13 @@ class Gurl(NSObject):
                 self.bytesReceived = local_filesize
                 self.expectedLength += local_filesize
                 # open file for append
-                self.destination = open(self.destination_path, 'a')
+                self.destination = DiskWriter(
+                    self.destination_path, 'ab', self.expectedLength)
 
             elif str(self.status).startswith('2'):
                 # not resuming, just open the file for writing
-                self.destination = open(self.destination_path, 'w')
+                self.destination = DiskWriter(
+                    self.destination_path, 'wb', self.expectedLength)
                 # store some headers with the file for use if we need to resume
                 # the downloadand for future checking if the file on the server
                 # has changed
@@ -673,6 +701,8 @@ class Gurl(NSObject):
 
     def handleReceivedData_(self, data):
         '''Handle received data'''
+        if self.throttle:
+            self.throttle(len(data))
         if self.destination:
             self.destination.write(str(data))
         else:
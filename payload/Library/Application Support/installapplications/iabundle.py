@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+iabundle.py
+
+Single file bundle format for an entire InstallApplications bootstrap.
+
+A bundle is laid out as:
+
+    IABUNDLE1\\n                magic (10 bytes)
+    <index length>              8 byte big-endian unsigned integer
+    <index>                     json: {'version': 1,
+                                       'bootstrap': {...bootstrap.json...},
+                                       'items': {hash: {'offset': int,
+                                                        'length': int,
+                                                        'name': str}}}
+    <payloads>                  every payload, back to back
+
+Offsets in the index are absolute from the start of the bundle, so an item
+can be copied straight out of an mmap of the file.
+"""
+
+import json
+import mmap
+import os
+import struct
+
+BUNDLE_MAGIC = 'IABUNDLE1\n'
+BUNDLE_VERSION = 1
+HEADER_FORMAT = '>Q'
+HEADER_SIZE = len(BUNDLE_MAGIC) + struct.calcsize(HEADER_FORMAT)
+COPY_CHUNK = 8 * 2**20
+
+
+class BundleError(Exception):
+    '''Raised when a bundle is malformed or an item is missing'''
+    pass
+
+
+def writebundle(bundlepath, bootstrap, payloads):
+    '''Write a bundle to bundlepath. payloads is a list of
+    (hash, name, sourcepath) tuples; duplicate hashes are stored once.'''
+    items = {}
+    order = []
+    offset = 0
+    for filehash, name, sourcepath in payloads:
+        if filehash in items:
+            continue
+        length = os.path.getsize(sourcepath)
+        items[filehash] = {'offset': offset, 'length': length, 'name': name}
+        order.append((filehash, sourcepath))
+        offset += length
+
+    # The index has to know the absolute offsets, which depend on the size
+    # of the index itself. Serialize once to measure, then shift.
+    index = {'version': BUNDLE_VERSION, 'bootstrap': bootstrap,
+             'items': items}
+    indexdata = json.dumps(index, sort_keys=True)
+    while True:
+        base = HEADER_SIZE + len(indexdata)
+        shifted = {}
+        for filehash, entry in items.items():
+            shifted[filehash] = dict(entry, offset=entry['offset'] + base)
+        index['items'] = shifted
+        newdata = json.dumps(index, sort_keys=True)
+        if len(newdata) == len(indexdata):
+            indexdata = newdata
+            break
+        indexdata = newdata
+
+    with open(bundlepath, 'wb') as bundlefile:
+        bundlefile.write(BUNDLE_MAGIC)
+        bundlefile.write(struct.pack(HEADER_FORMAT, len(indexdata)))
+        bundlefile.write(indexdata)
+        for filehash, sourcepath in order:
+            with open(sourcepath, 'rb') as source:
+                while 1:
+                    chunk = source.read(COPY_CHUNK)
+                    if not chunk:
+                        break
+                    bundlefile.write(chunk)
+    return len(order)
+
+
+class Bundle(object):
+    '''Read only view of a bundle on local disk'''
+
+    def __init__(self, path):
+        self.path = path
+        self.fileref = open(path, 'rb')
+        magic = self.fileref.read(len(BUNDLE_MAGIC))
+        if magic != BUNDLE_MAGIC:
+            self.fileref.close()
+            raise BundleError('Not an InstallApplications bundle: %s' % path)
+        (indexlength,) = struct.unpack(
+            HEADER_FORMAT, self.fileref.read(struct.calcsize(HEADER_FORMAT)))
+        try:
+            index = json.loads(self.fileref.read(indexlength))
+        except ValueError as err:
+            self.fileref.close()
+            raise BundleError('Invalid bundle index in %s: %s' % (path, err))
+        if index.get('version') != BUNDLE_VERSION:
+            self.fileref.close()
+            raise BundleError('Unsupported bundle version %s in %s' % (
+                index.get('version'), path))
+        self.manifest = index['bootstrap']
+        self.items = index['items']
+        self.map = mmap.mmap(self.fileref.fileno(), 0,
+                             access=mmap.ACCESS_READ)
+
+    def has(self, filehash):
+        return filehash in self.items
+
+    def extract(self, filehash, destination):
+        '''Copy a single item out of the bundle by offset. The mmap is
+        handed to write() through buffer objects so no intermediate copies
+        of the payload are made.'''
+        try:
+            entry = self.items[filehash]
+        except KeyError:
+            raise BundleError('Hash %s not found in bundle' % filehash)
+        offset = entry['offset']
+        end = offset + entry['length']
+        if end > len(self.map):
+            raise BundleError('Bundle is truncated: %s' % self.path)
+        with open(destination, 'wb') as outfile:
+            while offset < end:
+                length = min(COPY_CHUNK, end - offset)
+                outfile.write(buffer(self.map, offset, length))
+                offset += length
+        return entry['length']
+
+    def close(self):
+        self.map.close()
+        self.fileref.close()
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+iahash.py
+
+File hashing shared by installapplications.py and generatejson.py. Files are
+mapped into memory and fed to hashlib in large slices, which hashlib hashes
+without holding the GIL, so several files can be hashed at once from a
+thread pool. Any number of digests are computed in a single read, and any
+algorithm hashlib (or the optional pyblake2 module) provides can be used.
+"""
+
+import hashlib
+import mmap
+import multiprocessing
+import os
+from multiprocessing.pool import ThreadPool
+
+try:
+    import pyblake2
+except ImportError:
+    pyblake2 = None
+
+DEFAULT_ALGORITHM = 'sha256'
+# Bytes handed to hashlib per update.
+BLOCK_SIZE = 8 * 2**20
+
+
+def newhash(algorithm):
+    '''Return a new hash object for algorithm, or raise ValueError'''
+    if pyblake2 is not None and algorithm in ('blake2b', 'blake2s'):
+        return getattr(pyblake2, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def available(algorithm):
+    try:
+        newhash(algorithm)
+    except (ValueError, TypeError):
+        return False
+    return True
+
+
+class MultiHash(object):
+    '''Computes several digests of the same data'''
+
+    def __init__(self, algorithms=(DEFAULT_ALGORITHM,)):
+        self.hashes = dict((algorithm, newhash(algorithm))
+                           for algorithm in algorithms)
+
+    def update(self, data):
+        for hash_function in self.hashes.values():
+            hash_function.update(data)
+
+    def hexdigests(self):
+        return dict((algorithm, hash_function.hexdigest())
+                    for algorithm, hash_function in self.hashes.items())
+
+
+def hashfile(filename, algorithms=(DEFAULT_ALGORITHM,)):
+    '''Return a dictionary of algorithm to hex digest for filename'''
+    multihash = MultiHash(algorithms)
+    with open(filename, 'rb') as fileref:
+        size = os.fstat(fileref.fileno()).st_size
+        if size:
+            mapped = mmap.mmap(fileref.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, size, BLOCK_SIZE):
+                    multihash.update(buffer(mapped, offset, BLOCK_SIZE))
+            finally:
+                mapped.close()
+    return multihash.hexdigests()
+
+
+def gethash(filename, algorithm=DEFAULT_ALGORITHM):
+    if not os.path.isfile(filename):
+        return 'NOT A FILE'
+    return hashfile(filename, (algorithm,))[algorithm]
+
+
+def hashfiles(filenames, algorithms=(DEFAULT_ALGORITHM,), workers=None):
+    '''Hash many files concurrently. Returns a dictionary of filename to
+    the hashfile() result, or None for files that could not be read.'''
+    def hashone(filename):
+        try:
+            return hashfile(filename, algorithms)
+        except (IOError, OSError):
+            return None
+
+    filenames = list(filenames)
+    if len(filenames) < 2:
+        return dict((filename, hashone(filename)) for filename in filenames)
+    pool = ThreadPool(min(workers or multiprocessing.cpu_count(),
+                          len(filenames)))
+    try:
+        return dict(zip(filenames, pool.map(hashone, filenames)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def matches(digests, expected):
+    '''True if digests agrees with every digest in expected'''
+    if not digests or not expected:
+        return False
+    return all(digests.get(algorithm) == value
+               for algorithm, value in expected.items())
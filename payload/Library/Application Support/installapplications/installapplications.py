@@ -25,14 +25,9 @@
 # https://github.com/munki/munki
 # Notice a pattern?
 
-from distutils.version import LooseVersion
-from Foundation import NSLog
-from SystemConfiguration import SCDynamicStoreCopyConsoleUser
-import hashlib
 import json
 import optparse
 import os
-import plistlib
 import re
 import shutil
 import subprocess
@@ -40,25 +35,154 @@ import sys
 import time
 sys.path.append('/usr/local/installapplications')
 # PEP8 can really be annoying at times.
-import gurl  # noqa
+import profiler  # noqa
+import providers  # noqa
+import runtrace  # noqa
+# The rest of the engine is imported by loadengine(), once we know this
+# isn't a --userscript run.
 
 
+# macOS touchpoints. The default provider imports PyObjC lazily; --provider
+# stub runs without it.
+g_provider = providers.getprovider()
 g_dry_run = False
+g_bundle = None
+g_prefetcher = None
+g_progress = None
+g_memo = None
+g_mirrors = None
+g_cache = None
+g_peer = None
+g_metrics = None
+g_limiter = None
+g_controller = None
+g_profiler = profiler.NullProfiler()
+g_trace = runtrace.NullRecorder()
+g_started = time.time()
+
+# Included manifest fragments fetched at once.
+FRAGMENT_WORKERS = 8
+# Seed bundle looked for in the iapath when --seed isn't given.
+SEED_NAME = 'seed.iabundle'
+
+# Name, type and help text of every metric written with --metrics-path.
+METRICS = [
+    ('items_total', 'counter', 'Items by stage, type and result'),
+    ('bytes_total', 'counter', 'Payload bytes by source'),
+    ('download_seconds', 'histogram', 'Time spent downloading each item'),
+    ('install_seconds', 'histogram', 'Time spent installing or running '
+     'each item'),
+    ('retries_total', 'counter', 'Download retries by reason'),
+    ('console_user_wait_seconds_total', 'counter', 'Time spent waiting '
+     'for a user to log in'),
+    ('throttled_seconds_total', 'counter', 'Time downloads spent held '
+     'back by the bandwidth limit'),
+    ('download_concurrency', 'gauge', 'Parallel downloads the adaptive '
+     'controller allows'),
+    ('stage_completed_timestamp_seconds', 'gauge', 'When each stage '
+     'finished'),
+    ('run_success', 'gauge', '1 if the last run finished, 0 if it failed'),
+    ('run_duration_seconds', 'gauge', 'Length of the last run'),
+    ('last_run_timestamp_seconds', 'gauge', 'When the last run ended'),
+]
 
 
 def deplog(text):
-    depnotify = '/private/var/tmp/depnotify.log'
+    depnotify = g_provider.depnotifylog
     with open(depnotify, 'a+') as log:
         log.write(text + '\n')
 
 
+def loadengine():
+    '''Import everything a bootstrap run needs. A --userscript run stops
+    before this, so it loads no more than logging and running a script
+    take.'''
+    global ThreadPool, blobcache, concurrency, delta, diskspace, iabundle, \
+        iahash, manifest, metrics, mirrors, peer, predicates, prefetch, \
+        progress, ratelimit, seed, verify
+    from multiprocessing.pool import ThreadPool
+    import blobcache
+    import concurrency
+    import delta
+    import diskspace
+    import iabundle
+    import iahash
+    import manifest
+    import metrics
+    import mirrors
+    import peer
+    import predicates
+    import prefetch
+    import progress
+    import ratelimit
+    import seed
+    import verify
+
+
 def iaslog(text):
-    NSLog('[InstallApplications] ' + text)
+    g_provider.log(text)
 
 
 def getconsoleuser():
-    cfuser = SCDynamicStoreCopyConsoleUser(None, None, None)
-    return cfuser
+    return g_provider.consoleuser()
+
+
+def waitforconsoleuser(message):
+    '''Block until a real user is logged in at the console'''
+    start = time.time()
+    while (getconsoleuser()[0] is None
+           or getconsoleuser()[0] == u'loginwindow'
+           or getconsoleuser()[0] == u'_mbsetupuser'):
+        iaslog(message)
+        time.sleep(1)
+    count('console_user_wait_seconds_total', time.time() - start)
+    g_trace.userarrived()
+
+
+def count(name, amount=1, **labels):
+    if g_metrics is not None:
+        g_metrics.inc(name, amount, **labels)
+
+
+def observe(name, seconds, **labels):
+    if g_metrics is not None:
+        g_metrics.observe(name, seconds, **labels)
+
+
+def writemetrics(success=None):
+    '''Write the metrics file, marking the run finished if success is
+    given'''
+    if g_metrics is None:
+        return
+    if g_limiter is not None:
+        g_metrics.set('throttled_seconds_total', g_limiter.waited)
+    if g_controller is not None:
+        g_metrics.set('download_concurrency', g_controller.current)
+    if success is not None:
+        g_metrics.set('run_success', 1 if success else 0)
+        g_metrics.set('run_duration_seconds', time.time() - g_started)
+        g_metrics.set('last_run_timestamp_seconds', time.time())
+    if not g_metrics.write():
+        iaslog('Could not write metrics to %s' % g_metrics.path)
+
+
+def installed(item, start):
+    '''Record how long installing or running item took'''
+    seconds = time.time() - start
+    observe('install_seconds', seconds, type=item.type)
+    g_trace.install(item, seconds)
+
+
+def section(item, phase):
+    '''Profiler section name for one phase of an item'''
+    return '%s-%d-%s-%s' % (item.stage, item.index, item.name, phase)
+
+
+def itemfailed(item):
+    '''Record a failure that ends the run'''
+    count('items_total', stage=item.stage, type=item.type, result='failed')
+    writemetrics(success=False)
+    g_trace.write()
 
 
 def pkgregex(pkgpath):
@@ -70,73 +194,66 @@ def pkgregex(pkgpath):
         return packagepath
 
 
-def installpackage(packagepath):
+def installpackage(packagepath, onprogress=None):
     try:
-        cmd = ['/usr/sbin/installer', '-verboseR', '-pkg', packagepath,
-               '-target', '/']
+        cmd = g_provider.installcommand(packagepath)
         if g_dry_run:
             iaslog('Dry run installing package: %s' % packagepath)
             return 0
-        proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
+        if cmd is None:
+            iaslog('No installer on this platform, skipping: %s' % (
+                   packagepath))
+            return 0
+        proc = subprocess.Popen(cmd, shell=False, bufsize=1,
                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        output, rcode = proc.communicate(), proc.returncode
-        installlog = output[0].split('\n')
-        # Filter all blank lines after the split.
-        for line in filter(None, installlog):
+                                stderr=subprocess.STDOUT)
+        proc.stdin.close()
+        # Read the log as it is written so the installer's own progress
+        # (installer:%NN.NN lines) can be passed on while it runs.
+        for line in iter(proc.stdout.readline, ''):
+            line = line.rstrip('\n')
+            # Filter all blank lines.
+            if not line:
+                continue
+            if onprogress and line.startswith('installer:%'):
+                try:
+                    onprogress(float(line[len('installer:%'):]) / 100.0)
+                except ValueError:
+                    pass
             # Replace any instances of % with a space and any elipsis with
             # a blank line since NSLog can't handle these kinds of characters.
             # Hopefully this is the only bad characters we will ever run into.
             logline = line.replace('%', ' ').replace('\xe2\x80\xa6', '')
             iaslog(logline)
+        rcode = proc.wait()
         return rcode
     except Exception:
         pass
 
 
 def checkreceipt(packageid):
-    try:
-        cmd = ['/usr/sbin/pkgutil', '--pkg-info-plist', packageid]
-        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output = proc.communicate()
-        receiptout = output[0]
-        if receiptout:
-            plist = plistlib.readPlistFromString(receiptout)
-            version = plist['pkg-version']
-        else:
-            version = '0.0.0.0.0'
-        return version
-    except Exception:
-        version = '0.0.0.0.0'
-        return version
+    return g_provider.receiptversion(packageid)
 
 
-def gethash(filename):
-    hash_function = hashlib.sha256()
-    if not os.path.isfile(filename):
-        return 'NOT A FILE'
-
-    fileref = open(filename, 'rb')
-    while 1:
-        chunk = fileref.read(2**16)
-        if not chunk:
-            break
-        hash_function.update(chunk)
-    fileref.close()
-    return hash_function.hexdigest()
+def packageinstalled(item):
+    '''True if the receipt for a package item is at least its version.
+    Packages without a packageid or version are always installed.'''
+    if not item.packageid or not item.version:
+        return False
+    try:
+        return predicates.atleast(checkreceipt(item.packageid), item.version)
+    except ValueError as err:
+        iaslog('Could not compare the receipt of %s, installing it: %s' % (
+            item.name, err))
+        return False
 
 
 def launchctl(*arg):
-    # Use *arg to pass unlimited variables to command.
-    cmd = arg
-    run = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, err = run.communicate()
-    return output
+    return g_provider.launchctl(*arg)
 
 
-def downloadfile(options):
-    connection = gurl.Gurl.alloc().initWithOptions_(options)
+def downloadfile(options, onprogress=None, watchdog=None):
+    connection = g_provider.newdownload(options)
     percent_complete = -1
     bytes_received = 0
     connection.start()
@@ -157,9 +274,24 @@ def downloadfile(options):
                         iaslog('Downloading %s - Percent complete: %s ' % (
                                filename, percent_complete))
                 elif connection.bytesReceived != bytes_received:
-                    bytes_received = connection.bytesReceived
                     iaslog('Downloading %s - Bytes received: %s ' % (
-                           filename, bytes_received))
+                           filename, connection.bytesReceived))
+                if connection.bytesReceived != bytes_received:
+                    bytes_received = connection.bytesReceived
+                    if onprogress:
+                        onprogress(bytes_received, connection.expectedLength)
+                if watchdog and watchdog.collapsed(connection.bytesReceived):
+                    iaslog('Throughput collapsed for %s, cancelling' % (
+                           filename))
+                    connection.cancel()
+                    # Let the session close the partial file before anyone
+                    # resumes it.
+                    deadline = time.time() + 5
+                    while (connection.destination is not None and
+                           not connection.destination.closed and
+                           time.time() < deadline):
+                        time.sleep(0.1)
+                    break
 
     except (KeyboardInterrupt, SystemExit):
         # safely kill the connection then fall through
@@ -170,6 +302,16 @@ def downloadfile(options):
         # Re-raise the error
         raise
 
+    # Network and disk throughput are reported separately so a slow disk
+    # can be told apart from a slow link.
+    if connection.destination is not None:
+        network = connection.networkThroughput()
+        disk = connection.destination.throughput()
+        iaslog('Downloaded %s: %s at %s/s, written at %s/s' % (
+               filename, progress.humanbytes(connection.bytesReceived),
+               progress.humanbytes(network) if network else '-',
+               progress.humanbytes(disk) if disk else '-'))
+
     if connection.error is not None:
         iaslog('Error: %s %s ' % (str(connection.error.code()),
                                   str(connection.error.localizedDescription()))
@@ -181,6 +323,194 @@ def downloadfile(options):
         iaslog('Headers: %s ' % (str(connection.headers)))
     if connection.redirection != []:
         iaslog('Redirection: %s ' % (str(connection.redirection)))
+    return connection
+
+
+def datahook(url):
+    '''Return the per chunk callback for a download from url: it applies the
+    bandwidth limit and feeds the concurrency controller. None if neither
+    is in use.'''
+    if g_limiter is None and g_controller is None:
+        return None
+    if g_limiter is not None:
+        g_limiter.target(url)
+    started = time.time()
+    first = []
+
+    def hook(nbytes):
+        if g_controller is not None:
+            if not first:
+                first.append(True)
+                g_controller.firstbyte(time.time() - started)
+            g_controller.received(nbytes)
+        if g_limiter is not None:
+            g_limiter.throttle(nbytes)
+    return hook
+
+
+def stageddownload(options):
+    '''Download to a partial file next to options['file'] and rename it into
+    place only once the transfer has completed, so a killed daemon never
+    leaves a truncated file at the final path.'''
+    finalpath = options['file']
+    options = dict(options, file=finalpath + manifest.PARTIAL_SUFFIX,
+                   can_resume=True)
+    connection = downloadfile(options)
+    if connection.error is None and (
+            connection.status is None or
+            str(connection.status).startswith('2')) and \
+            os.path.isfile(options['file']):
+        os.rename(options['file'], finalpath)
+        return True
+    return False
+
+
+def loadfragment(include, directory, opts):
+    '''Return (fragment, error) for one include. Fragments are kept by hash
+    in directory, and in the blob cache with --cachepath, so one that has
+    not changed is never downloaded again.'''
+    filehash = include['hash']
+    algorithm = include.get('hash_algorithm', iahash.DEFAULT_ALGORITHM)
+    path = os.path.join(directory, '%s.json' % filehash)
+    partial = path + manifest.PARTIAL_SUFFIX
+    pool = g_provider.autoreleasepool()
+    try:
+        if not (os.path.isfile(path) and
+                iahash.gethash(path, algorithm) == filehash):
+            if g_cache is not None and g_cache.copyto(filehash, partial):
+                iaslog('Copied fragment %s from cache' % include['url'])
+            elif g_bundle is not None and g_bundle.has(filehash):
+                g_bundle.extract(filehash, partial)
+            else:
+                options = {'url': include['url'], 'file': partial,
+                           'name': 'Fragment %s' % filehash[:12]}
+                if opts.headers:
+                    options['additional_headers'] = {
+                        'Authorization': opts.headers}
+                iaslog('Starting download: %s' % include['url'])
+                downloadfile(options)
+            if not os.path.isfile(partial) or \
+                    iahash.gethash(partial, algorithm) != filehash:
+                if os.path.isfile(partial):
+                    os.remove(partial)
+                return None, 'include %s: could not fetch a copy matching ' \
+                    'its hash' % include['url']
+            os.rename(partial, path)
+            if g_cache is not None:
+                g_cache.add(path, filehash)
+        with open(path) as fragmentfile:
+            fragment = json.load(fragmentfile)
+    except (iabundle.BundleError, IOError, OSError, ValueError) as err:
+        return None, 'include %s: %s' % (include['url'], err)
+    finally:
+        del pool
+    if not isinstance(fragment, dict):
+        return None, 'include %s: expected an object' % include['url']
+    return fragment, None
+
+
+def resolveincludes(iajson, directory, opts, depth=0):
+    '''Fetch the fragments iajson includes, concurrently, and merge them
+    (and anything they include in turn) into it. Returns the merged json
+    and a list of errors.'''
+    includes = iajson.get('include', [])
+    errors = manifest.validateincludes(includes)
+    if errors or not includes:
+        return iajson, errors
+    if depth >= manifest.MAX_INCLUDE_DEPTH:
+        return iajson, ['include: fragments nested more than %d deep' %
+                        manifest.MAX_INCLUDE_DEPTH]
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    pool = ThreadPool(min(len(includes), FRAGMENT_WORKERS))
+    try:
+        loaded = pool.map(
+            lambda include: loadfragment(include, directory, opts),
+            includes)
+    finally:
+        pool.close()
+        pool.join()
+    fragments = []
+    for fragment, error in loaded:
+        if error:
+            errors.append(error)
+            continue
+        fragment, nested = resolveincludes(fragment, directory, opts,
+                                           depth + 1)
+        errors.extend(nested)
+        fragments.append(fragment)
+    return manifest.mergeincludes(iajson, fragments), errors
+
+
+def fetchjson(json_data):
+    '''Download and parse the live json for the seed's revalidator. Returns
+    None to be retried.'''
+    pool = g_provider.autoreleasepool()
+    try:
+        jsonpath = json_data['file']
+        if not os.path.isfile(jsonpath):
+            iaslog('Starting download: %s' % (json_data['url']))
+            stageddownload(json_data)
+        if not os.path.isfile(jsonpath):
+            return None
+        try:
+            return json.loads(open(jsonpath).read())
+        except ValueError as err:
+            iaslog('Invalid json at %s: %s' % (jsonpath, str(err)))
+            os.remove(jsonpath)
+            return None
+    finally:
+        del pool
+
+
+def hassource(item):
+    '''True if item's payload can be fetched: from its urls, or by hash from
+    the bundle, the blob cache or the LAN peer. Items without one run from
+    whatever is already at their path.'''
+    if not item.hash:
+        return False
+    return bool(item.urls) or g_peer is not None or \
+        (g_bundle is not None and g_bundle.has(item.hash)) or \
+        (g_cache is not None and g_cache.has(item.hash))
+
+
+def startprefetcher(items, opts, budget):
+    global g_prefetcher
+    g_prefetcher = prefetch.Prefetcher(
+        [item for item in items if hassource(item) and not item.skipped],
+        lambda item: prefetchitem(item, opts), workers=opts.concurrency,
+        lookahead=opts.lookahead, log=iaslog, budget=budget,
+        controller=g_controller)
+    g_prefetcher.start()
+
+
+def adoptlive(iajson, done, opts, iapath):
+    '''Turn the live json, once it arrives, into the plan the rest of a
+    seeded run follows. Returns None to stay on the current plan.'''
+    if iajson is None:
+        return None
+    if iajson == g_bundle.manifest:
+        iaslog('Live json matches the seed')
+        return None
+    errors = []
+    if isinstance(iajson, dict) and iajson.get('include'):
+        iajson, errors = resolveincludes(
+            iajson, os.path.join(iapath, 'fragments'), opts)
+    if not errors:
+        plan, errors = manifest.loadplan(iajson)
+    if errors:
+        for error in errors:
+            iaslog('Invalid item in live json: %s' % error)
+        iaslog('Carrying on with the seed')
+        return None
+    predicates.evaluate(list(plan.items()), g_provider)
+    if g_prefetcher is not None:
+        budget = g_prefetcher.budget
+        g_prefetcher.stop()
+        startprefetcher([item for item in plan.items()
+                         if seed.itemkey(item) not in done], opts, budget)
+    iaslog('Switched to the live json')
+    return plan
 
 
 def vararg_callback(option, opt_str, value, parser):
@@ -263,19 +593,351 @@ def runuserscript(iauserscriptpath):
         return False
 
 
-def download_if_needed(item, stage, type, opts, depnotifystatus):
-    # Check if the file exists and matches the expected hash.
-    path = item['file']
-    name = item['name']
-    hash = item['hash']
-    while not (os.path.isfile(path) and hash == gethash(path)):
-        # Check if additional headers are being passed and add
-        # them to the dictionary.
+def extractfrombundle(item):
+    '''Copy an item out of the local bundle into its partial path. Returns
+    True if the bundle held the item and it was written to disk.'''
+    if g_bundle is None or not g_bundle.has(item.hash):
+        return False
+    try:
+        length = g_bundle.extract(item.hash, item.partial)
+    except (iabundle.BundleError, IOError, OSError) as err:
+        iaslog('Could not extract %s from bundle: %s' % (item.name, err))
+        return False
+    iaslog('Extracted %s (%s bytes) from bundle' % (item.name, length))
+    count('bytes_total', length, source='bundle')
+    return True
+
+
+def extractfromcache(item):
+    '''Copy an item out of the local blob cache into its partial path.
+    Returns True if the cache held the item.'''
+    if g_cache is None or not item.hash:
+        return False
+    try:
+        found = g_cache.copyto(item.hash, item.partial)
+    except (IOError, OSError) as err:
+        iaslog('Could not copy %s from cache: %s' % (item.name, err))
+        return False
+    if found:
+        iaslog('Copied %s from cache' % item.name)
+        count('bytes_total', os.path.getsize(item.partial), source='cache')
+    return found
+
+
+def deltabase(item, fromhash):
+    '''Path of an earlier version of item with hash fromhash: from the blob
+    cache, or the old file still at item's path if the memo has its hash.'''
+    if g_cache is not None and g_cache.has(fromhash):
+        return g_cache.path(fromhash)
+    if g_memo is not None and g_memo.trusted(item.path,
+                                             {item.algorithm: fromhash}):
+        return item.path
+    return None
+
+
+def patchfromdelta(item, opts):
+    '''Rebuild an item into its partial path from one of its deltas and an
+    earlier version we already have. Returns True if a patch was applied;
+    the result still has to pass promote().'''
+    if not item.deltas or not delta.available():
+        return False
+    patchpath = item.partial + delta.SUFFIX
+    for entry in item.deltas:
+        base = deltabase(item, entry['from'])
+        if base is None:
+            continue
+        options = {'url': entry['url'], 'file': patchpath,
+                   'name': item.name}
         if opts.headers:
-            item.update({'additional_headers':
-                         {'Authorization': opts.headers}})
+            options['additional_headers'] = {'Authorization': opts.headers}
+        options['throttle'] = datahook(entry['url'])
+        iaslog('Downloading delta for %s from %s' % (item.name,
+                                                      entry['url']))
+        connection = downloadfile(options)
+        count('bytes_total', received(connection), source='delta')
+        ok = connection.error is None and \
+            str(connection.status).startswith('2')
+        if g_controller is not None:
+            g_controller.record(ok)
+        try:
+            if not ok:
+                continue
+            if iahash.gethash(patchpath, item.algorithm) != entry['hash']:
+                iaslog('Delta for %s failed its hash check' % item.name)
+                continue
+            discardpartial(item)
+            delta.apply(base, item.partial, patchpath)
+        except (delta.DeltaError, IOError, OSError) as err:
+            iaslog('Could not apply delta for %s: %s' % (item.name, err))
+            discardpartial(item)
+            continue
+        finally:
+            try:
+                os.remove(patchpath)
+            except OSError:
+                pass
+        iaslog('Rebuilt %s from delta' % item.name)
+        return True
+    return False
+
+
+def reclaim(item):
+    '''Delete an installed payload to free its space. With --cachepath the
+    cache keeps its own link to the file.'''
+    if g_dry_run:
+        return
+    try:
+        os.remove(item.path)
+    except OSError:
+        return
+    if g_memo is not None:
+        g_memo.forget(item.path)
+    iaslog('Reclaimed %s' % item.path)
+
+
+def reclaims(item, opts):
+    '''True if item's payload is deleted once it has run successfully.
+    Payloads that can't be fetched again, user scripts and donotwait root
+    scripts (which may still be running) are left in place.'''
+    if opts.keep_payloads or not hassource(item):
+        return False
+    return item.type == 'package' or (item.type == 'rootscript' and
+                                      not item.donotwait)
+
+
+def fixpermissions(item):
+    # Fix script permissions.
+    if os.path.splitext(item.path)[1] != ".pkg":
+        os.chmod(item.path, 0755)
+    if item.type == 'userscript':
+        os.chmod(item.path, 0777)
+
+
+def verified(item):
+    '''True if item's file is on disk and matches its hash. Downloads only
+    reach the final path through promote(), and files verified earlier (even
+    in a previous run) are trusted from the memo while their stat matches.'''
+    if g_memo is not None:
+        return g_memo.verify(item.path, item.digests)
+    return os.path.isfile(item.path) and iahash.matches(
+        iahash.hashfile(item.path, list(item.digests)), item.digests)
+
+
+def discardpartial(item):
+    try:
+        os.remove(item.partial)
+    except OSError:
+        pass
+    if g_memo is not None:
+        g_memo.forget(item.partial)
+
+
+def promote(item):
+    '''Verify a finished partial download and rename it into place. A file
+    at the final path is therefore always a verified file.'''
+    if not os.path.isfile(item.partial):
+        return False
+    if g_memo is not None:
+        ok = g_memo.verify(item.partial, item.digests)
+    else:
+        ok = iahash.matches(
+            iahash.hashfile(item.partial, list(item.digests)), item.digests)
+    if not ok:
+        return False
+    os.rename(item.partial, item.path)
+    if g_memo is not None:
+        g_memo.forget(item.partial)
+        g_memo.record(item.path, item.digests)
+    fixpermissions(item)
+    if g_cache is not None:
+        try:
+            # User scripts are made world writable; keep the cache's copy
+            # out of reach.
+            g_cache.add(item.path, item.hash,
+                        link=item.type != 'userscript')
+        except (IOError, OSError) as err:
+            iaslog('Could not cache %s: %s' % (item.name, err))
+    return True
+
+
+def partialhash(item):
+    '''The primary digest of item's partial file, for logging'''
+    if g_memo is not None:
+        return (g_memo.lasthash(item.partial) or {}).get(item.algorithm)
+    return iahash.gethash(item.partial, item.algorithm)
+
+
+def trackdownload(item):
+    '''Return a downloadfile() progress callback for item, if DEPNotify
+    progress is being shown'''
+    if g_progress is None:
+        return None
+    return lambda received, expected: g_progress.download(
+        item, received, expected)
+
+
+def depstatus(text):
+    '''Show a status line in DEPNotify'''
+    if g_progress is not None:
+        g_progress.status(text)
+    else:
+        deplog('Status: %s' % text)
+
+
+def received(connection):
+    '''Bytes a download actually transferred and wrote this time'''
+    if connection.destination is None:
+        return 0
+    return connection.destination.written
+
+
+def fetchfrompeer(item):
+    '''Try the LAN peer for item. The peer never sees the auth headers and
+    anything it serves still has to pass the hash check in promote().'''
+    options = item.downloadoptions(None, g_peer + peer.blobpath(item.hash))
+    # Same bytes as the origin, so the origin can resume what the peer
+    # started and the other way around.
+    options['resume_any_source'] = True
+    connection = downloadfile(options, trackdownload(item))
+    count('bytes_total', received(connection), source='peer')
+    if connection.error is None and str(connection.status).startswith('2'):
+        return True
+    iaslog('Peer does not have %s, using the origin' % item.name)
+    return False
+
+
+def fetch(item, opts, usepeer=True):
+    '''Download item into its partial path, from the LAN peer if there is
+    one and otherwise trying its urls fastest mirror first. A mirror that
+    errors or whose throughput collapses is abandoned and the next one
+    resumes the same partial file with a Range request.'''
+    start = time.time()
+    ok = False
+    try:
+        ok = fetchany(item, opts, usepeer)
+        return ok
+    finally:
+        seconds = time.time() - start
+        observe('download_seconds', seconds, stage=item.stage)
+        if ok:
+            g_trace.download(item, seconds)
+
+
+def fetchany(item, opts, usepeer):
+    if usepeer and g_peer is not None and item.hash:
+        if fetchfrompeer(item):
+            return True
+    urls = g_mirrors.order(item.urls) if g_mirrors else item.urls
+    for number, url in enumerate(urls):
+        last = number == len(urls) - 1
+        watchdog = None
+        if g_mirrors is not None and not last:
+            watchdog = g_mirrors.watchdog(url)
+        # Check if additional headers are being passed and add
+        # them to the dictionary. Downloads go to the partial path and
+        # resume from there if the daemon was killed part way through.
+        options = item.downloadoptions(opts.headers, url)
+        options['throttle'] = datahook(url)
+        start = time.time()
+        connection = downloadfile(options, trackdownload(item), watchdog)
+        ok = (connection.error is None and
+              not (watchdog and watchdog.tripped) and
+              (connection.status is None or
+               str(connection.status).startswith('2')))
+        count('bytes_total', received(connection), source='network')
+        if g_controller is not None:
+            g_controller.record(ok)
+        if g_mirrors is not None:
+            g_mirrors.record(url, connection.bytesReceived,
+                             time.time() - start, ok)
+        if ok:
+            return True
+        if not last:
+            iaslog('Switching %s from %s to the next mirror' % (
+                   item.name, url))
+            g_mirrors.switched(url)
+            count('retries_total', reason='mirror')
+    return False
+
+
+def fromlocal(item, opts):
+    '''Stage item from the blob cache, the bundle or a delta, whichever
+    works first. A copy that doesn't verify is discarded so nothing is
+    downloaded on top of it, and a bad cache blob is dropped.'''
+    for extract in (extractfromcache, extractfrombundle,
+                    lambda item: patchfromdelta(item, opts)):
+        if extract(item):
+            if promote(item):
+                return True
+            discardpartial(item)
+            if extract is extractfromcache:
+                g_cache.remove(item.hash)
+    return False
+
+
+def prefetchitem(item, opts):
+    '''Background download used by the prefetcher. Unlike
+    download_if_needed() this never exits; anything that fails here is
+    retried in the foreground when the item's turn comes.'''
+    pool = g_provider.autoreleasepool()
+    try:
+        if verified(item) or promote(item):
+            return True
+        if not fromlocal(item, opts):
+            fetch(item, opts)
+            if not promote(item):
+                # Don't let the foreground resume onto bad data.
+                discardpartial(item)
+                return False
+        if g_progress is not None:
+            g_progress.finishdownload(item)
+        return True
+    finally:
+        del pool
+
+
+def download_if_needed(item, opts, depnotifystatus):
+    if g_prefetcher is not None and g_prefetcher.wait(item):
+        iaslog('Using prefetched %s' % item.name)
+    # Check if the file exists and matches the expected hash.
+    path = item.path
+    name = item.name
+    hash = item.hash
+    stage = item.stage
+    type = item.type
+    if verified(item):
+        return
+    # A complete download that was killed before it could be moved into
+    # place only needs verifying.
+    if promote(item):
+        iaslog('Recovered completed download of %s' % name)
+        return
+    # Cached and bundled items are copied straight from local disk, only
+    # falling back to the network if that copy turns out to be bad.
+    if extractfromcache(item):
+        if promote(item):
+            iaslog('Hash validated from cache: %s' % hash)
+            return
+        discardpartial(item)
+        g_cache.remove(hash)
+    if extractfrombundle(item):
+        if promote(item):
+            iaslog('Hash validated from bundle: %s' % hash)
+            return
+        discardpartial(item)
+    # Changed payloads can be rebuilt from an earlier version on disk.
+    if patchfromdelta(item, opts):
+        if promote(item):
+            iaslog('Hash validated from delta: %s' % hash)
+            return
+        discardpartial(item)
+    if not item.urls and g_peer is None:
+        iaslog('No url for %s and no valid bundle copy: exiting!' % name)
+        itemfailed(item)
+        sys.exit(1)
+    while not verified(item):
         # Download the file once:
-        iaslog('Starting download: %s' % (item['url']))
+        iaslog('Starting download: %s' % (item.url or item.urls[0]))
         if opts.depnotify:
             if stage == 'setupassistant':
                 iaslog(
@@ -283,30 +945,33 @@ def download_if_needed(item, stage, type, opts, depnotifystatus):
                     setupassistant.')
             else:
                 if depnotifystatus:
-                    deplog('Status: Downloading %s' % (name))
-        downloadfile(item)
+                    depstatus('Downloading %s' % (name))
+        fetch(item, opts)
         # Wait half a second to process
         time.sleep(0.5)
         # Check the files hash and redownload until it's
         # correct. Bail after three times and log event.
         failsleft = 3
-        while not hash == gethash(path):
+        while not promote(item):
             iaslog('Hash failed for %s - received: %s expected\
-                   : %s' % (name, gethash(path), hash))
-            downloadfile(item)
+                   : %s' % (name, partialhash(item), hash))
+            # Start over rather than resuming onto bad data, and don't
+            # trust the peer again for this item.
+            discardpartial(item)
+            count('retries_total', reason='hash')
+            fetch(item, opts, usepeer=False)
             failsleft -= 1
             if failsleft == 0:
                 iaslog('Hash retry failed for %s: exiting!\
                        ' % name)
+                itemfailed(item)
                 sys.exit(1)
         # Time to install.
         iaslog('Hash validated - received: %s expected: %s' % (
-               gethash(path), hash))
-        # Fix script permissions.
-        if os.path.splitext(path)[1] != ".pkg":
-            os.chmod(path, 0755)
-        if type is 'userscript':
-            os.chmod(path, 0777)
+               (g_memo.lasthash(path) or {}).get(item.algorithm)
+               if g_memo else hash, hash))
+        if g_progress is not None:
+            g_progress.finishdownload(item)
 
 
 def touch(path):
@@ -332,6 +997,9 @@ def main():
                  help=('Optional: Utilize DEPNotify and pass options to it.'))
     o.add_option('--headers', help=('Optional: Auth headers'))
     o.add_option('--jsonurl', help=('Required: URL to json file.'))
+    o.add_option('--bundle', default=None,
+                 help=('Optional: Path or URL to a bootstrap.iabundle. '
+                       'Replaces --jsonurl and per item downloads.'))
     o.add_option('--iapath',
                  default='/Library/Application Support/installapplications',
                  help=('Optional: Specify InstallApplications package path.'))
@@ -345,17 +1013,93 @@ def main():
                  help=('Optional: Trigger a reboot.'), action='store_true')
     o.add_option('--dry-run', help=('Optional: Dry run (for testing).'),
                  action='store_true')
+    o.add_option('--lookahead', default=0, type='int',
+                 help=('Optional: Download up to this many items ahead of '
+                       'the one being installed. Default 0 (off).'))
+    o.add_option('--concurrency', default=2, type='int',
+                 help=('Optional: Parallel downloads when --lookahead is '
+                       'used. Default 2.'))
+    o.add_option('--lookahead-budget', default=0, type='int', metavar='MB',
+                 help=('Optional: Most megabytes of payloads the prefetcher '
+                       'may stage ahead of the current item. Default 0 '
+                       '(whatever free space allows).'))
+    o.add_option('--disk-reserve', default=0, type='int', metavar='MB',
+                 help=('Optional: Megabytes of free space to leave alone. '
+                       'Default 0.'))
+    o.add_option('--keep-payloads', default=None, action='store_true',
+                 help=('Optional: Keep packages and root scripts on disk '
+                       'after they are installed.'))
+    o.add_option('--bandwidth-limit', default=None, type='float',
+                 metavar='MBPS',
+                 help=('Optional: Cap all downloads together at this many '
+                       'megabits per second, overriding the json\'s '
+                       'bandwidth limit_mbps.'))
+    o.add_option('--adaptive-bandwidth', default=None, action='store_true',
+                 help=('Optional: Back off downloads when round trip times '
+                       'to the server rise.'))
+    o.add_option('--seed', default=None,
+                 help=('Optional: Seed bundle to start from while the json '
+                       'downloads. Default seed.iabundle in the iapath, '
+                       'if present.'))
+    o.add_option('--seed-wait', default=300, type='float',
+                 help=('Optional: Seconds to wait at the end of a seeded '
+                       'run for the json to arrive. Default 300.'))
+    o.add_option('--concurrency-min', default=None, type='int',
+                 help=('Optional: Fewest parallel downloads when the '
+                       'concurrency adapts to the link.'))
+    o.add_option('--concurrency-max', default=None, type='int',
+                 help=('Optional: Most parallel downloads when the '
+                       'concurrency adapts to the link. --concurrency is '
+                       'the starting point.'))
     o.add_option('--userscript', default=None,
                  help=('Optional: Trigger a user script run.'),
                  action='store_true')
+    o.add_option('--cachepath', default=None,
+                 help=('Optional: Keep verified payloads in this directory '
+                       'so they can be reused and served to peers.'))
+    o.add_option('--serve', default=None, action='store_true',
+                 help=('Optional: Serve the --cachepath payloads to other '
+                       'machines on the network instead of running.'))
+    o.add_option('--port', default=None, type='int',
+                 help=('Optional: Port for --serve and --peer auto. '
+                       'Default 8739.'))
+    o.add_option('--peer', default=None,
+                 help=('Optional: Try this peer (http://host:port) before '
+                       'the origin, or "auto" to look for one on the '
+                       'local network.'))
+
+    o.add_option('--metrics-path', default=None,
+                 help=('Optional: Write Prometheus metrics to this .prom '
+                       'file (for the node_exporter textfile collector) '
+                       'after each stage and at the end of the run.'))
+    o.add_option('--profile', default=None, metavar='DIR',
+                 help=('Optional: Write cProfile stats and memory reports '
+                       'for each phase and item to DIR.'))
+    o.add_option('--trace', default=None, metavar='PATH',
+                 help=('Optional: Write the size, download and install '
+                       'time of every item to PATH as json, for '
+                       'simulate.py.'))
+    o.add_option('--provider', default='auto',
+                 choices=['auto', 'macos', 'stub'],
+                 help=('Optional: Platform provider. "stub" runs without '
+                       'macOS (no installs, urllib2 downloads) for testing. '
+                       'Default auto.'))
 
     opts, args = o.parse_args()
 
+    if opts.provider != 'auto':
+        global g_provider
+        g_provider = providers.getprovider(opts.provider)
+
     # Dry run that doesn't actually run or install anything.
     if opts.dry_run:
         global g_dry_run
         g_dry_run = True
 
+    # The user script LaunchAgent logs without the Foundation bridge.
+    if opts.userscript:
+        g_provider.foundation = False
+
     # Begin logging events
     iaslog('Beginning InstallApplications run')
 
@@ -396,6 +1140,46 @@ def main():
             iaslog('Failed to run script!')
             sys.exit(1)
 
+    loadengine()
+    if opts.port is None:
+        opts.port = peer.DEFAULT_PORT
+
+    if opts.cachepath:
+        global g_cache
+        g_cache = blobcache.BlobCache(opts.cachepath)
+
+    if opts.serve:
+        if g_cache is None:
+            iaslog('--serve requires --cachepath!')
+            sys.exit(1)
+        iaslog('Running in serve mode')
+        peer.serve(g_cache, opts.port, iaslog)
+        sys.exit(0)
+
+    if opts.profile:
+        global g_profiler
+        g_profiler = profiler.Profiler(opts.profile)
+
+    global g_trace
+    g_trace = runtrace.getrecorder(opts.trace, g_started)
+
+    if opts.metrics_path:
+        global g_metrics
+        g_metrics = metrics.Metrics(opts.metrics_path)
+        for name, kind, text in METRICS:
+            g_metrics.declare(name, kind, text)
+
+    if opts.peer:
+        global g_peer
+        if opts.peer == 'auto':
+            g_peer = peer.discover(opts.port)
+            if g_peer:
+                iaslog('Discovered peer: %s' % g_peer)
+            else:
+                iaslog('No peer found, using the origin')
+        else:
+            g_peer = opts.peer.rstrip('/')
+
     # DEPNotify trigger commands that need to happen at the end of a run
     deptriggers = ['Command: Quit', 'Command: Restart', 'Command: Logout',
                    'DEPNotifyPath', 'DEPNotifyArguments',
@@ -414,7 +1198,7 @@ def main():
                 deplog(notification)
 
     # Check for root and json url.
-    if opts.jsonurl:
+    if opts.jsonurl or opts.bundle:
         jsonurl = opts.jsonurl
         if not g_dry_run and (os.getuid() != 0):
             print 'InstallApplications requires root!'
@@ -429,45 +1213,195 @@ def main():
     except Exception:
         pass
 
-    # json data for gurl download
-    json_data = {
-            'url': jsonurl,
-            'file': jsonpath,
-            'name': 'Bootstrap.json'
-        }
-    
-    # Grab auth headers if they exist and update the json_data dict.
-    if opts.headers:
-        headers = {'Authorization': opts.headers}
-        json_data.update({'additional_headers': headers})
-
-    # If the file doesn't exist, grab it and wait half a second to save.
-    while not os.path.isfile(jsonpath):
-        iaslog('Starting download: %s' % (json_data['url']))
-        downloadfile(json_data)
-        time.sleep(0.5)
+    revalidator = None
+    g_profiler.start('load')
+    if opts.bundle:
+        # A bundle carries the json and every payload, so the whole run
+        # needs at most one download.
+        global g_bundle
+        if re.match(r'^https?://', opts.bundle):
+            bundlepath = os.path.join(iapath, 'bootstrap.iabundle')
+            bundle_data = {
+                'url': opts.bundle,
+                'file': bundlepath,
+                'name': 'Bootstrap.iabundle'
+            }
+            if opts.headers:
+                bundle_data.update(
+                    {'additional_headers': {'Authorization': opts.headers}})
+            while not os.path.isfile(bundlepath):
+                iaslog('Starting download: %s' % (bundle_data['url']))
+                stageddownload(bundle_data)
+                time.sleep(0.5)
+        else:
+            bundlepath = opts.bundle
+        iaslog('InstallApplications bundle path: ' + str(bundlepath))
+        try:
+            g_bundle = iabundle.Bundle(bundlepath)
+        except (iabundle.BundleError, IOError) as err:
+            iaslog('Invalid bundle: %s' % str(err))
+            sys.exit(1)
+        iajson = g_bundle.manifest
+    else:
+        # json data for gurl download
+        json_data = {
+                'url': jsonurl,
+                'file': jsonpath,
+                'name': 'Bootstrap.json'
+            }
+
+        # Grab auth headers if they exist and update the json_data dict.
+        if opts.headers:
+            headers = {'Authorization': opts.headers}
+            json_data.update({'additional_headers': headers})
+
+        # A seed shipped in the package lets the run start before the json
+        # has been downloaded; the json is then fetched in the background.
+        # A json left by an interrupted run is used as is.
+        seedpath = opts.seed or os.path.join(iapath, SEED_NAME)
+        if not os.path.isfile(jsonpath) and os.path.isfile(seedpath):
+            try:
+                g_bundle = iabundle.Bundle(seedpath)
+            except (iabundle.BundleError, IOError) as err:
+                iaslog('Invalid seed: %s' % str(err))
+        if g_bundle is not None:
+            iaslog('Starting from seed %s' % seedpath)
+            iajson = g_bundle.manifest
+            revalidator = seed.Revalidator(lambda: fetchjson(json_data),
+                                           iaslog)
+            revalidator.start()
+        else:
+            # If the file doesn't exist, grab it and wait half a second to
+            # save.
+            while not os.path.isfile(jsonpath):
+                iaslog('Starting download: %s' % (json_data['url']))
+                stageddownload(json_data)
+                time.sleep(0.5)
+
+            # Load up file to grab all the items.
+            try:
+                iajson = json.loads(open(jsonpath).read())
+            except ValueError as err:
+                iaslog('Invalid json at %s: %s' % (jsonpath, str(err)))
+                os.remove(jsonpath)
+                sys.exit(1)
 
-    # Load up file to grab all the items.
-    iajson = json.loads(open(jsonpath).read())
+    # Shared fragments the json includes are fetched together, each cached
+    # on its own.
+    if isinstance(iajson, dict) and iajson.get('include'):
+        iajson, errors = resolveincludes(
+            iajson, os.path.join(iapath, 'fragments'), opts)
+        if errors:
+            for error in errors:
+                iaslog('Invalid include: %s' % error)
+            sys.exit(1)
 
-    # Set the stages
-    stages = ['setupassistant', 'userland']
+    # Parse and validate every item before anything is downloaded or
+    # installed, so a broken manifest fails immediately and in full.
+    plan, errors = manifest.loadplan(iajson)
+    if errors:
+        for error in errors:
+            iaslog('Invalid item: %s' % error)
+        iaslog('Found %d problems in the json, exiting!' % len(errors))
+        sys.exit(1)
 
-    # Get the number of items for DEPNotify
-    if opts.depnotify:
-        numberofitems = 0
-        for stage in stages:
-            if stage == 'setupassistant':
-                iaslog('Skipping DEPNotify item count due to setupassistant.')
-            else:
-                numberofitems += int(len(iajson[stage]))
-        # Mulitply by two for download and installation status messages
-        if depnotifystatus:
-            deplog('Command: Determinate: %d' % (numberofitems*2))
+    g_profiler.stop()
+
+    # One bandwidth limit for every download of the run, from the json's
+    # settings unless overridden on the command line.
+    global g_limiter
+    g_limiter = ratelimit.getlimiter(
+        plan.settings, opts.bandwidth_limit,
+        True if opts.adaptive_bandwidth else None, iaslog)
+    # The number of parallel downloads adapts to the link when limits are
+    # given on the command line or in the json.
+    global g_controller
+    g_controller = concurrency.getcontroller(
+        plan.settings, opts.concurrency_min, opts.concurrency_max,
+        opts.concurrency, iaslog)
+
+    # Set the stages
+    stages = manifest.STAGES
+
+    # Decide what can be skipped before anything touches the network:
+    # skip_if predicates and package receipts are checked in one pass.
+    with g_profiler.section('skip-if'):
+        skipped = predicates.evaluate(list(plan.items()), g_provider, iaslog)
+    iaslog('%d of %d items will be skipped' % (len(skipped), len(plan)))
+
+    # Check everything already on disk in one parallel pass. Files verified
+    # by an earlier run are trusted from the memo without being read again.
+    g_profiler.start('verify')
+    global g_memo
+    g_memo = verify.VerifyMemo(os.path.join(iapath, '.verified.json'),
+                               iahash.hashfile)
+    staged = [(item.path, item.digests) for item in plan.items()
+              if item.digests and not item.skipped]
+    results = g_memo.verifyall(staged)
+    iaslog('%d of %d items already staged and verified' % (
+        len([ok for ok in results.values() if ok]), len(staged)))
+    g_profiler.stop()
+
+    # Check there is room for the run before downloading anything. Payloads
+    # are reclaimed as they are installed, so what matters is the peak, and
+    # whatever is left over bounds how far ahead the prefetcher may stage.
+    pending = [item for item in plan.items() if not item.skipped and (
+        hassource(item) or results.get(item.path))]
+    # With --cachepath reclaiming only drops a link; the cache keeps the
+    # blocks.
+    kept = [item for item in pending
+            if g_cache is not None or not reclaims(item, opts)]
+    peak = diskspace.peakfootprint(
+        pending, [item for item in pending if results.get(item.path)],
+        kept=kept)
+    available = diskspace.freespace(iapath) - opts.disk_reserve * 2**20
+    iaslog('Run needs up to %d MB on disk, %d MB available' % (
+        peak / 2**20, available / 2**20))
+    if peak > available:
+        iaslog('Not enough free space for this run')
+        writemetrics(success=False)
+        sys.exit(1)
+    budget = available - peak
+    if opts.lookahead_budget > 0:
+        budget = min(budget, opts.lookahead_budget * 2**20)
+
+    # Set up the DEPNotify progress bar. It is weighted by bytes: every item
+    # counts its size for the download and again (partially) for the
+    # install.
+    if opts.depnotify and depnotifystatus:
+        global g_progress
+        iaslog('Skipping DEPNotify progress for setupassistant items.')
+        g_progress = progress.Progress(
+            [item for stage in stages if stage != 'setupassistant'
+             for item in plan.stage(stage) if not item.skipped], deplog)
+        g_progress.start()
+
+    # Rank the mirrors of any item that has more than one url.
+    if any(len(item.urls) > 1 for item in plan.items()):
+        global g_mirrors
+        g_mirrors = mirrors.Mirrors(iaslog)
+        with g_profiler.section('probe-mirrors'):
+            g_mirrors.probe(plan.items(), opts.headers)
+
+    # Start downloading ahead of the install loop. Execution order stays as
+    # declared; the prefetcher only decides which downloads happen first.
+    if opts.lookahead > 0:
+        startprefetcher(list(plan.items()), opts, budget)
+
+    # Items are handed out one at a time so a seeded run can switch to the
+    # live json between any two of them.
+    if revalidator is not None:
+        reconciler = seed.Reconciler(
+            plan, lambda timeout: adoptlive(revalidator.take(timeout),
+                                            reconciler.done, opts, iapath),
+            opts.seed_wait)
+    else:
+        reconciler = seed.Reconciler(plan, lambda timeout: None)
 
     # Process all stages
     for stage in stages:
         iaslog('Beginning %s' % (stage))
+        g_profiler.start('stage-%s' % stage)
         if stage == 'userland':
             # Open DEPNotify for the admin if they pass
             # condition.
@@ -481,12 +1415,9 @@ def main():
                     if 'DEPNotifyArguments:' in depnstr:
                         depnotifyarguments = depnstr.split(' ', 1)[-1]
             if depnotifypath:
-                while (getconsoleuser()[0] is None
-                       or getconsoleuser()[0] == u'loginwindow'
-                       or getconsoleuser()[0] == u'_mbsetupuser'):
-                    iaslog('Detected SetupAssistant in userland stage - \
-                           delaying DEPNotify launch until user session.')
-                    time.sleep(1)
+                waitforconsoleuser('Detected SetupAssistant in userland '
+                                   'stage - delaying DEPNotify launch until '
+                                   'user session.')
                 iaslog('Creating DEPNotify Launcher')
                 depnotifyscriptpath = os.path.join(
                     iauserscriptpath,
@@ -519,41 +1450,41 @@ def main():
                 while os.path.isfile(userscripttouchpath):
                     iaslog('Waiting for DEPNotify script to complete')
                     time.sleep(0.5)
+        g_profiler.stop()
         # Loop through the items and download/install/run them.
-        for item in iajson[stage]:
+        for item in reconciler.items(stage, last=stage == stages[-1]):
             # Set the filepath, name and type.
-            try:
-                path = item['file']
-                name = item['name']
-                type = item['type']
-            except KeyError as e:
-                iaslog('Invalid item %s: %s' % (repr(item), str(e)))
-                continue
+            path = item.path
+            name = item.name
+            type = item.type
             iaslog('%s processing %s %s at %s' % (stage, type, name, path))
+            result = 'processed'
+            if item.skipped:
+                if type == 'package':
+                    iaslog('Skipping %s - already installed.' % (name))
+                else:
+                    iaslog('Skipping %s - skip_if matched.' % (name))
+                count('items_total', stage=stage, type=type,
+                      result='skipped')
+                continue
 
             if type == 'package':
-                packageid = item['packageid']
-                version = item['version']
                 # Compare version of package with installed version
-                if LooseVersion(checkreceipt(packageid)) >= LooseVersion(
-                        version):
+                if packageinstalled(item):
                     iaslog('Skipping %s - already installed.' % (name))
+                    result = 'skipped'
                 else:
                     # Download the package if it isn't already on disk.
-                    download_if_needed(item, stage, type, opts,
-                                       depnotifystatus)
+                    with g_profiler.section(section(item, 'download')):
+                        download_if_needed(item, opts, depnotifystatus)
 
                     # On userland stage, we want to wait until we are actually
                     # in the user's session.
                     if stage == 'userland':
-                        if len(iajson['userland']) > 0:
-                            while (getconsoleuser()[0] is None
-                                   or getconsoleuser()[0] == u'loginwindow'
-                                   or getconsoleuser()[0] == u'_mbsetupuser'):
-                                iaslog('Detected SetupAssistant in userland \
-                                       stage - delaying install until user \
-                                       session.')
-                                time.sleep(1)
+                        if len(reconciler.plan.stage('userland')) > 0:
+                            waitforconsoleuser(
+                                'Detected SetupAssistant in userland stage '
+                                '- delaying install until user session.')
                     iaslog('Installing %s from %s' % (name, path))
                     if opts.depnotify:
                         if stage == 'setupassistant':
@@ -562,43 +1493,79 @@ def main():
                                 setupassistant.')
                         else:
                             if depnotifystatus:
-                                deplog('Status: Installing: %s' % (name))
+                                depstatus('Installing: %s' % (name))
                     # Install the package
-                    installerstatus = installpackage(item['file'])
+                    installprogress = None
+                    if g_progress is not None:
+                        installprogress = (lambda fraction, item=item:
+                                           g_progress.install(item, fraction))
+                    g_profiler.start(section(item, 'install'))
+                    start = time.time()
+                    installerstatus = installpackage(path, installprogress)
+                    installed(item, start)
+                    g_profiler.stop()
+                    if installerstatus:
+                        result = 'failed'
+                    elif reclaims(item, opts):
+                        reclaim(item)
             elif type == 'rootscript':
-                if 'url' in item:
-                    download_if_needed(item, stage, type, opts,
-                                       depnotifystatus)
+                if hassource(item):
+                    with g_profiler.section(section(item, 'download')):
+                        download_if_needed(item, opts, depnotifystatus)
                 iaslog('Starting root script: %s' % (path))
-                try:
-                    donotwait = item['donotwait']
-                except KeyError as e:
-                    donotwait = False
+                donotwait = item.donotwait
                 if opts.depnotify:
                     if depnotifystatus:
-                        deplog('Status: Installing: %s' % (name))
+                        depstatus('Installing: %s' % (name))
+                g_profiler.start(section(item, 'install'))
+                start = time.time()
                 if donotwait:
-                    runrootscript(path, True)
+                    ran = runrootscript(path, True)
                 else:
-                    runrootscript(path, False)
+                    ran = runrootscript(path, False)
+                installed(item, start)
+                g_profiler.stop()
+                if not ran:
+                    result = 'failed'
+                elif reclaims(item, opts):
+                    reclaim(item)
             elif type == 'userscript':
-                if stage == 'setupassistant':
-                    iaslog('Detected setupassistant and user script. \
-                          User scripts cannot work in setupassistant stage! \
-                          Removing %s') % path
-                    os.remove(path)
-                    pass
-                if 'url' in item:
-                    download_if_needed(item, stage, type, opts,
-                                       depnotifystatus)
+                # User scripts in setupassistant are rejected when the json
+                # is loaded.
+                if hassource(item):
+                    with g_profiler.section(section(item, 'download')):
+                        download_if_needed(item, opts, depnotifystatus)
                 iaslog('Triggering LaunchAgent for user script: %s' % (path))
+                g_profiler.start(section(item, 'install'))
+                start = time.time()
                 touch(userscripttouchpath)
                 if opts.depnotify:
                     if depnotifystatus:
-                        deplog('Status: Installing: %s' % (name))
+                        depstatus('Installing: %s' % (name))
                 while os.path.isfile(userscripttouchpath):
                     iaslog('Waiting for user script to complete: %s' % (path))
                     time.sleep(0.5)
+                installed(item, start)
+                g_profiler.stop()
+            count('items_total', stage=stage, type=type, result=result)
+            if g_progress is not None:
+                g_progress.finishinstall(item)
+        if g_metrics is not None:
+            g_metrics.set('stage_completed_timestamp_seconds', time.time(),
+                          stage=stage)
+            writemetrics()
+
+    if g_prefetcher is not None:
+        g_prefetcher.stop()
+    if g_limiter is not None:
+        g_limiter.stop()
+    if revalidator is not None:
+        revalidator.stop()
+    if g_mirrors is not None:
+        g_mirrors.report()
+    writemetrics(success=True)
+    if not g_trace.write():
+        iaslog('Could not write the trace to %s' % opts.trace)
 
     # Kill the launchdaemon and agent
     try:
@@ -632,7 +1599,7 @@ def main():
 
     # Trigger a reboot
     if opts.reboot:
-        subprocess.call(['/sbin/shutdown', '-r', 'now'])
+        g_provider.reboot()
     else:
         iaslog(
             'Removing LaunchDaemon from launchctl list: ' + opts.ldidentifier)
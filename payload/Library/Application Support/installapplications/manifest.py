@@ -0,0 +1,308 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+manifest.py
+
+Parses bootstrap.json once into an execution plan of compact item objects.
+Every item is validated up front so a broken manifest is reported in full
+before anything is downloaded or installed.
+"""
+
+import os
+
+import concurrency
+import iahash
+import predicates
+import ratelimit
+
+# Stages run in this order.
+STAGES = ['setupassistant', 'userland']
+ITEM_TYPES = ('package', 'rootscript', 'userscript')
+PARTIAL_SUFFIX = '.partial'
+# How deep fragments may include other fragments.
+MAX_INCLUDE_DEPTH = 4
+
+# Keys every item needs, and the extra keys needed per type.
+REQUIRED_KEYS = ('name', 'type', 'file')
+REQUIRED_BY_TYPE = {
+    'package': ('hash', 'packageid', 'version'),
+    'rootscript': (),
+    'userscript': (),
+}
+
+
+class Item(object):
+    '''A single validated bootstrap item'''
+
+    __slots__ = ('stage', 'index', 'name', 'type', 'path', 'partial', 'url',
+                 'urls', 'hash', 'algorithm', 'digests', 'packageid',
+                 'version', 'donotwait', 'size', 'priority', 'skipif',
+                 'skipped', 'deltas', 'raw')
+
+    def __init__(self, stage, index, raw):
+        self.stage = stage
+        self.index = index
+        self.raw = raw
+        self.name = raw['name']
+        self.type = raw['type']
+        self.path = os.path.normpath(raw['file'])
+        # Downloads land here and are renamed to path once verified.
+        self.partial = self.path + PARTIAL_SUFFIX
+        self.url = raw.get('url') or None
+        # The primary url first, then any mirrors of it.
+        self.urls = []
+        for url in [self.url] + raw.get('mirrors', []):
+            if url and url not in self.urls:
+                self.urls.append(url)
+        self.hash = raw.get('hash')
+        self.algorithm = raw.get('hash_algorithm', iahash.DEFAULT_ALGORITHM)
+        # Every digest the file has to match: the primary hash plus any
+        # extra ones listed in 'hashes'.
+        self.digests = dict(raw.get('hashes', {}))
+        if self.hash:
+            self.digests[self.algorithm] = self.hash
+        self.packageid = raw.get('packageid')
+        self.version = raw.get('version')
+        self.donotwait = bool(raw.get('donotwait', False))
+        self.size = raw.get('size')
+        self.priority = raw.get('priority', 0)
+        self.skipif = raw.get('skip_if')
+        # Set by predicates.evaluate() before anything is downloaded.
+        self.skipped = False
+        # Patches that rebuild this payload from earlier versions, keyed by
+        # the earlier version's hash in 'from'.
+        self.deltas = raw.get('deltas', [])
+
+    def __repr__(self):
+        return '<Item %s/%d %s %s>' % (self.stage, self.index, self.type,
+                                       self.name)
+
+    def addmirror(self, url):
+        if url not in self.urls:
+            self.urls.append(url)
+
+    def downloadoptions(self, headers=None, url=None):
+        '''Return a fresh options dictionary for Gurl. Downloads are written
+        to the partial path and can resume from it, even when the rest of
+        the file comes from a different mirror; the hash check after the
+        download is what guarantees the result.'''
+        options = dict(self.raw)
+        options['file'] = self.partial
+        options['can_resume'] = True
+        if url:
+            options['url'] = url
+        if len(self.urls) > 1:
+            options['resume_any_source'] = True
+        if headers:
+            options['additional_headers'] = {'Authorization': headers}
+        return options
+
+
+class Plan(object):
+    '''All items of a manifest, grouped by stage in execution order'''
+
+    def __init__(self, stages, settings=None):
+        self.stages = stages
+        self.settings = settings or {}
+
+    def stage(self, stage):
+        return self.stages.get(stage, [])
+
+    def items(self):
+        for stage in STAGES:
+            for item in self.stage(stage):
+                yield item
+
+    def __len__(self):
+        return sum(len(items) for items in self.stages.values())
+
+
+def validateitem(stage, index, raw):
+    '''Return a list of problems with a raw item dictionary'''
+    where = '%s item %d' % (stage, index)
+    if not isinstance(raw, dict):
+        return ['%s: expected an object, got %s' % (where, type(raw).__name__)]
+    if raw.get('name'):
+        where = '%s (%s)' % (where, raw['name'])
+    errors = []
+    for key in REQUIRED_KEYS:
+        if not raw.get(key):
+            errors.append('%s: missing \'%s\'' % (where, key))
+    itemtype = raw.get('type')
+    if itemtype and itemtype not in ITEM_TYPES:
+        errors.append('%s: unknown type \'%s\'' % (where, itemtype))
+    for key in REQUIRED_BY_TYPE.get(itemtype, ()):
+        # packageid and version may be left empty, as generatejson.py
+        # writes them; a package missing either is always installed.
+        if key not in raw or (key == 'hash' and not raw[key]):
+            errors.append('%s: %s items need \'%s\'' % (where, itemtype, key))
+    if raw.get('url') and not raw.get('hash'):
+        errors.append('%s: items with a url need a \'hash\'' % where)
+    if raw.get('file') and not os.path.isabs(raw['file']):
+        errors.append('%s: file must be an absolute path' % where)
+    if itemtype == 'userscript' and stage == 'setupassistant':
+        errors.append('%s: user scripts cannot run in setupassistant' % where)
+    if 'donotwait' in raw and not isinstance(raw['donotwait'], bool):
+        errors.append('%s: donotwait must be true or false' % where)
+    if 'size' in raw and (isinstance(raw['size'], bool) or
+                          not isinstance(raw['size'], (int, long)) or
+                          raw['size'] < 0):
+        errors.append('%s: size must be a non-negative integer' % where)
+    if 'priority' in raw and not isinstance(raw['priority'], (int, long)):
+        errors.append('%s: priority must be an integer' % where)
+    if 'mirrors' in raw and not (
+            isinstance(raw['mirrors'], list) and
+            all(isinstance(url, basestring) for url in raw['mirrors'])):
+        errors.append('%s: mirrors must be a list of urls' % where)
+    if 'deltas' in raw:
+        if not isinstance(raw['deltas'], list) or not all(
+                isinstance(entry, dict) and all(
+                    isinstance(entry.get(key), basestring) and entry[key]
+                    for key in ('from', 'url', 'hash'))
+                for entry in raw['deltas']):
+            errors.append('%s: deltas must be a list of objects with '
+                          '\'from\', \'url\' and \'hash\'' % where)
+    if 'skip_if' in raw:
+        errors.extend(['%s: %s' % (where, error)
+                       for error in predicates.validate(raw['skip_if'])])
+    algorithms = [raw.get('hash_algorithm', iahash.DEFAULT_ALGORITHM)]
+    if 'hashes' in raw:
+        if isinstance(raw['hashes'], dict) and all(
+                isinstance(value, basestring)
+                for value in raw['hashes'].values()):
+            algorithms.extend(raw['hashes'].keys())
+        else:
+            errors.append('%s: hashes must map an algorithm to a digest' %
+                          where)
+    for algorithm in algorithms:
+        if not isinstance(algorithm, basestring) or \
+                not iahash.available(algorithm):
+            errors.append('%s: unsupported hash algorithm \'%s\'' % (
+                where, algorithm))
+    return errors
+
+
+def validatesettings(settings):
+    '''Return a list of problems with the top level settings object.
+    settings['mirrors'] maps an origin url prefix to a list of prefixes
+    that serve the same files; settings['bandwidth'] is described in
+    ratelimit.py and settings['concurrency'] in concurrency.py.'''
+    if not isinstance(settings, dict):
+        return ['settings: expected an object']
+    errors = []
+    mirrors = settings.get('mirrors', {})
+    if not isinstance(mirrors, dict) or not all(
+            isinstance(alternates, list) for alternates in mirrors.values()):
+        errors.append('settings: mirrors must map an origin url to a list '
+                      'of mirror urls')
+    if 'bandwidth' in settings:
+        errors.extend(ratelimit.validate(settings['bandwidth']))
+    if 'concurrency' in settings:
+        errors.extend(concurrency.validate(settings['concurrency']))
+    return errors
+
+
+def validateincludes(includes):
+    '''Return a list of problems with a manifest's 'include' list. Every
+    fragment is named by url and hash, so a cached copy can be used without
+    asking the server.'''
+    if not isinstance(includes, list):
+        return ['include: expected a list of fragments']
+    errors = []
+    for number, include in enumerate(includes):
+        where = 'include %d' % number
+        if not isinstance(include, dict):
+            errors.append('%s: expected an object' % where)
+            continue
+        for key in ('url', 'hash'):
+            if not isinstance(include.get(key), basestring) or \
+                    not include[key]:
+                errors.append('%s: missing \'%s\'' % (where, key))
+        algorithm = include.get('hash_algorithm', iahash.DEFAULT_ALGORITHM)
+        if not isinstance(algorithm, basestring) or \
+                not iahash.available(algorithm):
+            errors.append('%s: unsupported hash algorithm \'%s\'' % (
+                where, algorithm))
+    return errors
+
+
+def mergeincludes(iajson, fragments):
+    '''Return iajson with the stage items of its resolved fragments put in
+    front of its own, in include order. An item already merged with the
+    same file and hash is not added twice. Settings only come from the top
+    level manifest.'''
+    merged = dict((key, value) for key, value in iajson.items()
+                  if key != 'include')
+    for stage in STAGES:
+        items = []
+        seen = set()
+        for source in list(fragments) + [iajson]:
+            rawitems = source.get(stage, [])
+            if not isinstance(rawitems, list):
+                # Left for loadplan() to report
+                items = rawitems
+                break
+            for raw in rawitems:
+                if isinstance(raw, dict):
+                    key = (raw.get('file'), raw.get('hash'))
+                    if raw.get('hash') and key in seen:
+                        continue
+                    seen.add(key)
+                items.append(raw)
+        if items or stage in merged:
+            merged[stage] = items
+    return merged
+
+
+def loadplan(iajson):
+    '''Parse and validate a bootstrap json dictionary. Returns a tuple of
+    (plan, errors); the plan should not be run if errors is non-empty.'''
+    errors = []
+    stages = {}
+    seen = {}
+    if not isinstance(iajson, dict):
+        return Plan({}), ['bootstrap json must be an object']
+    settings = iajson.get('settings', {})
+    errors.extend(validatesettings(settings))
+    if errors:
+        settings = {}
+    for stage in STAGES:
+        rawitems = iajson.get(stage, [])
+        if not isinstance(rawitems, list):
+            errors.append('%s: expected a list of items' % stage)
+            continue
+        stages[stage] = []
+        for index, raw in enumerate(rawitems):
+            itemerrors = validateitem(stage, index, raw)
+            if itemerrors:
+                errors.extend(itemerrors)
+                continue
+            item = Item(stage, index, raw)
+            # The same path can't hold two different payloads.
+            if item.hash and item.path in seen and \
+                    seen[item.path].hash != item.hash:
+                errors.append('%s item %d (%s): %s is also used by %s with '
+                              'a different hash' % (
+                                  stage, index, item.name, item.path,
+                                  seen[item.path].name))
+            seen.setdefault(item.path, item)
+            for origin, alternates in settings.get('mirrors', {}).items():
+                if item.url and item.url.startswith(origin):
+                    for alternate in alternates:
+                        item.addmirror(alternate + item.url[len(origin):])
+            stages[stage].append(item)
+    return Plan(stages, settings), errors
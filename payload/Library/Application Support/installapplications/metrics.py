@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+metrics.py
+
+Counters, gauges and histograms for a run, written in the Prometheus text
+exposition format so node_exporter's textfile collector can pick them up.
+The file is replaced atomically each time it is written.
+"""
+
+import os
+import threading
+
+PREFIX = 'installapplications_'
+# Seconds; suits anything from a small script download to a large install.
+BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def labelstring(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for key, value in sorted(labels))
+
+
+def formatvalue(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    '''Collects metrics for one run and writes them to path'''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # name: (type, help)
+        self.meta = {}
+        # name: {labels tuple: value or Histogram}
+        self.series = {}
+
+    def declare(self, name, kind, text):
+        self.meta[name] = (kind, text)
+        self.series.setdefault(name, {})
+
+    def key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        with self.lock:
+            values = self.series.setdefault(name, {})
+            key = self.key(labels)
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.series.setdefault(name, {})[self.key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            values = self.series.setdefault(name, {})
+            key = self.key(labels)
+            if key not in values:
+                values[key] = Histogram(BUCKETS)
+            values[key].observe(value)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.series):
+                kind, text = self.meta.get(name, ('untyped', ''))
+                fullname = PREFIX + name
+                lines.append('# HELP %s %s' % (fullname, text))
+                lines.append('# TYPE %s %s' % (fullname, kind))
+                for labels, value in sorted(self.series[name].items()):
+                    if isinstance(value, Histogram):
+                        for bound, count in zip(value.buckets, value.counts):
+                            lines.append('%s_bucket%s %d' % (
+                                fullname,
+                                labelstring(labels + (('le', bound),)),
+                                count))
+                        lines.append('%s_bucket%s %d' % (
+                            fullname,
+                            labelstring(labels + (('le', '+Inf'),)),
+                            value.count))
+                        lines.append('%s_sum%s %s' % (
+                            fullname, labelstring(labels),
+                            formatvalue(value.sum)))
+                        lines.append('%s_count%s %d' % (
+                            fullname, labelstring(labels), value.count))
+                    else:
+                        lines.append('%s%s %s' % (
+                            fullname, labelstring(labels),
+                            formatvalue(value)))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        '''Replace the metrics file. The collector ignores files that don't
+        end in .prom, so the temporary file can sit next to it.'''
+        tmppath = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmppath, 'w') as metricsfile:
+                metricsfile.write(self.render())
+            os.rename(tmppath, self.path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+            return False
+        return True
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+mirrors.py
+
+Mirror selection for items that can be downloaded from more than one url.
+At startup every mirror host is probed in parallel with a small Range
+request; items then try their urls fastest first. During a download a
+watchdog notices when throughput collapses so the caller can cancel and
+resume the same partial file from the next mirror.
+"""
+
+import threading
+import time
+import urllib2
+from urlparse import urlparse
+
+# Bytes fetched from each mirror by the startup probe.
+PROBE_BYTES = 256 * 1024
+PROBE_TIMEOUT = 10
+# A download is considered collapsed when it averages less than
+# COLLAPSE_RATE bytes/sec (or COLLAPSE_FRACTION of the mirror's probed
+# throughput, whichever is higher) over COLLAPSE_WINDOW seconds.
+COLLAPSE_RATE = 16 * 1024
+COLLAPSE_FRACTION = 0.05
+COLLAPSE_WINDOW = 20
+
+
+def hostof(url):
+    parsed = urlparse(url)
+    return '%s://%s' % (parsed.scheme, parsed.netloc)
+
+
+class MirrorStats(object):
+    '''Probe results and running totals for one mirror host'''
+
+    def __init__(self, host):
+        self.host = host
+        self.latency = None
+        self.throughput = None
+        self.bytes = 0
+        self.seconds = 0.0
+        self.failures = 0
+        self.switches = 0
+
+    def score(self):
+        '''Estimated seconds to fetch the probe, lower is better'''
+        if self.latency is None or not self.throughput:
+            return float('inf')
+        return self.latency + PROBE_BYTES / self.throughput
+
+
+class Mirrors(object):
+    '''Ranks mirror hosts and records how each one performs'''
+
+    def __init__(self, log):
+        self.log = log
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def stats(self, url):
+        host = hostof(url)
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = MirrorStats(host)
+            return self.hosts[host]
+
+    def probeone(self, url, headers):
+        stats = self.stats(url)
+        request = urllib2.Request(url)
+        request.add_header('Range', 'bytes=0-%d' % (PROBE_BYTES - 1))
+        if headers:
+            request.add_header('Authorization', headers)
+        start = time.time()
+        try:
+            response = urllib2.urlopen(request, timeout=PROBE_TIMEOUT)
+            first = time.time()
+            data = response.read(PROBE_BYTES)
+            end = time.time()
+        except Exception as err:  # noqa
+            stats.failures += 1
+            self.log('Mirror probe of %s failed: %s' % (stats.host, err))
+            return
+        stats.latency = first - start
+        if end > first:
+            stats.throughput = len(data) / (end - first)
+        else:
+            stats.throughput = float(len(data) or 1)
+        self.log('Mirror %s: %.0f ms latency, %d KB/s' % (
+            stats.host, stats.latency * 1000, stats.throughput / 1024))
+
+    def probe(self, items, headers=None):
+        '''Probe every mirror host used by items, in parallel. Each host is
+        probed with the first url that points at it.'''
+        urls = {}
+        for item in items:
+            if len(item.urls) < 2:
+                continue
+            for url in item.urls:
+                urls.setdefault(hostof(url), url)
+        threads = []
+        for url in urls.values():
+            thread = threading.Thread(target=self.probeone,
+                                      args=(url, headers))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join(PROBE_TIMEOUT + 5)
+
+    def order(self, urls):
+        '''Return urls sorted fastest mirror first. Unprobed hosts keep
+        their listed order after the probed ones.'''
+        return sorted(urls, key=lambda url: (self.stats(url).score(),
+                                             urls.index(url)))
+
+    def record(self, url, received, seconds, ok):
+        stats = self.stats(url)
+        with self.lock:
+            stats.bytes += received
+            stats.seconds += seconds
+            if not ok:
+                stats.failures += 1
+
+    def switched(self, url):
+        stats = self.stats(url)
+        with self.lock:
+            stats.switches += 1
+
+    def watchdog(self, url):
+        return Watchdog(self.stats(url).throughput)
+
+    def report(self):
+        for host in sorted(self.hosts):
+            stats = self.hosts[host]
+            rate = stats.bytes / stats.seconds if stats.seconds else 0
+            self.log('Mirror %s: %d bytes in %.1f sec (%d KB/s), '
+                     '%d failures, %d switches away' % (
+                         host, stats.bytes, stats.seconds, rate / 1024,
+                         stats.failures, stats.switches))
+
+
+class Watchdog(object):
+    '''Tells downloadfile() when a transfer has slowed to a crawl'''
+
+    def __init__(self, expected=None, clock=time.time):
+        self.clock = clock
+        self.minimum = COLLAPSE_RATE
+        if expected:
+            self.minimum = max(self.minimum, expected * COLLAPSE_FRACTION)
+        self.samples = []
+        self.tripped = False
+
+    def collapsed(self, received):
+        '''Feed the bytes received so far; True once the average over the
+        last window is below the minimum.'''
+        now = self.clock()
+        self.samples.append((now, received))
+        # Keep one sample at or beyond the start of the window.
+        while (len(self.samples) > 1 and
+               now - self.samples[1][0] >= COLLAPSE_WINDOW):
+            self.samples.pop(0)
+        first = self.samples[0]
+        if now - first[0] < COLLAPSE_WINDOW:
+            # Not a full window of history yet.
+            return False
+        rate = (received - first[1]) / (now - first[0])
+        if rate < self.minimum:
+            self.tripped = True
+        return self.tripped
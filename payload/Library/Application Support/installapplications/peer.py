@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+peer.py
+
+LAN peer that serves verified payloads out of a BlobCache, so a room full of
+machines pulls each payload over the uplink roughly once.
+
+The server answers GET and HEAD for /blobs/<hash>, with single Range
+support so interrupted transfers resume. It also answers a UDP broadcast on
+the same port number, which is how clients started with --peer auto find it.
+Clients always verify what they get against the manifest hash and fall back
+to the origin if the peer doesn't have it.
+"""
+
+import BaseHTTPServer
+import os
+import re
+import socket
+import SocketServer
+import threading
+
+DEFAULT_PORT = 8739
+DISCOVER_REQUEST = 'IAPEER?'
+DISCOVER_REPLY = 'IAPEER'
+DISCOVER_TIMEOUT = 1.0
+COPY_CHUNK = 2**20
+BLOB_PATH = re.compile(r'^/blobs/([0-9a-fA-F]{16,128})$')
+RANGE_HEADER = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def blobpath(filehash):
+    return '/blobs/%s' % filehash
+
+
+class BlobHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves blobs from self.server.cache'''
+
+    server_version = 'InstallApplications-peer/1.0'
+
+    def log_message(self, format, *args):
+        self.server.log('%s %s' % (self.client_address[0], format % args))
+
+    def do_HEAD(self):
+        self.serve(body=False)
+
+    def do_GET(self):
+        self.serve(body=True)
+
+    def serve(self, body):
+        match = BLOB_PATH.match(self.path)
+        if not match:
+            self.send_error(404)
+            return
+        path = self.server.cache.path(match.group(1).lower())
+        try:
+            fileref = open(path, 'rb')
+        except IOError:
+            self.send_error(404)
+            return
+        try:
+            size = os.fstat(fileref.fileno()).st_size
+            start, end = 0, size - 1
+            status = 200
+            byterange = self.headers.getheader('Range')
+            if byterange:
+                parsed = RANGE_HEADER.match(byterange.strip())
+                if not parsed or not (parsed.group(1) or parsed.group(2)):
+                    self.send_error(416)
+                    return
+                if parsed.group(1):
+                    start = int(parsed.group(1))
+                    if parsed.group(2):
+                        end = min(int(parsed.group(2)), size - 1)
+                else:
+                    # Suffix range: the last N bytes.
+                    start = max(size - int(parsed.group(2)), 0)
+                if start > end or start >= size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d' % size)
+                    self.end_headers()
+                    return
+                status = 206
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', '"%s"' % match.group(1).lower())
+            if status == 206:
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                    start, end, size))
+            self.end_headers()
+            if not body:
+                return
+            fileref.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = fileref.read(min(COPY_CHUNK, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+            self.server.served += end - start + 1 - remaining
+        except socket.error:
+            # Client went away
+            pass
+        finally:
+            fileref.close()
+
+
+class PeerServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, cache, log):
+        BaseHTTPServer.HTTPServer.__init__(self, address, BlobHandler)
+        self.cache = cache
+        self.log = log
+        self.served = 0
+
+
+def answerdiscovery(port, log):
+    '''Reply to broadcast discovery requests with our http port'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', port))
+    while True:
+        try:
+            data, address = sock.recvfrom(64)
+        except socket.error:
+            continue
+        if data.strip() == DISCOVER_REQUEST:
+            log('Discovery request from %s' % address[0])
+            sock.sendto('%s %d' % (DISCOVER_REPLY, port), address)
+
+
+def serve(cache, port=DEFAULT_PORT, log=None, discovery=True):
+    '''Serve cache until interrupted'''
+    log = log or (lambda text: None)
+    server = PeerServer(('', port), cache, log)
+    if discovery:
+        thread = threading.Thread(target=answerdiscovery, args=(port, log))
+        thread.daemon = True
+        thread.start()
+    log('Serving %s on port %d' % (cache.root, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    log('Served %d bytes' % server.served)
+
+
+def discover(port=DEFAULT_PORT, timeout=DISCOVER_TIMEOUT):
+    '''Broadcast for a peer on the local network. Returns its base url, or
+    None if nobody answered in time.'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    sock.settimeout(timeout)
+    try:
+        sock.sendto(DISCOVER_REQUEST, ('<broadcast>', port))
+        data, address = sock.recvfrom(64)
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+    parts = data.split()
+    if len(parts) != 2 or parts[0] != DISCOVER_REPLY:
+        return None
+    return 'http://%s:%s' % (address[0], parts[1])
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+predicates.py
+
+skip_if preconditions. An item's skip_if is one predicate or a list of
+predicates that must all hold for the item to be skipped:
+
+    {"type": "exists", "path": "/Applications/Foo.app"}
+    {"type": "bundle_version", "path": "/Applications/Foo.app",
+     "version": "2.1"}
+    {"type": "receipt", "packageid": "com.foo.pkg", "version": "2.1"}
+
+bundle_version reads CFBundleShortVersionString (or "key") from the
+bundle's Info.plist, or from path itself if it is a plist. Versions hold
+when the installed one is at least the given one. A predicate that can't be
+evaluated, such as one with an empty version, is logged and does not hold.
+
+Every item is evaluated in one pass before anything is downloaded. Stats,
+plists and receipts are cached for the pass, and the receipts needed are
+queried in parallel first since each one is a pkgutil call.
+"""
+
+import os
+from distutils.version import LooseVersion
+from multiprocessing.pool import ThreadPool
+
+PREDICATE_KEYS = {
+    'exists': ('path',),
+    'bundle_version': ('path', 'version'),
+    'receipt': ('packageid', 'version'),
+}
+DEFAULT_VERSION_KEY = 'CFBundleShortVersionString'
+RECEIPT_WORKERS = 8
+
+
+def aslist(skipif):
+    if skipif is None:
+        return []
+    if isinstance(skipif, dict):
+        return [skipif]
+    return skipif
+
+
+def validate(skipif):
+    '''Return a list of problems with a raw skip_if value'''
+    if not isinstance(skipif, (dict, list)):
+        return ['skip_if must be a predicate or a list of predicates']
+    errors = []
+    for predicate in aslist(skipif):
+        if not isinstance(predicate, dict):
+            errors.append('skip_if predicates must be objects')
+            continue
+        kind = predicate.get('type')
+        if kind not in PREDICATE_KEYS:
+            errors.append('unknown skip_if type \'%s\'' % kind)
+            continue
+        for key in PREDICATE_KEYS[kind]:
+            if not isinstance(predicate.get(key), basestring) or \
+                    not predicate[key]:
+                errors.append('skip_if %s needs \'%s\'' % (kind, key))
+    return errors
+
+
+def atleast(installed, wanted):
+    '''True if version installed is at least wanted. Raises ValueError if
+    wanted is empty or the two can't be compared.'''
+    if installed is None or not str(installed).strip():
+        return False
+    if not str(wanted).strip():
+        raise ValueError('empty version')
+    try:
+        return LooseVersion(str(installed)) >= LooseVersion(str(wanted))
+    except (AttributeError, TypeError):
+        raise ValueError('cannot compare %s with %s' % (installed, wanted))
+
+
+class Evaluator(object):
+    '''Evaluates predicates against the machine with per pass caches'''
+
+    def __init__(self, provider, log=None):
+        self.provider = provider
+        self.log = log or (lambda text: None)
+        self.stats = {}
+        self.plists = {}
+        self.receipts = {}
+
+    def exists(self, path):
+        if path not in self.stats:
+            self.stats[path] = os.path.exists(path)
+        return self.stats[path]
+
+    def plist(self, path):
+        if os.path.isdir(path):
+            path = os.path.join(path, 'Contents', 'Info.plist')
+        if path not in self.plists:
+            self.plists[path] = None
+            if self.exists(path):
+                self.plists[path] = self.provider.readplist(path)
+        return self.plists[path]
+
+    def receipt(self, packageid):
+        if packageid not in self.receipts:
+            self.receipts[packageid] = self.provider.receiptversion(
+                packageid)
+        return self.receipts[packageid]
+
+    def loadreceipts(self, packageids):
+        '''Query the receipts for packageids in parallel'''
+        packageids = [packageid for packageid in set(packageids)
+                      if packageid not in self.receipts]
+        if not packageids:
+            return
+        pool = ThreadPool(min(RECEIPT_WORKERS, len(packageids)))
+        try:
+            versions = pool.map(self.provider.receiptversion, packageids)
+        finally:
+            pool.close()
+            pool.join()
+        self.receipts.update(zip(packageids, versions))
+
+    def holds(self, predicate):
+        try:
+            return self.check(predicate)
+        except ValueError as err:
+            self.log('skip_if %s could not be evaluated, not skipping: %s' %
+                     (predicate['type'], err))
+            return False
+
+    def check(self, predicate):
+        kind = predicate['type']
+        if kind == 'exists':
+            return self.exists(predicate['path'])
+        if kind == 'bundle_version':
+            info = self.plist(predicate['path']) or {}
+            return atleast(info.get(predicate.get('key',
+                                                  DEFAULT_VERSION_KEY)),
+                           predicate['version'])
+        if kind == 'receipt':
+            return atleast(self.receipt(predicate['packageid']),
+                           predicate['version'])
+        return False
+
+    def skip(self, item):
+        '''True if item has skip_if predicates and all of them hold'''
+        predicates = aslist(item.skipif)
+        return bool(predicates) and all(self.holds(predicate)
+                                        for predicate in predicates)
+
+    def current(self, item):
+        '''True if the receipt of package item is at least its version'''
+        if item.type != 'package' or not item.packageid or \
+                not item.version:
+            return False
+        try:
+            return atleast(self.receipt(item.packageid), item.version)
+        except ValueError as err:
+            self.log('Could not compare the receipt of %s, installing it: '
+                     '%s' % (item.name, err))
+            return False
+
+
+def evaluate(items, provider, log=None):
+    '''Mark items whose skip_if holds, or packages whose receipt is already
+    current, as skipped. Returns the skipped items.'''
+    evaluator = Evaluator(provider, log)
+    packageids = []
+    for item in items:
+        if item.type == 'package' and item.packageid and item.version:
+            packageids.append(item.packageid)
+        for predicate in aslist(item.skipif):
+            if predicate['type'] == 'receipt':
+                packageids.append(predicate['packageid'])
+    evaluator.loadreceipts(packageids)
+    skipped = []
+    for item in items:
+        if evaluator.skip(item) or evaluator.current(item):
+            item.skipped = True
+            skipped.append(item)
+    return skipped
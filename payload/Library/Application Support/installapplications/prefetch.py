@@ -0,0 +1,170 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+prefetch.py
+
+Background download-ahead for bootstrap items. Items are still installed in
+the order they are declared; this only decides which bytes arrive first.
+
+Workers take the item that is needed soonest: highest 'priority' first, then
+the earliest in the plan. When there is more than one worker, the last one
+is a bulk lane that starts the largest pending item in the window, so big
+packages use the leftover bandwidth instead of sitting in front of every
+small script.
+
+With a disk budget, an item is only started if the payloads staged from the
+cursor onwards plus its size fit in the budget. Installed payloads are
+reclaimed by the caller, so moving the cursor frees budget.
+
+With a concurrency controller (see concurrency.py) there are as many
+workers as its maximum, but only as many downloads as its current limit
+are started at once.
+"""
+
+import threading
+
+PENDING = 'pending'
+ACTIVE = 'active'
+DONE = 'done'
+FAILED = 'failed'
+CLAIMED = 'claimed'
+
+
+def _nolog(text):
+    pass
+
+
+class Prefetcher(object):
+    '''Downloads items ahead of the execution cursor'''
+
+    def __init__(self, items, fetch, workers=2, lookahead=4, log=None,
+                 budget=None, controller=None):
+        # items must be in execution order. fetch(item) downloads and
+        # verifies a single item and returns True on success; it is called
+        # from worker threads and must not exit the process.
+        self.items = list(items)
+        self.fetch = fetch
+        self.workers = max(1, workers)
+        self.lookahead = max(1, lookahead)
+        self.log = log or _nolog
+        # Bytes that may be staged ahead of the cursor, None for no limit.
+        self.budget = budget
+        self.controller = controller
+        if controller is not None:
+            self.workers = controller.maximum
+        self.positions = dict((id(item), n)
+                              for n, item in enumerate(self.items))
+        self.state = [PENDING] * len(self.items)
+        self.cursor = 0
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.threads = []
+
+    def start(self):
+        for number in range(self.workers):
+            bulk = self.workers > 1 and number == self.workers - 1
+            thread = threading.Thread(target=self.worker, args=(bulk,),
+                                      name='prefetch-%d' % number)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        # Idle workers exit straight away; don't hang on one that is still
+        # downloading something nobody needs any more.
+        for thread in self.threads:
+            thread.join(1)
+
+    def soonest(self, position):
+        item = self.items[position]
+        return (-(item.priority or 0), position)
+
+    def staged(self):
+        '''Bytes fetched or being fetched at or after the cursor'''
+        return sum(self.items[n].size or 0
+                   for n in range(self.cursor, len(self.items))
+                   if self.state[n] in (ACTIVE, DONE))
+
+    def candidates(self):
+        window = self.cursor + self.lookahead + 1
+        pending = [n for n in range(self.cursor,
+                                    min(window, len(self.items)))
+                   if self.state[n] == PENDING]
+        if self.budget is None:
+            return pending
+        staged = self.staged()
+        return [n for n in pending
+                if staged + (self.items[n].size or 0) <= self.budget]
+
+    def nextitem(self, bulk):
+        '''Pick the next position to fetch. Caller holds the lock.'''
+        if self.controller is not None and \
+                self.state.count(ACTIVE) >= self.controller.limit():
+            return None
+        candidates = self.candidates()
+        if not candidates:
+            return None
+        if bulk:
+            largest = max(candidates,
+                          key=lambda n: (self.items[n].size or 0,
+                                         -n))
+            if self.items[largest].size:
+                return largest
+        return min(candidates, key=self.soonest)
+
+    def worker(self, bulk):
+        while True:
+            with self.cond:
+                position = self.nextitem(bulk)
+                while position is None and not self.stopped:
+                    self.cond.wait(1)
+                    position = self.nextitem(bulk)
+                if self.stopped:
+                    return
+                self.state[position] = ACTIVE
+            item = self.items[position]
+            self.log('Prefetching %s' % item.name)
+            try:
+                ok = self.fetch(item)
+            except Exception as err:  # noqa
+                self.log('Prefetch of %s failed: %s' % (item.name, err))
+                ok = False
+            with self.cond:
+                self.state[position] = DONE if ok else FAILED
+                self.cond.notify_all()
+
+    def wait(self, item):
+        '''Called by the main loop before it needs item. Moves the cursor to
+        item and waits for an in-flight fetch to finish. Returns True if the
+        prefetcher fetched it successfully; otherwise the caller downloads
+        it in the foreground.'''
+        position = self.positions.get(id(item))
+        if position is None:
+            return False
+        with self.cond:
+            self.cursor = position
+            self.cond.notify_all()
+            if self.state[position] == PENDING:
+                # Not started yet; the caller fetches it now.
+                self.state[position] = CLAIMED
+                return False
+            while self.state[position] == ACTIVE:
+                self.cond.wait(0.5)
+            return self.state[position] == DONE
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+profiler.py
+
+Per phase profiling for --profile DIR. Each section of a run (loading the
+manifest, downloading or installing one item, ...) gets its own cProfile
+stats file, NNN-<section>.pstats, readable with the pstats module or
+snakeviz. Memory is reported per section in NNN-<section>.memory.txt: the
+top allocations when tracemalloc is importable (the pytracemalloc backport
+on Python 2), otherwise the growth in peak resident size. index.txt lists
+every section with its wall and CPU time.
+
+cProfile only sees the thread that opened the section, so background
+downloads show up as time spent waiting. Sections don't nest; a section
+started inside another one is folded into it. With profiling off the
+NullProfiler is used and sections cost a function call.
+"""
+
+import os
+import re
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+TOP_ALLOCATIONS = 25
+
+
+def safename(name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name)[:80]
+
+
+def maxrss():
+    '''Peak resident size in bytes'''
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+class NullProfiler(object):
+    '''Used when profiling is off'''
+
+    enabled = False
+
+    def start(self, name):
+        pass
+
+    def stop(self):
+        pass
+
+    @contextmanager
+    def section(self, name):
+        yield
+
+
+class Profiler(object):
+    '''Writes a pstats file and a memory report for every section'''
+
+    enabled = True
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.sequence = 0
+        self.current = None
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.index = open(os.path.join(directory, 'index.txt'), 'a')
+        self.index.write('# section wall_seconds cpu_seconds\n')
+
+    def start(self, name):
+        if self.current is not None:
+            return
+        self.sequence += 1
+        import cProfile
+        profile = cProfile.Profile()
+        snapshot = tracemalloc.take_snapshot() if tracemalloc else None
+        self.current = {
+            'name': '%03d-%s' % (self.sequence, safename(name)),
+            'profile': profile, 'snapshot': snapshot, 'rss': maxrss(),
+            'wall': time.time(), 'cpu': time.clock()}
+        profile.enable()
+
+    def stop(self):
+        current = self.current
+        if current is None:
+            return
+        current['profile'].disable()
+        self.current = None
+        wall = time.time() - current['wall']
+        cpu = time.clock() - current['cpu']
+        base = os.path.join(self.directory, current['name'])
+        try:
+            current['profile'].dump_stats(base + '.pstats')
+            with open(base + '.memory.txt', 'w') as report:
+                if current['snapshot'] is not None:
+                    stats = tracemalloc.take_snapshot().compare_to(
+                        current['snapshot'], 'lineno')
+                    for stat in stats[:TOP_ALLOCATIONS]:
+                        report.write('%s\n' % stat)
+                else:
+                    report.write('tracemalloc not available\n')
+                    report.write('peak rss growth: %d bytes\n' % (
+                        maxrss() - current['rss']))
+            self.index.write('%s %.3f %.3f\n' % (current['name'], wall, cpu))
+            self.index.flush()
+        except (IOError, OSError):
+            pass
+
+    @contextmanager
+    def section(self, name):
+        owner = self.current is None
+        self.start(name)
+        try:
+            yield
+        finally:
+            if owner:
+                self.stop()
+
+
+def getprofiler(directory=None):
+    if directory:
+        return Profiler(directory)
+    return NullProfiler()
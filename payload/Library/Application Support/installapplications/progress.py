@@ -0,0 +1,193 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+progress.py
+
+Byte weighted DEPNotify progress. Each item contributes its size once for
+the download and a fraction of it again for the install, so an 8 GB package
+moves the bar proportionally more than a 2 KB script. Throughput is smoothed
+and an ETA is written to DEPNotify no more than once per interval.
+"""
+
+import threading
+import time
+
+# DEPNotify DeterminateManual steps for the whole run.
+STEPS = 1000
+# Items without a 'size' in the json are counted as this many bytes.
+DEFAULT_SIZE = 2**20
+# Installing is weighted as this fraction of an item's download.
+INSTALL_WEIGHT = 0.5
+# Smoothing factor for the throughput moving average.
+SMOOTHING = 0.3
+
+
+def humanbytes(count):
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if abs(count) < 1024.0 or unit == 'GB':
+            if unit == 'bytes':
+                return '%d %s' % (count, unit)
+            return '%.1f %s' % (count, unit)
+        count /= 1024.0
+
+
+def humantime(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return '%d sec' % max(seconds, 1)
+    if seconds < 3600:
+        return '%d min' % ((seconds + 59) // 60)
+    return '%d hr %d min' % (seconds // 3600, (seconds % 3600) // 60)
+
+
+class Progress(object):
+    '''Tracks download and install progress of a set of items'''
+
+    def __init__(self, items, write, interval=1.0, clock=time.time):
+        self.write = write
+        self.interval = interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.weights = {}
+        self.downloaded = {}
+        self.installed = {}
+        self.bytesseen = {}
+        for item in items:
+            self.weights[id(item)] = item.size or DEFAULT_SIZE
+            self.downloaded[id(item)] = 0.0
+            self.installed[id(item)] = 0.0
+        self.total = sum(self.weights.values()) * (1 + INSTALL_WEIGHT)
+        self.sent = 0
+        self.text = None
+        self.lastwrite = 0
+        self.laststatus = None
+        self.received = 0
+        self.lastsample = None
+        self.throughput = None
+
+    def start(self):
+        self.write('Command: DeterminateManual: %d' % STEPS)
+
+    def status(self, text):
+        '''Set the status text shown in DEPNotify'''
+        with self.lock:
+            self.text = text
+            self.update(force=True)
+
+    def download(self, item, received, expected=-1):
+        '''Record bytes received so far for item's download'''
+        key = id(item)
+        if key not in self.weights:
+            return
+        with self.lock:
+            if expected and expected > 0:
+                fraction = float(received) / expected
+            else:
+                fraction = float(received) / self.weights[key]
+            self.downloaded[key] = min(fraction, 1.0)
+            # The first report may include a resumed partial file, which
+            # says nothing about the current throughput.
+            if key in self.bytesseen:
+                self.sample(max(received - self.bytesseen[key], 0))
+            self.bytesseen[key] = received
+            self.update()
+
+    def finishdownload(self, item):
+        key = id(item)
+        if key not in self.weights:
+            return
+        with self.lock:
+            self.downloaded[key] = 1.0
+            self.update()
+
+    def install(self, item, fraction):
+        key = id(item)
+        if key not in self.weights:
+            return
+        with self.lock:
+            self.installed[key] = min(max(fraction, 0.0), 1.0)
+            self.update()
+
+    def finishinstall(self, item):
+        key = id(item)
+        if key not in self.weights:
+            return
+        with self.lock:
+            self.downloaded[key] = 1.0
+            self.installed[key] = 1.0
+            self.update(force=True)
+
+    def sample(self, newbytes):
+        '''Fold newly received bytes into the smoothed throughput'''
+        now = self.clock()
+        self.received += newbytes
+        if self.lastsample is None:
+            self.lastsample = (now, self.received)
+            return
+        elapsed = now - self.lastsample[0]
+        if elapsed < 0.5:
+            return
+        rate = (self.received - self.lastsample[1]) / elapsed
+        if self.throughput is None:
+            self.throughput = rate
+        else:
+            self.throughput = (SMOOTHING * rate +
+                               (1 - SMOOTHING) * self.throughput)
+        self.lastsample = (now, self.received)
+
+    def done(self):
+        work = 0.0
+        for key, weight in self.weights.items():
+            work += weight * self.downloaded[key]
+            work += weight * INSTALL_WEIGHT * self.installed[key]
+        return work
+
+    def remainingbytes(self):
+        return sum(weight * (1 - self.downloaded[key])
+                   for key, weight in self.weights.items())
+
+    def eta(self):
+        if not self.throughput:
+            return None
+        return self.remainingbytes() / self.throughput
+
+    def update(self, force=False):
+        '''Write the bar position and status. Caller holds the lock.'''
+        now = self.clock()
+        if not force and now - self.lastwrite < self.interval:
+            return
+        self.lastwrite = now
+        if self.total:
+            steps = int(self.done() / self.total * STEPS)
+        else:
+            steps = STEPS
+        if steps > self.sent:
+            self.write('Command: DeterminateManualStep: %d' %
+                       (steps - self.sent))
+            self.sent = steps
+        if self.text:
+            details = []
+            if self.throughput and self.remainingbytes() > 0:
+                details.append('%s/s' % humanbytes(self.throughput))
+                details.append('about %s remaining' % humantime(self.eta()))
+            if details:
+                status = 'Status: %s (%s)' % (self.text, ', '.join(details))
+            else:
+                status = 'Status: %s' % self.text
+            if status != self.laststatus:
+                self.write(status)
+                self.laststatus = status
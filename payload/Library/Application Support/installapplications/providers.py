@@ -0,0 +1,307 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+providers.py
+
+Everything installapplications.py needs from the operating system: logging,
+the console user, package receipts and installs, launchctl, rebooting and
+the downloader. MacProvider imports PyObjC and gurl only when a method first
+needs them, and logs to syslog instead of NSLog when foundation is False, so
+--userscript runs never load the Foundation bridge.
+StubProvider has the same interface with no macOS dependencies, so the engine
+can run on Linux for tests and benchmarks.
+"""
+
+import os
+import plistlib
+import pwd
+import subprocess
+import sys
+import syslog
+import threading
+import time
+
+CHUNK = 2**16
+
+
+class MacProvider(object):
+    '''The real thing'''
+
+    name = 'macos'
+    depnotifylog = '/private/var/tmp/depnotify.log'
+    # Set to False before the first log line to log without PyObjC.
+    foundation = True
+
+    def log(self, text):
+        if not self.foundation:
+            syslog.syslog(syslog.LOG_NOTICE, '[InstallApplications] ' + text)
+            return
+        from Foundation import NSLog
+        NSLog('[InstallApplications] ' + text)
+
+    def consoleuser(self):
+        '''(username, uid, gid) of the console user'''
+        from SystemConfiguration import SCDynamicStoreCopyConsoleUser
+        return SCDynamicStoreCopyConsoleUser(None, None, None)
+
+    def receiptversion(self, packageid):
+        '''Installed version of packageid, or 0.0.0.0.0 if not installed'''
+        try:
+            cmd = ['/usr/sbin/pkgutil', '--pkg-info-plist', packageid]
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            receiptout = proc.communicate()[0]
+            if receiptout:
+                plist = plistlib.readPlistFromString(receiptout)
+                return plist['pkg-version']
+        except Exception:
+            pass
+        return '0.0.0.0.0'
+
+    def readplist(self, path):
+        '''Contents of a plist, or None if it can't be read. plistlib only
+        reads XML, so binary plists are converted with plutil.'''
+        try:
+            return plistlib.readPlist(path)
+        except Exception:
+            pass
+        try:
+            proc = subprocess.Popen(
+                ['/usr/bin/plutil', '-convert', 'xml1', '-o', '-', path],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output = proc.communicate()[0]
+            if proc.returncode == 0:
+                return plistlib.readPlistFromString(output)
+        except Exception:
+            pass
+        return None
+
+    def installcommand(self, packagepath):
+        return ['/usr/sbin/installer', '-verboseR', '-pkg', packagepath,
+                '-target', '/']
+
+    def launchctl(self, *arg):
+        # Use *arg to pass unlimited variables to command.
+        run = subprocess.Popen(arg, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+        output, err = run.communicate()
+        return output
+
+    def reboot(self):
+        subprocess.call(['/sbin/shutdown', '-r', 'now'])
+
+    def newdownload(self, options):
+        '''Return an unstarted Gurl for options'''
+        import gurl
+        return gurl.Gurl.alloc().initWithOptions_(options)
+
+    def autoreleasepool(self):
+        '''An autorelease pool for a background thread; delete it when the
+        thread's work is done'''
+        from Foundation import NSAutoreleasePool
+        return NSAutoreleasePool.alloc().init()
+
+
+class StubProvider(object):
+    '''Runs the engine without macOS. Logs go to stderr, packages are not
+    installed and downloads use urllib2.'''
+
+    name = 'stub'
+    depnotifylog = '/tmp/depnotify.log'
+    foundation = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def log(self, text):
+        with self.lock:
+            sys.stderr.write('%s [InstallApplications] %s\n' % (
+                time.strftime('%Y-%m-%d %H:%M:%S'), text))
+
+    def consoleuser(self):
+        user = pwd.getpwuid(os.getuid())
+        return (user.pw_name, user.pw_uid, user.pw_gid)
+
+    def receiptversion(self, packageid):
+        return '0.0.0.0.0'
+
+    def readplist(self, path):
+        try:
+            return plistlib.readPlist(path)
+        except Exception:
+            return None
+
+    def installcommand(self, packagepath):
+        # Nothing to run; installpackage() treats the install as done.
+        return None
+
+    def launchctl(self, *arg):
+        self.log('Stub launchctl: %s' % ' '.join(arg))
+        return ''
+
+    def reboot(self):
+        self.log('Stub reboot')
+
+    def newdownload(self, options):
+        return UrllibDownload(options)
+
+    def autoreleasepool(self):
+        return None
+
+
+class DownloadError(object):
+    '''The parts of NSError that downloadfile() reads'''
+
+    def __init__(self, code, description):
+        self.errorcode = code
+        self.description = description
+
+    def code(self):
+        return self.errorcode
+
+    def localizedDescription(self):
+        return self.description
+
+
+class UrllibDownload(object):
+    '''A Gurl compatible downloader on a background thread. Partial files
+    are resumed with a Range request whenever can_resume is set; callers
+    verify the finished file by hash.'''
+
+    def __init__(self, options):
+        self.url = options.get('url')
+        self.destination_path = options.get('file')
+        self.can_resume = options.get('can_resume', False)
+        self.additional_headers = options.get('additional_headers') or {}
+        self.connection_timeout = options.get('connection_timeout', 60)
+        self.throttle = options.get('throttle')
+        self.resume = False
+        self.response = None
+        self.headers = None
+        self.status = None
+        self.error = None
+        self.SSLerror = None
+        self.done = False
+        self.cancelled = False
+        self.redirection = []
+        self.destination = None
+        self.bytesReceived = 0
+        self.expectedLength = -1
+        self.percentComplete = 0
+        self.startTime = None
+        self.finishTime = None
+        self.thread = None
+
+    def start(self):
+        if not self.destination_path:
+            self.done = True
+            return
+        self.startTime = time.time()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        import urllib2
+        from diskwriter import DiskWriter
+        request = urllib2.Request(self.url)
+        for header, value in self.additional_headers.items():
+            request.add_header(header, value)
+        offset = 0
+        if self.can_resume and os.path.isfile(self.destination_path):
+            offset = os.path.getsize(self.destination_path)
+            if offset:
+                self.resume = True
+                request.add_header('Range', 'bytes=%d-' % offset)
+        try:
+            try:
+                response = urllib2.urlopen(request,
+                                           timeout=self.connection_timeout)
+            except urllib2.HTTPError as err:
+                self.response = err
+                self.status = err.code
+                self.headers = dict(err.info())
+                return
+            self.response = response
+            self.status = response.getcode()
+            self.headers = dict(response.info())
+            if response.geturl() != self.url:
+                self.redirection.append(response.geturl())
+            length = int(self.headers.get('content-length', -1))
+            self.bytesReceived = 0
+            self.percentComplete = -1
+            self.expectedLength = length
+            if self.status == 206 and self.resume:
+                self.bytesReceived = offset
+                if length >= 0:
+                    self.expectedLength = length + offset
+                mode = 'ab'
+            else:
+                mode = 'wb'
+            self.destination = DiskWriter(self.destination_path, mode,
+                                          self.expectedLength)
+            try:
+                while not self.cancelled:
+                    chunk = response.read(CHUNK)
+                    if not chunk:
+                        break
+                    if self.throttle:
+                        self.throttle(len(chunk))
+                    self.destination.write(chunk)
+                    self.bytesReceived += len(chunk)
+                    if self.expectedLength > 0:
+                        self.percentComplete = int(
+                            float(self.bytesReceived) /
+                            float(self.expectedLength) * 100.0)
+            finally:
+                self.destination.close()
+            if self.cancelled:
+                self.error = DownloadError(-999, 'cancelled')
+        except Exception as err:  # noqa
+            self.error = DownloadError(-1, str(err))
+        finally:
+            self.finishTime = time.time()
+            self.done = True
+
+    def cancel(self):
+        self.cancelled = True
+        if self.thread is None:
+            self.done = True
+
+    def isDone(self):
+        if not self.done and self.thread is not None:
+            self.thread.join(0.1)
+        return self.done
+
+    def networkThroughput(self):
+        '''Bytes per second received over the network'''
+        end = self.finishTime or time.time()
+        if not self.startTime or end <= self.startTime:
+            return None
+        return self.bytesReceived / (end - self.startTime)
+
+
+def getprovider(name=None):
+    '''Return the provider called name, or the one for this platform'''
+    if name is None or name == 'auto':
+        name = 'macos' if sys.platform == 'darwin' else 'stub'
+    if name == 'macos':
+        return MacProvider()
+    if name == 'stub':
+        return StubProvider()
+    raise ValueError('Unknown provider: %s' % name)
@@ -0,0 +1,309 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+ratelimit.py
+
+Bandwidth limiting shared by every download of a run. Downloaders call
+throttle(nbytes) for each chunk they receive; the call blocks until a token
+bucket allows it, which slows the socket reads and so the sender.
+
+The limit comes from settings['bandwidth'] in the bootstrap json:
+
+    "bandwidth": {
+        "limit_mbps": 50,
+        "adaptive": true,
+        "schedule": [
+            {"days": ["mon", "tue", "wed", "thu", "fri"],
+             "start": "08:00", "end": "18:00", "limit_mbps": 10}
+        ]
+    }
+
+The first schedule window that covers the local time wins, otherwise
+limit_mbps applies; without either there is no cap. Windows may wrap past
+midnight and days defaults to every day.
+
+In adaptive mode the cap is a ceiling. The round trip time of a TCP connect
+to the download host is sampled in the background; when it rises above the
+lowest seen by more than TARGET_DELAY the link is queueing, so the rate is
+cut, and otherwise it grows back towards the ceiling.
+"""
+
+import socket
+import threading
+import time
+import urlparse
+
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+# How often the schedule is looked at again.
+SCHEDULE_INTERVAL = 30
+# Seconds of traffic the bucket may save up.
+BURST_SECONDS = 0.25
+# Adaptive mode
+PROBE_INTERVAL = 2
+PROBE_TIMEOUT = 2
+BASELINE_SAMPLES = 150
+TARGET_DELAY = 0.05
+DECREASE = 0.7
+INCREASE = 0.1
+MIN_RATE = 64 * 1024
+
+
+def mbps(value):
+    '''Bytes per second for a megabit per second value'''
+    return value * 1000000 / 8.0
+
+
+def parseclock(text):
+    '''Minutes past midnight for "HH:MM", or None if malformed'''
+    try:
+        hours, minutes = text.split(':')
+        hours, minutes = int(hours), int(minutes)
+    except (AttributeError, ValueError):
+        return None
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        return None
+    return hours * 60 + minutes
+
+
+def validlimit(value):
+    return isinstance(value, (int, long, float)) and \
+        not isinstance(value, bool) and value > 0
+
+
+def validate(bandwidth):
+    '''Return a list of problems with a raw settings['bandwidth'] value'''
+    if not isinstance(bandwidth, dict):
+        return ['settings: bandwidth must be an object']
+    errors = []
+    if 'limit_mbps' in bandwidth and not validlimit(bandwidth['limit_mbps']):
+        errors.append('settings: bandwidth limit_mbps must be a positive '
+                      'number')
+    if not isinstance(bandwidth.get('adaptive', False), bool):
+        errors.append('settings: bandwidth adaptive must be true or false')
+    schedule = bandwidth.get('schedule', [])
+    if not isinstance(schedule, list):
+        return errors + ['settings: bandwidth schedule must be a list']
+    for number, window in enumerate(schedule):
+        where = 'settings: bandwidth schedule %d' % number
+        if not isinstance(window, dict):
+            errors.append('%s must be an object' % where)
+            continue
+        for key in ('start', 'end'):
+            if parseclock(window.get(key)) is None:
+                errors.append('%s needs \'%s\' as HH:MM' % (where, key))
+        if not validlimit(window.get('limit_mbps')):
+            errors.append('%s needs a positive limit_mbps' % where)
+        days = window.get('days', DAYS)
+        if not isinstance(days, list) or \
+                not all(day in DAYS for day in days):
+            errors.append('%s days must be a list of %s' % (
+                where, ', '.join(DAYS)))
+    return errors
+
+
+class Schedule(object):
+    '''The cap in bytes per second at a given time'''
+
+    def __init__(self, limit=None, windows=()):
+        self.limit = limit
+        self.windows = []
+        for window in windows:
+            self.windows.append((
+                set(window.get('days', DAYS)),
+                parseclock(window['start']), parseclock(window['end']),
+                mbps(window['limit_mbps'])))
+
+    def cap(self, now=None):
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        today = DAYS[local.tm_wday]
+        yesterday = DAYS[local.tm_wday - 1]
+        for days, start, end, limit in self.windows:
+            if start <= end:
+                if today in days and start <= minute < end:
+                    return limit
+            # The window wraps past midnight; the early hours belong to the
+            # day it started on.
+            elif (today in days and minute >= start) or \
+                    (yesterday in days and minute < end):
+                return limit
+        return self.limit
+
+
+class TokenBucket(object):
+    '''Thread safe token bucket. Consumers take their bytes up front, going
+    into debt if need be, and sleep until the debt would be paid off, so
+    concurrent downloads share the rate fairly.'''
+
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = 0.0
+        self.stamp = time.time()
+
+    def setrate(self, rate):
+        with self.lock:
+            self.refill()
+            self.rate = rate
+
+    def refill(self):
+        now = time.time()
+        if self.rate:
+            self.tokens = min(self.rate * BURST_SECONDS,
+                              self.tokens + (now - self.stamp) * self.rate)
+        else:
+            self.tokens = 0.0
+        self.stamp = now
+
+    def consume(self, nbytes):
+        '''Take nbytes, sleeping as long as needed. Returns the seconds
+        slept.'''
+        with self.lock:
+            if not self.rate:
+                return 0
+            self.refill()
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class Limiter(object):
+    '''Applies a Schedule, and in adaptive mode the RTT back off, to a
+    TokenBucket shared by every download'''
+
+    def __init__(self, schedule, adaptive=False, log=None):
+        self.schedule = schedule
+        self.adaptive = adaptive
+        self.log = log or (lambda text: None)
+        self.bucket = TokenBucket()
+        self.lock = threading.Lock()
+        self.ceiling = None
+        self.checked = 0
+        # Adaptive state
+        self.rate = None
+        self.received = 0
+        self.address = None
+        self.samples = []
+        self.waited = 0.0
+        self.thread = None
+        self.stopped = threading.Event()
+        self.update()
+
+    def update(self):
+        '''Re-read the schedule and apply the current rate'''
+        self.checked = time.time()
+        ceiling = self.schedule.cap()
+        if ceiling != self.ceiling:
+            self.log('Bandwidth limit: %s' % (
+                '%.1f Mbit/s' % (ceiling * 8 / 1000000.0) if ceiling
+                else 'none'))
+            self.ceiling = ceiling
+        rate = self.ceiling
+        if self.rate is not None and (rate is None or self.rate < rate):
+            rate = self.rate
+        self.bucket.setrate(rate)
+
+    def throttle(self, nbytes):
+        '''Called by a downloader for every chunk it receives'''
+        if time.time() - self.checked > SCHEDULE_INTERVAL:
+            with self.lock:
+                self.update()
+        with self.lock:
+            self.received += nbytes
+        waited = self.bucket.consume(nbytes)
+        if waited:
+            with self.lock:
+                self.waited += waited
+
+    def target(self, url):
+        '''Measure round trips against the host of url in adaptive mode'''
+        if not self.adaptive:
+            return
+        parts = urlparse.urlparse(url)
+        if not parts.hostname:
+            return
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.address = (parts.hostname, port)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def probe(self):
+        '''Seconds for a TCP connect to the target, or PROBE_TIMEOUT'''
+        start = time.time()
+        try:
+            connection = socket.create_connection(self.address,
+                                                  PROBE_TIMEOUT)
+            connection.close()
+        except (socket.error, socket.timeout):
+            return PROBE_TIMEOUT
+        return time.time() - start
+
+    def run(self):
+        last = time.time()
+        while not self.stopped.wait(PROBE_INTERVAL):
+            rtt = self.probe()
+            self.samples = (self.samples + [rtt])[-BASELINE_SAMPLES:]
+            now = time.time()
+            with self.lock:
+                observed = self.received / max(now - last, 0.001)
+                self.received = 0
+                last = now
+                self.adjust(rtt - min(self.samples), observed)
+
+    def adjust(self, delay, observed):
+        '''Cut the rate when the link is queueing, grow it otherwise.
+        Caller holds the lock.'''
+        if observed < MIN_RATE:
+            # Nothing much is downloading, so any queue isn't ours and
+            # there is nothing to learn from.
+            return
+        if delay > TARGET_DELAY:
+            current = observed if self.rate is None else \
+                min(self.rate, observed)
+            self.rate = max(MIN_RATE, current * DECREASE)
+            self.log('Round trip up %d ms, backing off to %.1f Mbit/s' % (
+                delay * 1000, self.rate * 8 / 1000000.0))
+        elif self.rate is not None:
+            self.rate += max(MIN_RATE, self.rate * INCREASE)
+            if self.ceiling is not None and self.rate >= self.ceiling:
+                self.rate = None
+            elif self.rate > observed * 4:
+                # Far above what is being used; stop limiting.
+                self.rate = None
+        self.update()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def getlimiter(settings, limit=None, adaptive=None, log=None):
+    '''Return a Limiter for settings['bandwidth'], with limit (Mbit/s) and
+    adaptive overriding the json, or None if nothing is limited'''
+    bandwidth = settings.get('bandwidth', {})
+    if limit is None:
+        limit = bandwidth.get('limit_mbps')
+    if adaptive is None:
+        adaptive = bandwidth.get('adaptive', False)
+    schedule = bandwidth.get('schedule', [])
+    if not limit and not schedule and not adaptive:
+        return None
+    return Limiter(Schedule(mbps(limit) if limit else None, schedule),
+                   adaptive, log)
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+runtrace.py
+
+Per item timings of a run for --trace PATH, which simulate.py replays under
+other settings. Every item that runs gets one record, in the order it ran:
+
+    {"stage": "userland", "name": "Foo", "type": "package",
+     "size": 1048576, "download_seconds": 2.5, "install_seconds": 14.2,
+     "donotwait": false}
+
+size is the payload the item downloads (0 for local files) and
+download_seconds is only there when it came over the network rather than
+from a cache, the bundle or a delta. user_at is when a console user was
+first seen, in seconds after the start of the run. The file is rewritten
+whenever the run ends, successfully or not.
+"""
+
+import json
+import os
+import threading
+import time
+
+from seed import itemkey
+
+
+def filesize(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class NullRecorder(object):
+    '''Used when tracing is off'''
+
+    def download(self, item, seconds):
+        pass
+
+    def install(self, item, seconds):
+        pass
+
+    def userarrived(self):
+        pass
+
+    def write(self):
+        return True
+
+
+class Recorder(object):
+    '''Collects timings from the main loop and the prefetch workers'''
+
+    def __init__(self, path, started=None):
+        self.path = path
+        self.started = started or time.time()
+        self.lock = threading.Lock()
+        self.records = {}
+        self.order = []
+        self.userat = None
+
+    def record(self, item):
+        '''Caller holds the lock'''
+        key = itemkey(item)
+        if key not in self.records:
+            self.records[key] = {
+                'stage': item.stage, 'name': item.name, 'type': item.type,
+                'size': 0, 'install_seconds': 0.0,
+                'donotwait': bool(item.donotwait)}
+        return self.records[key]
+
+    def download(self, item, seconds):
+        '''A network download of item finished and is in its partial path'''
+        with self.lock:
+            record = self.record(item)
+            record['size'] = filesize(item.partial) or item.size or 0
+            record['download_seconds'] = seconds
+
+    def install(self, item, seconds):
+        with self.lock:
+            record = self.record(item)
+            if item.urls and not record['size']:
+                record['size'] = item.size or filesize(item.path)
+            record['install_seconds'] += seconds
+            if itemkey(item) not in self.order:
+                self.order.append(itemkey(item))
+
+    def userarrived(self):
+        with self.lock:
+            if self.userat is None:
+                self.userat = time.time() - self.started
+
+    def write(self):
+        '''Write the trace; False if it could not be written'''
+        with self.lock:
+            trace = {'duration': time.time() - self.started,
+                     'user_at': self.userat,
+                     'items': [self.records[key] for key in self.order]}
+        temp = self.path + '.tmp'
+        try:
+            with open(temp, 'w') as stream:
+                json.dump(trace, stream, indent=1, sort_keys=True)
+            os.rename(temp, self.path)
+        except (IOError, OSError):
+            return False
+        return True
+
+
+def getrecorder(path=None, started=None):
+    if path:
+        return Recorder(path, started)
+    return NullRecorder()
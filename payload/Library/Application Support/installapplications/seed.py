@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+seed.py
+
+Starting a run from a seed manifest shipped in the package. The run begins
+on the seed straight away while the live json is fetched in the background.
+Before each item the current plan is looked at again: once the live plan has
+been adopted, items that already ran (the same stage, file and hash) are not
+run again, and new or changed items run in order in place of the seed's.
+Items of a stage that has already finished are not revisited.
+"""
+
+import threading
+
+# Seconds between attempts to fetch the live json, doubling up to the max.
+RETRY_INTERVAL = 2
+MAX_RETRY_INTERVAL = 60
+
+
+def itemkey(item):
+    return (item.stage, item.path, item.hash)
+
+
+class Revalidator(object):
+    '''Fetches the live json on a background thread. fetch() returns the
+    parsed json or None to be retried.'''
+
+    def __init__(self, fetch, log=None):
+        self.fetch = fetch
+        self.log = log or (lambda text: None)
+        self.result = None
+        self.arrived = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        interval = RETRY_INTERVAL
+        while not self.stopped.is_set():
+            result = self.fetch()
+            if result is not None:
+                self.result = result
+                self.arrived.set()
+                return
+            self.stopped.wait(interval)
+            interval = min(interval * 2, MAX_RETRY_INTERVAL)
+
+    def take(self, timeout=0):
+        '''The live json once it has arrived, waiting up to timeout seconds
+        for it. It is only handed out once; after that this returns None.'''
+        if timeout:
+            self.arrived.wait(timeout)
+        result, self.result = self.result, None
+        return result
+
+    def stop(self):
+        self.stopped.set()
+
+
+class Reconciler(object):
+    '''Hands out the items of each stage one at a time from whichever plan
+    is current. adopt(timeout) returns a plan to switch to, or None; it is
+    called with 0 before every item and, once the last stage has run out of
+    items, with the time left to wait for the live json.'''
+
+    def __init__(self, plan, adopt, finalwait=0):
+        self.plan = plan
+        self.adopt = adopt
+        self.finalwait = finalwait
+        self.done = set()
+
+    def switch(self, timeout):
+        plan = self.adopt(timeout)
+        if plan is not None:
+            self.plan = plan
+            return True
+        return False
+
+    def items(self, stage, last=False):
+        waited = False
+        while True:
+            self.switch(0)
+            pending = [item for item in self.plan.stage(stage)
+                       if itemkey(item) not in self.done]
+            if not pending:
+                # The live json could still add items; the last stage is
+                # the final chance to run them.
+                if last and not waited:
+                    waited = True
+                    if self.switch(self.finalwait):
+                        continue
+                return
+            item = pending[0]
+            self.done.add(itemkey(item))
+            yield item
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2009-2017 Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+verify.py
+
+Remembers which files on disk have already been hashed. Each record keeps
+the inode, size, mtime, digests and time of verification; as long as the
+stat still matches, the file is trusted without being read again. This makes a
+daemon restart with many gigabytes already staged take seconds.
+"""
+
+import json
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import iahash
+
+
+def statkey(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_size, st.st_mtime]
+
+
+class VerifyMemo(object):
+    '''Persistent record of verified files'''
+
+    def __init__(self, path, hashfunc):
+        # hashfunc(filepath, algorithms) returns {algorithm: digest}
+        self.path = path
+        self.hashfunc = hashfunc
+        self.lock = threading.Lock()
+        try:
+            with open(path) as memofile:
+                self.records = json.load(memofile)
+        except (IOError, ValueError):
+            self.records = {}
+
+    def trusted(self, filepath, expected):
+        '''True if filepath was verified to have the expected digests and
+        is unchanged'''
+        record = self.records.get(filepath)
+        if not record or not iahash.matches(record.get('hashes'), expected):
+            return False
+        return record.get('stat') == statkey(filepath)
+
+    def record(self, filepath, digests):
+        key = statkey(filepath)
+        with self.lock:
+            if key is None:
+                self.records.pop(filepath, None)
+            else:
+                self.records[filepath] = {'stat': key, 'hashes': digests,
+                                          'verified': time.time()}
+            self.save()
+
+    def lasthash(self, filepath):
+        '''The digests recorded for filepath the last time it was read'''
+        return self.records.get(filepath, {}).get('hashes')
+
+    def forget(self, filepath):
+        with self.lock:
+            if self.records.pop(filepath, None) is not None:
+                self.save()
+
+    def save(self):
+        '''Write the memo atomically. Caller holds the lock.'''
+        tmppath = '%s.tmp' % self.path
+        try:
+            with open(tmppath, 'w') as memofile:
+                json.dump(self.records, memofile)
+            os.rename(tmppath, self.path)
+        except (IOError, OSError):
+            pass
+
+    def verify(self, filepath, expected):
+        '''Return True if filepath exists and matches the expected
+        {algorithm: digest} dictionary, hashing it only if the memo can't
+        vouch for it.'''
+        if self.trusted(filepath, expected):
+            return True
+        if not os.path.isfile(filepath):
+            return False
+        digests = self.hashfunc(filepath, list(expected))
+        self.record(filepath, digests)
+        return iahash.matches(digests, expected)
+
+    def verifyall(self, pairs, workers=None):
+        '''Verify many (filepath, expected digests) pairs at once. Files the
+        memo already trusts are skipped; the rest are hashed in parallel,
+        which scales because hashlib releases the GIL on large reads.'''
+        results = {}
+        pending = []
+        for filepath, expected in pairs:
+            if self.trusted(filepath, expected):
+                results[filepath] = True
+            elif os.path.isfile(filepath):
+                pending.append((filepath, expected))
+            else:
+                results[filepath] = False
+        if pending:
+            pool = ThreadPool(workers or multiprocessing.cpu_count())
+            try:
+                checked = pool.map(lambda pair: self.verify(*pair), pending)
+            finally:
+                pool.close()
+                pool.join()
+            for (filepath, expected), ok in zip(pending, checked):
+                results[filepath] = ok
+        return results
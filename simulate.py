@@ -0,0 +1,343 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Replay a recorded run under other settings
+# Usage: python simulate.py --trace /path/to/trace.json
+#
+# The trace is written by installapplications.py --trace PATH: the size,
+# download time and install time of every item, in the order they ran, and
+# when a console user appeared. Each --policy replays the bootstrap loop
+# from main() with those timings and predicts how long the run would take
+# and how much disk it would need at most. Nothing is downloaded or run.
+#
+# A policy is a comma separated list of settings, for example
+# "lookahead=4,concurrency=2,cap=20":
+#
+#   lookahead    items downloaded ahead of the one being installed (0 is
+#                the sequential loop)
+#   concurrency  downloads the prefetcher runs at once
+#   scripts      root scripts (without donotwait) run at once, one after
+#                the other within a stage
+#   cap          bandwidth limit in Mbit/s
+#   budget       disk budget in MB for downloading ahead
+#
+# Without --policy a few common ones are compared. "sequential" is the
+# loop as it runs without any of the options.
+#
+# Downloads are modelled as sharing the link fairly, each no faster than it
+# was in the trace. The link is taken to be as fast as the fastest recorded
+# download unless --link-mbps says otherwise; items that didn't come over
+# the network in the trace are given the average recorded rate. Items ahead
+# are started in plan order. Userland packages and user scripts wait for the
+# console user, who logs in when they did in the trace or --user-at seconds
+# into the run.
+#
+# For each policy the time until the setupassistant stage is done, the time
+# until the run is finished (the user has their desktop) and the peak bytes
+# of payloads on disk are printed.
+
+import json
+import optparse
+import sys
+
+DEFAULT_POLICIES = ['sequential', 'lookahead=1', 'lookahead=2',
+                    'lookahead=4', 'lookahead=4,concurrency=4',
+                    'lookahead=4,scripts=4']
+SETTINGS = {'lookahead': int, 'concurrency': int, 'scripts': int,
+            'cap': float, 'budget': float}
+# Seconds below which the simulated clock treats two events as one.
+EPSILON = 1e-9
+
+
+def mbps(value):
+    '''Bytes per second for a megabit per second value'''
+    return value * 1000000 / 8.0
+
+
+def parsepolicy(text):
+    '''Settings for a policy string, raising ValueError if malformed'''
+    policy = {'lookahead': 0, 'concurrency': 2, 'scripts': 1, 'cap': None,
+              'budget': None}
+    if text == 'sequential':
+        return policy
+    for part in text.split(','):
+        key, sep, value = part.partition('=')
+        key = key.strip()
+        if not sep or key not in SETTINGS:
+            raise ValueError('unknown setting %r' % part)
+        policy[key] = SETTINGS[key](value)
+        if policy[key] < 0 or (key in ('concurrency', 'scripts') and
+                               policy[key] < 1):
+            raise ValueError('%s is out of range' % key)
+    return policy
+
+
+def share(rates, capacity):
+    '''Split capacity fairly between downloads, none getting more than its
+    own rate (max-min fairness). rates maps a key to its rate.'''
+    allocation = {}
+    left = capacity
+    pending = sorted(rates, key=lambda key: rates[key])
+    while pending:
+        fair = left / len(pending)
+        key = pending.pop(0)
+        allocation[key] = min(rates[key], fair)
+        left -= allocation[key]
+    return allocation
+
+
+class Item(object):
+    '''One item of the trace'''
+
+    def __init__(self, number, raw, rate):
+        self.number = number
+        self.stage = raw['stage']
+        self.name = raw['name']
+        self.type = raw['type']
+        self.size = raw.get('size') or 0
+        self.install = raw.get('install_seconds') or 0.0
+        self.donotwait = raw.get('donotwait', False)
+        seconds = raw.get('download_seconds')
+        self.rate = self.size / seconds if self.size and seconds else rate
+        # The same payloads installapplications.py reclaims.
+        self.reclaimed = self.size and (
+            self.type == 'package' or
+            (self.type == 'rootscript' and not self.donotwait))
+        # Items that only run inside the user's session.
+        self.needsuser = self.stage == 'userland' and \
+            self.type in ('package', 'userscript')
+        # Root scripts that may run alongside each other.
+        self.parallel = self.type == 'rootscript' and not self.donotwait
+
+
+class Simulation(object):
+    '''The bootstrap loop under one policy'''
+
+    def __init__(self, items, policy, link, userat):
+        self.items = items
+        self.policy = policy
+        self.capacity = link
+        if policy['cap']:
+            self.capacity = min(link, mbps(policy['cap']))
+        self.budget = None
+        if policy['budget'] is not None:
+            self.budget = policy['budget'] * 2**20
+        self.userat = userat or 0.0
+        self.now = 0.0
+        # Bytes left for every download in flight, and which of them the
+        # prefetcher started.
+        self.remaining = {}
+        self.prefetched = set()
+        self.downloaded = set()
+        # Finish time of everything being installed or run.
+        self.running = {}
+        self.cursor = 0
+        self.disk = 0
+        self.peak = 0
+        self.stagedone = {}
+
+    def startdownload(self, number, prefetched=False):
+        item = self.items[number]
+        self.disk += item.size
+        self.peak = max(self.peak, self.disk)
+        if item.size:
+            self.remaining[number] = float(item.size)
+            if prefetched:
+                self.prefetched.add(number)
+        else:
+            self.downloaded.add(number)
+
+    def started(self, number):
+        return number in self.remaining or number in self.downloaded or \
+            number in self.running or number < self.cursor
+
+    def prefetch(self):
+        '''Start downloads ahead of the cursor, as prefetch.py does'''
+        if not self.policy['lookahead']:
+            return False
+        progress = False
+        # The prefetcher's cursor is the item being installed, the one
+        # before ours.
+        base = max(self.cursor - 1, 0)
+        window = min(len(self.items), base + self.policy['lookahead'] + 1)
+        for number in range(self.cursor, window):
+            if len(self.prefetched) >= self.policy['concurrency']:
+                break
+            if self.started(number):
+                continue
+            item = self.items[number]
+            if self.budget is not None:
+                staged = sum(self.items[n].size for n in range(
+                    base, len(self.items))
+                    if n in self.remaining or n in self.downloaded or
+                    n in self.running)
+                if staged + item.size > self.budget:
+                    continue
+            self.startdownload(number, True)
+            progress = True
+        return progress
+
+    def admitted(self, item):
+        '''True if the loop can move on to item'''
+        if not self.running:
+            return True
+        if not item.parallel or len(self.running) >= self.policy['scripts']:
+            return False
+        return all(self.items[n].parallel and self.items[n].stage ==
+                   item.stage for n in self.running)
+
+    def advance(self):
+        '''Move the loop along at the current time. True if anything
+        changed.'''
+        progress = False
+        for number, finish in self.running.items():
+            if finish <= self.now + EPSILON:
+                del self.running[number]
+                item = self.items[number]
+                if item.reclaimed:
+                    self.disk -= item.size
+                progress = True
+        if self.cursor < len(self.items):
+            item = self.items[self.cursor]
+            if self.admitted(item):
+                if not self.started(self.cursor):
+                    # Not fetched ahead; the loop downloads it itself.
+                    self.startdownload(self.cursor)
+                    progress = True
+                if self.cursor in self.downloaded and \
+                        (not item.needsuser or
+                         self.now >= self.userat - EPSILON):
+                    self.downloaded.discard(self.cursor)
+                    # donotwait scripts go on in the background and hold
+                    # nothing up.
+                    seconds = 0.0 if item.donotwait else item.install
+                    self.running[self.cursor] = self.now + seconds
+                    self.cursor += 1
+                    progress = True
+        if self.prefetch():
+            progress = True
+        for stage in set(item.stage for item in self.items):
+            if stage not in self.stagedone and not any(
+                    item.stage == stage and (item.number >= self.cursor or
+                                             item.number in self.running)
+                    for item in self.items):
+                self.stagedone[stage] = self.now
+        return progress
+
+    def step(self):
+        '''Jump to the next event. False when the run is over.'''
+        rates = share(dict((number, self.items[number].rate)
+                           for number in self.remaining), self.capacity)
+        events = list(self.running.values())
+        for number, left in self.remaining.items():
+            if rates[number] > 0:
+                events.append(self.now + left / rates[number])
+        if self.cursor < len(self.items) and \
+                self.items[self.cursor].needsuser and self.userat > self.now:
+            events.append(self.userat)
+        if not events:
+            return False
+        later = max(min(events), self.now)
+        elapsed = later - self.now
+        for number in list(self.remaining):
+            self.remaining[number] -= rates[number] * elapsed
+            if self.remaining[number] < 1:
+                del self.remaining[number]
+                self.prefetched.discard(number)
+                self.downloaded.add(number)
+        self.now = later
+        return True
+
+    def run(self):
+        while True:
+            while self.advance():
+                pass
+            if self.cursor >= len(self.items) and not self.running:
+                return self.now
+            if not self.step():
+                # Nothing can happen any more; a bug rather than a result.
+                raise RuntimeError('simulation stalled at item %d' %
+                                   self.cursor)
+
+
+def loadtrace(path):
+    try:
+        with open(path) as stream:
+            trace = json.load(stream)
+        trace['items']
+    except (IOError, ValueError, KeyError, TypeError) as err:
+        print '[Error] Could not read trace %s: %s' % (path, err)
+        sys.exit(1)
+    return trace
+
+
+def main():
+    usage = '%prog --trace PATH [--policy POLICY ...]'
+    op = optparse.OptionParser(usage=usage)
+    op.add_option('--trace', default=None,
+                  help=('Required: Trace written by installapplications.py '
+                        '--trace'))
+    op.add_option('--policy', default=None, action='append',
+                  help=('Optional: Settings to simulate, e.g. '
+                        '"lookahead=4,concurrency=2". Can be given more '
+                        'than once. Default a few common ones'))
+    op.add_option('--link-mbps', default=None, type='float',
+                  help=('Optional: Speed of the link in Mbit/s. Default '
+                        'the fastest download in the trace'))
+    op.add_option('--user-at', default=None, type='float',
+                  help=('Optional: Seconds into the run the user logs in. '
+                        'Default as recorded'))
+    opts, args = op.parse_args()
+
+    if not opts.trace:
+        op.print_help()
+        sys.exit(1)
+
+    policies = []
+    for text in opts.policy or DEFAULT_POLICIES:
+        try:
+            policies.append((text, parsepolicy(text)))
+        except ValueError as err:
+            print '[Error] Bad policy %s: %s' % (text, err)
+            sys.exit(1)
+
+    trace = loadtrace(opts.trace)
+    recorded = [raw for raw in trace['items']
+                if raw.get('size') and raw.get('download_seconds')]
+    average = None
+    if recorded:
+        average = sum(raw['size'] for raw in recorded) / sum(
+            raw['download_seconds'] for raw in recorded)
+    link = mbps(opts.link_mbps) if opts.link_mbps else None
+    if link is None and recorded:
+        link = max(raw['size'] / raw['download_seconds']
+                   for raw in recorded)
+    if link is None:
+        print ('[Error] The trace has no network downloads to take the '
+               'speed from, pass --link-mbps')
+        sys.exit(1)
+    items = [Item(number, raw, average or link)
+             for number, raw in enumerate(trace['items'])]
+    userat = trace.get('user_at')
+    if opts.user_at is not None:
+        userat = opts.user_at
+
+    print 'Trace: %d items, %.1f MB, recorded run %.1f sec' % (
+        len(items), sum(item.size for item in items) / 2.0**20,
+        trace.get('duration') or 0)
+    print 'Link: %.1f Mbit/s, user logs in at %.1f sec' % (
+        link * 8 / 1000000.0, userat or 0)
+    width = max(len(text) for text, policy in policies)
+    print '%-*s  %14s  %10s  %10s' % (width, 'policy', 'setupassistant',
+                                      'finished', 'peak disk')
+    for text, policy in policies:
+        simulation = Simulation(items, policy, link, userat)
+        finished = simulation.run()
+        setup = simulation.stagedone.get('setupassistant')
+        print '%-*s  %14s  %10s  %10s' % (
+            width, text, '-' if setup is None else '%.1f s' % setup,
+            '%.1f s' % finished, '%.1f MB' % (simulation.peak / 2.0**20))
+
+
+if __name__ == '__main__':
+    main()
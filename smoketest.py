@@ -0,0 +1,360 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Exercise publishing and transfer paths against local stand-ins
+# Usage: python smoketest.py s3 --s3-endpoint-url http://127.0.0.1:5000
+#        python smoketest.py peer versions
+#
+# Each check runs the real code against something local, prints a line per
+# expectation and exits 1 as soon as one fails.
+#
+# s3 publishes a small payload and one large enough for a multipart upload
+# with generatejson.py's S3Uploader, publishes them again and expects both to
+# be skipped on their stored digest, then changes the small one without
+# changing its size and expects it to be uploaded again. Point it at any S3
+# stand-in, e.g. moto (moto_server -p 5000) or MinIO, with credentials in the
+# environment as boto3 expects them (moto takes any, AWS_ACCESS_KEY_ID=test
+# AWS_SECRET_ACCESS_KEY=test). The bucket is created if it doesn't exist and
+# the objects are deleted afterwards. Requires boto3.
+#
+# peer starts installapplications.py --serve on a blob cache holding two of
+# three payloads, then a --dry-run client with --peer pointed at it and a
+# stand-in origin that only has the json and the third payload. The client
+# has to fetch the first payload from the peer, resume the second from a
+# half written partial with a Range request to the peer, and fall back to
+# the origin for the third. Both processes use the stub provider, so this
+# runs anywhere and needs neither root nor macOS.
+#
+# versions validates sizes and package versions the way the client does, and
+# then runs a --dry-run client on packages without a packageid or a version.
+# Those are always installed, never skipped on their receipt.
+
+import BaseHTTPServer
+import json
+import optparse
+import os
+import shutil
+import SimpleHTTPServer
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+# Shared modules live alongside installapplications.py in the payload.
+IADIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'payload', 'Library',
+    'Application Support', 'installapplications')
+sys.path.insert(0, IADIR)
+# PEP8 can really be annoying at times.
+import blobcache  # noqa
+import generatejson  # noqa
+import iahash  # noqa
+import manifest  # noqa
+import predicates  # noqa
+import providers  # noqa
+
+CHUNK = 2**20
+# The smallest part S3 accepts, so the large payload needs three of them.
+PART_MB = 5
+# Seconds to wait for the peer to listen and for the client run to finish.
+STARTUP = 10
+RUNTIME = 120
+# Both ends use the stub provider, so nothing is installed and no root is
+# needed; the launchd identifiers keep the real ones out of reach.
+PROGRAM = [sys.executable, os.path.join(IADIR, 'installapplications.py'),
+           '--provider', 'stub', '--ldidentifier', 'com.example.smoketest',
+           '--laidentifier', 'com.example.smoketest']
+
+
+class Failed(Exception):
+    pass
+
+
+def expect(condition, text):
+    if not condition:
+        raise Failed(text)
+    print '[OK] %s' % text
+
+
+def writefile(path, size):
+    with open(path, 'wb') as fileref:
+        while size > 0:
+            fileref.write(os.urandom(min(CHUNK, size)))
+            size -= CHUNK
+
+
+def checks3(opts, workdir):
+    '''Skip on a matching digest, and multipart upload'''
+    small = os.path.join(workdir, 'small.pkg')
+    large = os.path.join(workdir, 'large.pkg')
+    writefile(small, CHUNK)
+    writefile(large, 2 * PART_MB * 2**20 + CHUNK)
+    prefix = opts.s3_prefix or 'smoketest-%d' % os.getpid()
+
+    def publish(*paths):
+        uploader = generatejson.S3Uploader(
+            opts.s3_bucket, prefix, opts.s3_endpoint_url, 2, PART_MB)
+        try:
+            for path in paths:
+                uploader.upload(path, uploader.key(os.path.basename(path)))
+        finally:
+            uploader.close()
+        return uploader
+
+    store = generatejson.S3Uploader(opts.s3_bucket, prefix,
+                                    opts.s3_endpoint_url, 1, PART_MB)
+    store.close()
+    client = store.client
+    try:
+        client.create_bucket(Bucket=opts.s3_bucket)
+    except store.ClientError:
+        # Already there
+        pass
+    largekey = store.key('large.pkg')
+    try:
+        uploader = publish(small, large)
+        expect(uploader.uploaded == 2 and uploader.skipped == 0,
+               'first publish uploads both payloads')
+        head = client.head_object(Bucket=opts.s3_bucket, Key=largekey)
+        expect(head['ETag'].strip('"').endswith('-3'),
+               'large payload is uploaded in 3 parts')
+        body = client.get_object(Bucket=opts.s3_bucket, Key=largekey)['Body']
+        hash_function = iahash.MultiHash()
+        for chunk in iter(lambda: body.read(CHUNK), ''):
+            hash_function.update(chunk)
+        digest = iahash.gethash(large)
+        expect(hash_function.hexdigests()[iahash.DEFAULT_ALGORITHM] ==
+               digest, 'multipart object matches the file')
+        expect(uploader.storedhash(largekey, os.path.getsize(large)) ==
+               digest, 'digest is stored as an object tag')
+
+        uploader = publish(small, large)
+        expect(uploader.uploaded == 0 and uploader.skipped == 2,
+               'second publish skips both payloads')
+
+        writefile(small, CHUNK)
+        uploader = publish(small, large)
+        expect(uploader.uploaded == 1 and uploader.skipped == 1,
+               'changed payload of the same size is uploaded again')
+    finally:
+        for name in ('small.pkg', 'large.pkg'):
+            try:
+                client.delete_object(Bucket=opts.s3_bucket,
+                                     Key=store.key(name))
+            except store.ClientError:
+                pass
+
+
+class OriginHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    '''Serves server.root and records every path asked for'''
+
+    def translate_path(self, path):
+        return os.path.join(self.server.root, path.split('?')[0].lstrip('/'))
+
+    def log_message(self, format, *args):
+        self.server.requested.append(self.path)
+
+
+def freeport():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def waitforport(port, process):
+    deadline = time.time() + STARTUP
+    while time.time() < deadline and process.poll() is None:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.2)
+    return False
+
+
+def standin(root):
+    '''Serve root on a free port in the background'''
+    origin = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), OriginHandler)
+    origin.root = root
+    origin.requested = []
+    origin.url = 'http://127.0.0.1:%d' % origin.server_port
+    thread = threading.Thread(target=origin.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return origin
+
+
+def client(workdir, jsonurl, *args):
+    '''Run a --dry-run client on jsonurl. Returns its exit code and log.'''
+    log = os.path.join(workdir, 'client.log')
+    process = subprocess.Popen(
+        PROGRAM + ['--iapath', os.path.join(workdir, 'client'), '--dry-run',
+                   '--jsonurl', jsonurl] + list(args),
+        stdout=open(log, 'w'), stderr=subprocess.STDOUT)
+    deadline = time.time() + RUNTIME
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.2)
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+    output = open(log).read()
+    if process.returncode != 0:
+        print ''.join(output.splitlines(True)[-20:])
+    return process.returncode, output
+
+
+def checkpeer(opts, workdir):
+    '''Transfer between a --serve peer and a --peer client'''
+    origindir = os.path.join(workdir, 'origin')
+    cachedir = os.path.join(workdir, 'cache')
+    payloads = os.path.join(workdir, 'payloads')
+    for path in (origindir, payloads):
+        os.makedirs(path)
+    cache = blobcache.BlobCache(cachedir)
+    origin = standin(origindir)
+
+    items = []
+    for number, name in enumerate(('peer.pkg', 'resumed.pkg',
+                                   'origin.pkg')):
+        source = os.path.join(workdir, name)
+        writefile(source, (number + 2) * CHUNK)
+        filehash = iahash.gethash(source)
+        path = os.path.join(payloads, name)
+        if name == 'origin.pkg':
+            shutil.copyfile(source, os.path.join(origindir, name))
+        else:
+            cache.add(source, filehash, link=False)
+        if name == 'resumed.pkg':
+            with open(source, 'rb') as fileref:
+                data = fileref.read(os.path.getsize(source) // 2)
+            with open(path + manifest.PARTIAL_SUFFIX, 'wb') as fileref:
+                fileref.write(data)
+        items.append({'file': path, 'url': '%s/%s' % (origin.url, name),
+                      'hash': filehash, 'name': name, 'type': 'package',
+                      'packageid': 'com.example.%s' % name, 'version': '1.0',
+                      'size': os.path.getsize(source)})
+    with open(os.path.join(origindir, 'bootstrap.json'), 'w') as fileref:
+        json.dump({'preflight': [], 'setupassistant': items,
+                   'userland': []}, fileref)
+
+    port = freeport()
+    peerlog = os.path.join(workdir, 'peer.log')
+    server = subprocess.Popen(
+        PROGRAM + ['--iapath', os.path.join(workdir, 'peer'), '--serve',
+                   '--cachepath', cachedir, '--port', str(port)],
+        stdout=open(peerlog, 'w'), stderr=subprocess.STDOUT)
+    try:
+        expect(waitforport(port, server), 'peer is listening on %d' % port)
+        status, output = client(workdir, origin.url + '/bootstrap.json',
+                                '--peer', 'http://127.0.0.1:%d' % port)
+        expect(status == 0, 'client run succeeds')
+        for item in items:
+            expect(os.path.isfile(item['file']) and
+                   iahash.gethash(item['file']) == item['hash'],
+                   '%s is in place and matches its hash' % item['name'])
+        expect(sorted(origin.requested) ==
+               ['/bootstrap.json', '/origin.pkg'],
+               'origin only served the json and origin.pkg')
+        served = open(peerlog).read()
+        expect('"GET /blobs/%s HTTP/1.1" 200' % items[0]['hash'] in served,
+               'peer.pkg came from the peer')
+        expect('"GET /blobs/%s HTTP/1.1" 206' % items[1]['hash'] in served,
+               'resumed.pkg was resumed from the peer with a Range request')
+        expect('"GET /blobs/%s HTTP/1.1" 404' % items[2]['hash'] in served,
+               'peer reported it does not have origin.pkg')
+    finally:
+        if server.poll() is None:
+            server.terminate()
+            server.wait()
+        origin.shutdown()
+        origin.server_close()
+
+
+def checkversions(opts, workdir):
+    '''Sizes, and packages without a packageid or version'''
+    def errors(**keys):
+        raw = {'name': 'Foo', 'type': 'package', 'file': '/tmp/Foo.pkg',
+               'hash': 'a' * 64, 'packageid': 'com.foo', 'version': '1.0'}
+        raw.update(keys)
+        return manifest.validateitem('setupassistant', 0, raw)
+
+    expect(not errors(size=0), 'size 0 is valid')
+    expect(errors(size=-1) and errors(size=True) and errors(size='1'),
+           'negative, boolean and string sizes are rejected')
+    expect(not errors(version='') and not errors(packageid='', version=''),
+           'empty packageid and version are valid')
+
+    origindir = os.path.join(workdir, 'origin')
+    payloads = os.path.join(workdir, 'payloads')
+    for path in (origindir, payloads):
+        os.makedirs(path)
+    origin = standin(origindir)
+    raws = []
+    for name, packageid in (('noversion.pkg', 'com.example.noversion'),
+                            ('noid.pkg', '')):
+        source = os.path.join(origindir, name)
+        writefile(source, CHUNK)
+        raws.append({'file': os.path.join(payloads, name),
+                     'url': '%s/%s' % (origin.url, name),
+                     'hash': iahash.gethash(source), 'name': name,
+                     'type': 'package', 'packageid': packageid,
+                     'version': ''})
+    iajson = {'preflight': [], 'setupassistant': raws, 'userland': []}
+    with open(os.path.join(origindir, 'bootstrap.json'), 'w') as fileref:
+        json.dump(iajson, fileref)
+    try:
+        plan, planerrors = manifest.loadplan(iajson)
+        skipped = predicates.evaluate(list(plan.items()),
+                                      providers.getprovider('stub'))
+        expect(not planerrors and not skipped,
+               'packages without a version are not skipped on a receipt')
+        status, output = client(workdir, origin.url + '/bootstrap.json')
+        expect(status == 0, 'client run succeeds')
+        for raw in raws:
+            expect('Dry run installing package: %s' % raw['file'] in output,
+                   '%s is installed' % raw['name'])
+    finally:
+        origin.shutdown()
+        origin.server_close()
+
+
+CHECKS = {'peer': checkpeer, 's3': checks3, 'versions': checkversions}
+
+
+def main():
+    usage = '%prog [options] ' + '|'.join(sorted(CHECKS)) + ' ...'
+    op = optparse.OptionParser(usage=usage)
+    op.add_option('--s3-endpoint-url', default=None,
+                  help=('Required for s3: Endpoint of the S3 stand-in'))
+    op.add_option('--s3-bucket', default='installapplications-smoketest',
+                  help=('Optional: Bucket for s3, created if missing. '
+                        'Default installapplications-smoketest'))
+    op.add_option('--s3-prefix', default=None,
+                  help=('Optional: Key prefix for s3. Default one per run'))
+    opts, args = op.parse_args()
+
+    if not args or any(name not in CHECKS for name in args):
+        op.print_help()
+        sys.exit(1)
+    if 's3' in args and not opts.s3_endpoint_url:
+        # Never publish test objects to real S3 by accident.
+        print '[Error] s3 needs --s3-endpoint-url'
+        sys.exit(1)
+
+    for name in args:
+        workdir = tempfile.mkdtemp(prefix='smoketest-')
+        print 'Checking %s' % name
+        try:
+            CHECKS[name](opts, workdir)
+        except Failed as err:
+            print '[Fail] %s' % err
+            sys.exit(1)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()